@@ -0,0 +1,282 @@
+"""
+End to end benchmarks of the local and distributed run tasks against
+synthetic fixtures and local Mongo/Redis instances.
+
+    $ python -m benchmarks.bench run --particles 10,100 --days 1,2 --modes local,distributed
+    $ python -m benchmarks.bench compare benchmarks/results/old.json benchmarks/results/new.json
+
+Each invocation of 'run' writes a JSON file into benchmarks/results named
+after the current commit, so results can be compared across versions.
+"""
+import os
+import sys
+import json
+import math
+import time
+import signal
+import socket
+import argparse
+import platform
+import subprocess
+import multiprocessing
+from datetime import datetime
+
+from benchmarks import fixtures
+
+RESULTS_PATH = os.path.join(os.path.dirname(os.path.abspath(__file__)), "results")
+
+# Kept apart from development data unless overridden in the environment
+DEFAULT_ENVIRONMENT = {
+    'MONGO_URI'         : "mongodb://localhost:27017/larvaservice_benchmark",
+    'REDIS_URI'         : "redis://localhost:6379/15",
+    'RESULTS_REDIS_URI' : "redis://localhost:6379/15",
+}
+
+TASKS = {
+    'local'       : 'larva_service.tasks.local.run',
+    'distributed' : 'larva_service.tasks.distributed.run',
+}
+
+
+def git_version():
+    root = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+    try:
+        return subprocess.check_output(["git", "describe", "--always", "--dirty"], cwd=root).strip()
+    except (OSError, subprocess.CalledProcessError):
+        return "unknown"
+
+
+def configure(workdir):
+    """
+    Point the service at the fixtures and the benchmark databases.  Has to
+    happen before larva_service is imported, which reads its config on import.
+    """
+    for key, value in DEFAULT_ENVIRONMENT.items():
+        os.environ.setdefault(key, value)
+    os.environ.pop('USE_S3', None)
+    os.environ['OUTPUT_PATH'] = os.path.join(workdir, "output")
+    os.environ['CACHE_PATH'] = os.path.join(workdir, "cache")
+    os.environ['BATHY_PATH'] = os.path.join(workdir, "fixtures", "bathymetry.nc")
+    os.environ['SHORE_PATH'] = os.path.join(workdir, "fixtures", "shoreline.shp")
+
+
+def start_worker(queue, burst=False):
+    args = ["rqworker", "-c", "larva_service.defaults", "-w", "larva_service.locality.LocalityWorker", queue]
+    if burst:
+        args.insert(1, "--burst")
+    return subprocess.Popen(args)
+
+
+def reap(process):
+    """
+    Wait for a worker and return its peak RSS in MB, including the
+    work-horse processes it forked.
+    """
+    _, _, usage = os.wait4(process.pid, 0)
+    process.returncode = 0
+    return round(usage.ru_maxrss / 1024., 1)
+
+
+def run_case(mode, particles, days, timestep, paths, workers):
+    from larva_service import db, run_queue
+
+    run = db.Run()
+    run.name = u"benchmark %s %d particles %d days" % (mode, particles, days)
+    run.email = u"benchmark@localhost"
+    run.geometry = fixtures.RELEASE_POINT
+    run.release_depth = 5.
+    run.particles = particles
+    run.duration = days
+    run.timestep = timestep
+    run.start = fixtures.START
+    run.hydro_path = unicode(paths['hydro_path'])
+    run.shoreline_path = unicode(paths['shoreline_path'])
+    run.shoreline_feature = paths['shoreline_feature']
+    run.horiz_dispersion = 0.01
+    run.vert_dispersion = 0.001
+    run.output_formats = [u'trackline']
+    run.save()
+
+    job = run_queue.enqueue_call(func=TASKS[mode], args=(str(run['_id']),))
+    run.task_id = unicode(job.id)
+    run.save()
+
+    particle_workers = []
+    if mode == 'distributed':
+        particle_workers = [start_worker('particles') for i in range(workers)]
+
+    started = time.time()
+    run_rss = reap(start_worker('runs', burst=True))
+    wall = time.time() - started
+
+    particle_rss = []
+    for w in particle_workers:
+        w.send_signal(signal.SIGTERM)
+        particle_rss.append(reap(w))
+
+    run = db.Run.find_one({ '_id' : run['_id'] })
+    timings = run['timings'] or {}
+    steps = int(math.ceil((days * 24 * 60 * 60) / timestep))
+    model_seconds = timings.get('model_run')
+
+    result = {
+        'mode'                  : mode,
+        'particles'             : particles,
+        'days'                  : days,
+        'timestep'              : timestep,
+        'outcome'               : run['task_result'],
+        'wall_seconds'          : round(wall, 3),
+        'particle_steps'        : particles * steps,
+        'particle_steps_per_sec': round(particles * steps / model_seconds, 2) if model_seconds else None,
+        'peak_rss_mb'           : run_rss,
+        'particle_peak_rss_mb'  : max(particle_rss) if particle_rss else None,
+        'timings'               : timings,
+    }
+
+    run.delete()
+    return result
+
+
+def case_key(case):
+    return "%s/%dp/%dd/%ds" % (case['mode'], case['particles'], case['days'], case['timestep'])
+
+
+def run_benchmarks(args):
+    workdir = os.path.abspath(args.workdir)
+    configure(workdir)
+    paths = fixtures.build(os.path.join(workdir, "fixtures"), max(args.days) + 1)
+
+    # Checked before any runs are queued, a missing database otherwise shows up as a hung worker
+    from larva_service import redis_connection
+    redis_connection.ping()
+
+    cases = []
+    for mode in args.modes:
+        for days in args.days:
+            for particles in args.particles:
+                for i in range(args.repeat):
+                    print "Running %s with %d particles for %d days (%d/%d)" % (mode, particles, days, i + 1, args.repeat)
+                    case = run_case(mode, particles, days, args.timestep, paths, args.workers)
+                    print "    %s in %ss, %s particle-steps/sec, %s MB peak" % (case['outcome'], case['wall_seconds'], case['particle_steps_per_sec'], case['peak_rss_mb'])
+                    cases.append(case)
+
+    version = git_version()
+    report = {
+        'version'   : version,
+        'created'   : datetime.utcnow().isoformat(),
+        'host'      : socket.gethostname(),
+        'platform'  : platform.platform(),
+        'python'    : platform.python_version(),
+        'cpus'      : multiprocessing.cpu_count(),
+        'workers'   : args.workers,
+        'cases'     : cases,
+    }
+
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, "%s-%s.json" % (datetime.utcnow().strftime("%Y%m%dT%H%M%S"), version))
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to %s" % path
+
+
+def summarize(report):
+    """
+    Median throughput, peak RSS and phase timings of each case, over repeats
+    """
+    def median(values):
+        values = sorted(v for v in values if v is not None)
+        return values[len(values) // 2] if values else None
+
+    grouped = {}
+    for case in report['cases']:
+        grouped.setdefault(case_key(case), []).append(case)
+
+    summary = {}
+    for key, cases in grouped.items():
+        phases = set(p for c in cases for p in c['timings'])
+        summary[key] = {
+            'particle_steps_per_sec' : median(c['particle_steps_per_sec'] for c in cases),
+            'peak_rss_mb'            : median(c['peak_rss_mb'] for c in cases),
+            'timings'                : dict((p, median(c['timings'].get(p) for c in cases)) for p in phases),
+        }
+    return summary
+
+
+def compare_results(args):
+    with open(args.baseline) as f:
+        baseline = json.load(f)
+    with open(args.candidate) as f:
+        candidate = json.load(f)
+
+    print "Comparing %s against %s" % (candidate['version'], baseline['version'])
+
+    old, new = summarize(baseline), summarize(candidate)
+    regressions = []
+
+    def check(key, metric, before, after, higher_is_better=False):
+        if not before or after is None:
+            return
+        change = (after - before) / float(before)
+        worse = -change if higher_is_better else change
+        flag = ""
+        if worse > args.threshold:
+            flag = "  REGRESSION"
+            regressions.append((key, metric))
+        print "    %-28s %12s %12s %+8.1f%%%s" % (metric, before, after, change * 100, flag)
+
+    for key in sorted(set(old) & set(new)):
+        print key
+        check(key, 'particle_steps_per_sec', old[key]['particle_steps_per_sec'], new[key]['particle_steps_per_sec'], higher_is_better=True)
+        check(key, 'peak_rss_mb', old[key]['peak_rss_mb'], new[key]['peak_rss_mb'])
+        for phase in sorted(set(old[key]['timings']) & set(new[key]['timings'])):
+            # Sub-second phases are too noisy to compare
+            if max(old[key]['timings'][phase], new[key]['timings'][phase]) < args.min_seconds:
+                continue
+            check(key, phase, old[key]['timings'][phase], new[key]['timings'][phase])
+
+    for key in sorted(set(old) ^ set(new)):
+        print "%s only in %s" % (key, baseline['version'] if key in old else candidate['version'])
+
+    if regressions:
+        print "%d regression(s) over %d%%" % (len(regressions), args.threshold * 100)
+        return 1
+    return 0
+
+
+def integers(value):
+    return [int(v) for v in value.split(",") if v.strip()]
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="larva_service run benchmarks")
+    commands = parser.add_subparsers()
+
+    run = commands.add_parser("run", help="Run the benchmarks and store the results")
+    run.add_argument("--particles", type=integers, default=[10, 100], help="Comma separated particle counts")
+    run.add_argument("--days", type=integers, default=[1], help="Comma separated run durations, in days")
+    run.add_argument("--modes", type=lambda v: v.split(","), default=['local', 'distributed'], help="Comma separated: local, distributed")
+    run.add_argument("--timestep", type=int, default=3600, help="Model timestep, in seconds")
+    run.add_argument("--workers", type=int, default=multiprocessing.cpu_count(), help="Particle workers for distributed runs")
+    run.add_argument("--repeat", type=int, default=1, help="Runs of each case")
+    run.add_argument("--workdir", default=os.path.join("/tmp", "larva_benchmark"), help="Fixtures, output and cache")
+    run.add_argument("--output", default=RESULTS_PATH, help="Folder for the results file")
+    run.set_defaults(func=run_benchmarks)
+
+    compare = commands.add_parser("compare", help="Compare two results files")
+    compare.add_argument("baseline")
+    compare.add_argument("candidate")
+    compare.add_argument("--threshold", type=float, default=0.1, help="Relative change counted as a regression")
+    compare.add_argument("--min-seconds", type=float, default=1., help="Ignore phases shorter than this")
+    compare.set_defaults(func=compare_results)
+
+    args = parser.parse_args(argv)
+    for mode in getattr(args, 'modes', []):
+        if mode not in TASKS:
+            parser.error("Unknown mode '%s'" % mode)
+
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
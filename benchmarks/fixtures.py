@@ -0,0 +1,220 @@
+"""
+Synthetic inputs for the benchmarks: a hydrodynamic model, a bathymetry grid
+and a shoreline covering the same small domain, so runs need no network access.
+"""
+import os
+import math
+from datetime import datetime
+
+import numpy as np
+
+# minx, miny, maxx, maxy of the hydro domain
+DOMAIN = (-148.0, 60.0, -146.0, 61.5)
+# Land covers the domain north of this latitude, plus one island
+COAST_LATITUDE = 61.2
+ISLAND = (-146.65, 60.35, -146.5, 60.45)
+
+RELEASE_POINT = u"POINT (-147 60.75)"
+START = datetime(2014, 1, 1)
+
+DEPTHS = [0., 5., 10., 25., 50., 100.]
+TIDAL_PERIOD_HOURS = 12.42
+
+
+def write_hydro(path, days, resolution=0.02, step_hours=1):
+    """
+    CF hydro file with u/v/w/temp/salt on a regular (time, depth, lat, lon)
+    grid: a gyre around the middle of the domain with a tidal oscillation on
+    top, both decaying with depth.
+    """
+    import netCDF4
+
+    minx, miny, maxx, maxy = DOMAIN
+    lons = np.arange(minx, maxx + resolution / 2., resolution)
+    lats = np.arange(miny, maxy + resolution / 2., resolution)
+    hours = np.arange(0, days * 24 + step_hours, step_hours, dtype=np.float64)
+    depths = np.array(DEPTHS)
+
+    x, y = np.meshgrid(lons, lats)
+    cx, cy = (minx + maxx) / 2., (miny + maxy) / 2.
+    decay = np.exp(-depths / 50.)[:, np.newaxis, np.newaxis]
+    column = np.ones((len(depths), len(lats), len(lons)), dtype=np.float32)
+    profile = depths[:, np.newaxis, np.newaxis]
+
+    tmp = path + ".tmp"
+    nc = netCDF4.Dataset(tmp, "w")
+    try:
+        nc.Conventions = "CF-1.6"
+        nc.title = "Synthetic hydro for larva_service benchmarks"
+        nc.createDimension("time", None)
+        nc.createDimension("depth", len(depths))
+        nc.createDimension("lat", len(lats))
+        nc.createDimension("lon", len(lons))
+
+        t = nc.createVariable("time", "f8", ("time",))
+        t.units = "hours since %s" % START.strftime("%Y-%m-%d %H:%M:%S")
+        t.standard_name = "time"
+        t.axis = "T"
+
+        d = nc.createVariable("depth", "f4", ("depth",))
+        d.units = "m"
+        d.standard_name = "depth"
+        d.positive = "down"
+        d.axis = "Z"
+        d[:] = depths
+
+        lat = nc.createVariable("lat", "f8", ("lat",))
+        lat.units = "degrees_north"
+        lat.standard_name = "latitude"
+        lat.axis = "Y"
+        lat[:] = lats
+
+        lon = nc.createVariable("lon", "f8", ("lon",))
+        lon.units = "degrees_east"
+        lon.standard_name = "longitude"
+        lon.axis = "X"
+        lon[:] = lons
+
+        variables = {}
+        for name, standard_name, units in [("u",    "eastward_sea_water_velocity",  "m/s"),
+                                           ("v",    "northward_sea_water_velocity", "m/s"),
+                                           ("w",    "upward_sea_water_velocity",    "m/s"),
+                                           ("temp", "sea_water_temperature",        "degC"),
+                                           ("salt", "sea_water_salinity",           "1e-3")]:
+            var = nc.createVariable(name, "f4", ("time", "depth", "lat", "lon"), zlib=True, complevel=1,
+                                    chunksizes=(1, len(depths), len(lats), len(lons)))
+            var.standard_name = standard_name
+            var.units = units
+            variables[name] = var
+
+        # One timestep at a time so long durations never sit in memory
+        for i, hour in enumerate(hours):
+            t[i] = hour
+            tide = 0.15 * math.sin(2 * math.pi * hour / TIDAL_PERIOD_HOURS)
+            variables["u"][i] = decay * (-0.3 * (y - cy) + tide)
+            variables["v"][i] = decay * (0.3 * (x - cx) + tide / 2.)
+            variables["w"][i] = column * 0.
+            variables["temp"][i] = column * (8. - profile * 0.04 + 0.5 * math.sin(2 * math.pi * hour / 24.))
+            variables["salt"][i] = column * (31. + profile * 0.01)
+    finally:
+        nc.close()
+
+    os.rename(tmp, path)
+    return path
+
+
+def write_bathymetry(path, resolution=0.01, padding=0.5):
+    """
+    Depths ('z', negative down) shoaling towards the coast, positive on land
+    """
+    import netCDF4
+
+    minx, miny, maxx, maxy = DOMAIN
+    lons = np.arange(minx - padding, maxx + padding + resolution / 2., resolution)
+    lats = np.arange(miny - padding, maxy + padding + resolution / 2., resolution)
+    x, y = np.meshgrid(lons, lats)
+
+    z = -(20. + 400. * np.clip((COAST_LATITUDE - y) / (COAST_LATITUDE - miny + padding), 0, 1))
+    z[y >= COAST_LATITUDE] = 50.
+    ix0, iy0, ix1, iy1 = ISLAND
+    z[(x >= ix0) & (x <= ix1) & (y >= iy0) & (y <= iy1)] = 10.
+
+    tmp = path + ".tmp"
+    nc = netCDF4.Dataset(tmp, "w")
+    try:
+        nc.createDimension("lat", len(lats))
+        nc.createDimension("lon", len(lons))
+
+        lat = nc.createVariable("lat", "f8", ("lat",))
+        lat.units = "degrees_north"
+        lat.standard_name = "latitude"
+        lat[:] = lats
+
+        lon = nc.createVariable("lon", "f8", ("lon",))
+        lon.units = "degrees_east"
+        lon.standard_name = "longitude"
+        lon[:] = lons
+
+        depth = nc.createVariable("z", "f4", ("lat", "lon"), zlib=True)
+        depth.units = "m"
+        depth.positive = "up"
+        depth[:] = z
+    finally:
+        nc.close()
+
+    os.rename(tmp, path)
+    return path
+
+
+def shoreline_polygons(padding=0.5, islands=0):
+    """
+    The mainland north of the coast, the fixed island and 'islands' more small
+    irregular islands scattered over the water.
+    """
+    from shapely.geometry import box, Polygon
+
+    minx, miny, maxx, maxy = DOMAIN
+    polygons = [box(minx - padding, COAST_LATITUDE, maxx + padding, maxy + padding), box(*ISLAND)]
+
+    # Seeded, so every run of the benchmarks sees the same coastline
+    random = np.random.RandomState(0)
+    for i in range(islands):
+        cx = random.uniform(minx, maxx)
+        cy = random.uniform(miny, COAST_LATITUDE - 0.05)
+        angles = np.linspace(0, 2 * np.pi, random.randint(8, 40), endpoint=False)
+        radii = random.uniform(0.002, 0.02, len(angles))
+        polygons.append(Polygon(zip(cx + radii * np.cos(angles), cy + radii * np.sin(angles))))
+
+    return polygons
+
+
+def write_shoreline(path, padding=0.5, islands=0):
+    """
+    ESRI Shapefile of shoreline_polygons.  Returns the layer name to use as
+    the run's shoreline_feature.
+    """
+    from osgeo import ogr, osr
+
+    driver = ogr.GetDriverByName("ESRI Shapefile")
+    if os.path.exists(path):
+        driver.DeleteDataSource(path)
+
+    name = os.path.splitext(os.path.basename(path))[0]
+    srs = osr.SpatialReference()
+    srs.ImportFromEPSG(4326)
+
+    source = driver.CreateDataSource(path)
+    layer = source.CreateLayer(name, srs, ogr.wkbPolygon)
+    for polygon in shoreline_polygons(padding, islands):
+        feature = ogr.Feature(layer.GetLayerDefn())
+        feature.SetGeometry(ogr.CreateGeometryFromWkt(polygon.wkt))
+        layer.CreateFeature(feature)
+        feature.Destroy()
+    source.Destroy()
+
+    return unicode(name)
+
+
+def build(folder, days):
+    """
+    Write any missing fixtures into 'folder', with hydro covering 'days' days.
+    Returns a dict of their paths.
+    """
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    fixtures = {
+        'hydro_path'        : os.path.join(folder, "hydro_%dd.nc" % days),
+        'bathy_path'        : os.path.join(folder, "bathymetry.nc"),
+        'shoreline_path'    : os.path.join(folder, "shoreline.shp"),
+    }
+
+    if not os.path.exists(fixtures['hydro_path']):
+        write_hydro(fixtures['hydro_path'], days)
+    if not os.path.exists(fixtures['bathy_path']):
+        write_bathymetry(fixtures['bathy_path'])
+    if not os.path.exists(fixtures['shoreline_path']):
+        write_shoreline(fixtures['shoreline_path'])
+    fixtures['shoreline_feature'] = unicode(os.path.splitext(os.path.basename(fixtures['shoreline_path']))[0])
+
+    return fixtures
@@ -0,0 +1,355 @@
+"""
+Load benchmark of the web tier's listing and status endpoints.
+
+Seeds the benchmark database with runs, datasets and shorelines plus the RQ
+job hashes the run status lookups read, then drives each endpoint at a fixed
+concurrency and reports latency percentiles and the Mongo/Redis operations
+each request cost.
+
+    $ python -m benchmarks.web seed --runs 100000 --datasets 1000 --shorelines 100
+    $ python -m benchmarks.web load --concurrency 8 --requests 500
+
+Without --url the app is served in-process by a threaded werkzeug server.
+"""
+import os
+import sys
+import json
+import time
+import random
+import argparse
+import threading
+import urllib
+import urllib2
+from datetime import datetime, timedelta
+
+import numpy as np
+from bson.objectid import ObjectId
+from bson.binary import Binary
+
+from benchmarks import fixtures
+from benchmarks.bench import RESULTS_PATH, configure, git_version
+
+PERCENTILES = [50, 90, 95, 99]
+
+ENDPOINTS = ['runs_list', 'run_status', 'run_show', 'datasets_list', 'datasets_covering', 'shoreline_geoms']
+
+RUN_TASK = 'larva_service.tasks.distributed.run'
+
+
+def connect():
+    from mongokit import Connection
+    from larva_service import app
+
+    database = app.config['MONGODB_DATABASE']
+    if not database.endswith("_benchmark") and not os.environ.get("LARVA_BENCHMARK_FORCE"):
+        raise SystemExit("Refusing to use database '%s', benchmark databases end in '_benchmark' (set LARVA_BENCHMARK_FORCE=1 to override)" % database)
+    return Connection(app.config['MONGODB_HOST'], app.config['MONGODB_PORT'])[database]
+
+
+def make_run(i, created, task_id):
+    finished = i % 10 != 0
+    run_id = "%024x" % i
+    return {
+        '_id'               : ObjectId(run_id),
+        'name'              : u"Load run %d" % i,
+        'behavior'          : u"https://larvamap.s3.amazonaws.com/resources/benchmark.json",
+        'cached_behavior'   : { 'results' : [{ 'name' : u"benchmark", 'lifestages' : [] }] },
+        'particles'         : 100,
+        'hydro_path'        : u"http://example.com/thredds/dodsC/benchmark.nc",
+        'geometry'          : fixtures.RELEASE_POINT,
+        'release_depth'     : 5.,
+        'start'             : fixtures.START,
+        'duration'          : 2,
+        'timestep'          : 3600,
+        'horiz_dispersion'  : 0.01,
+        'vert_dispersion'   : 0.001,
+        'time_chunk'        : 10,
+        'horiz_chunk'       : 5,
+        'time_method'       : u'interp',
+        'created'           : created,
+        'task_id'           : task_id,
+        'email'             : u"benchmark@localhost",
+        'output'            : [u"/output/%s/%s" % (run_id, f) for f in ['trackline.geojson', 'model.log', 'results.h5']] if finished else [],
+        'task_result'       : u'success' if finished else u'',
+        'trackline'         : None,
+        'started'           : created + timedelta(minutes=1),
+        'ended'             : created + timedelta(minutes=30) if finished else None,
+        'shoreline_path'    : None,
+        'shoreline_feature' : None,
+        'final_message'     : u'Complete' if finished else u'',
+        'output_formats'    : [u'trackline'],
+        'exports'           : { 'trackline' : { 'status' : u'success', 'seconds' : 1.2 } } if finished else {},
+        'particle_store'    : u'',
+        'timings'           : { 'model_run' : 1500., 'export' : 1.2 } if finished else {},
+    }
+
+
+def make_trackline(i, created):
+    from larva_service import tracklines
+
+    geo = { 'type' : 'LineString', 'coordinates' : [[-147 + k * 0.01, 60.75 + k * 0.005] for k in range(48)] }
+    return { '_id' : ObjectId("%024x" % i), 'data' : Binary(tracklines.encode(geo)), 'positions' : 48, 'created' : created }
+
+
+def make_dataset(i, created):
+    from larva_service.models.dataset import footprint
+
+    minx, miny, maxx, maxy = fixtures.DOMAIN
+    dx, dy = (i % 20) * 0.5, (i // 20 % 20) * 0.5
+    bbox = u"POLYGON ((%s %s, %s %s, %s %s, %s %s, %s %s))" % (minx + dx, miny + dy, maxx + dx, miny + dy, maxx + dx, maxy + dy, minx + dx, maxy + dy, minx + dx, miny + dy)
+    variables = {}
+    for name, standard_name in [('u', 'eastward_sea_water_velocity'), ('v', 'northward_sea_water_velocity'),
+                                ('w', 'upward_sea_water_velocity'), ('temp', 'sea_water_temperature'),
+                                ('salt', 'sea_water_salinity'), ('zeta', 'sea_surface_height')]:
+        variables[name] = { 'attributes' : { 'standard_name' : standard_name, 'units' : 'unknown', 'long_name' : name * 8 },
+                            'dimensions' : ['time', 'depth', 'lat', 'lon'] }
+    return {
+        'name'      : u"Load dataset %d" % i,
+        'starting'  : fixtures.START,
+        'ending'    : fixtures.START + timedelta(days=365),
+        'timestep'  : 3600,
+        'location'  : u"http://example.com/thredds/dodsC/dataset_%d.nc" % i,
+        'bbox'      : bbox,
+        'geometry'  : bbox,
+        'footprint' : footprint(bbox),
+        'variables' : variables,
+        'keywords'  : [u"benchmark", u"ocean", u"model"],
+        'messages'  : [],
+        'task_id'   : None,
+        'created'   : created,
+        'updated'   : created,
+    }
+
+
+def seed(args):
+    from rq.job import Job
+    from larva_service import app, redis_connection
+    from larva_service.shoreline_index import build_index
+    from larva_service.models.dataset import index_datasets
+
+    mongo = connect()
+    for collection in ['runs', 'tracklines', 'datasets', 'shorelines']:
+        mongo.drop_collection(collection)
+
+    now = datetime.utcnow()
+    batch = 1000
+
+    print "Seeding %d runs" % args.runs
+    for offset in range(0, args.runs, batch):
+        runs = []
+        pipe = redis_connection.pipeline(transaction=False)
+        for i in range(offset, min(offset + batch, args.runs)):
+            task_id = u"benchmark-%d" % i
+            run = make_run(i, now - timedelta(minutes=i), task_id)
+            runs.append(run)
+
+            job = Job.create(func=RUN_TASK, args=("%024x" % i,), connection=redis_connection, id=task_id,
+                             status='finished' if run['task_result'] else 'started')
+            job.meta = { 'progress' : 100 if run['task_result'] else 42, 'message' : run['final_message'] or u"Running", 'updated' : now }
+            job.save(pipeline=pipe)
+        mongo['runs'].insert(runs)
+        mongo['tracklines'].insert([make_trackline(i, now) for i in range(offset, min(offset + batch, args.runs)) if i % 10 != 0])
+        pipe.execute()
+
+    print "Seeding %d datasets" % args.datasets
+    mongo['datasets'].insert([make_dataset(i, now - timedelta(hours=i)) for i in range(args.datasets)])
+    with app.app_context():
+        index_datasets()
+
+    print "Seeding %d shorelines" % args.shorelines
+    folder = os.path.join(os.path.abspath(args.workdir), "fixtures")
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    shoreline_path = os.path.join(folder, "web_shoreline.shp")
+    feature = fixtures.write_shoreline(shoreline_path, islands=args.islands)
+    index_path = os.path.join(app.config['SHORELINE_INDEX_PATH'], "benchmark")
+    stats = build_index(fixtures.shoreline_polygons(islands=args.islands), index_path)
+
+    minx, miny, maxx, maxy = fixtures.DOMAIN
+    mongo['shorelines'].insert([{
+        'name'         : u"Load shoreline %d" % i,
+        'path'         : unicode(shoreline_path),
+        'path_type'    : u"Shapefile",
+        'feature_name' : feature,
+        'title'        : None,
+        'bbox'         : u"POLYGON ((%s %s, %s %s, %s %s, %s %s, %s %s))" % (minx, miny, maxx, miny, maxx, maxy, minx, maxy, minx, miny),
+        'geometry'     : None,
+        'index_path'   : unicode(index_path),
+        'index_stats'  : stats,
+        'task_id'      : None,
+        'created'      : now - timedelta(days=i),
+        'updated'      : now - timedelta(days=i),
+    } for i in range(args.shorelines)])
+
+
+def counters():
+    """
+    Server wide Mongo operation and Redis command totals
+    """
+    from larva_service import redis_connection
+
+    ops = connect().command('serverStatus')['opcounters']
+    return sum(ops.values()), redis_connection.info()['total_commands_processed']
+
+
+def requests_for(endpoint, base, run_ids, shoreline_ids):
+    """
+    An endless supply of (url, POST data or None) for an endpoint
+    """
+    minx, miny, maxx, maxy = fixtures.DOMAIN
+    while True:
+        if endpoint == 'runs_list':
+            yield base + "/runs.json", None
+        elif endpoint == 'run_status':
+            yield base + "/runs/%s/status.json" % random.choice(run_ids), None
+        elif endpoint == 'run_show':
+            yield base + "/runs/%s.json" % random.choice(run_ids), None
+        elif endpoint == 'datasets_list':
+            yield base + "/datasets.json", None
+        elif endpoint == 'datasets_covering':
+            x, y = random.uniform(minx, maxx), random.uniform(miny, maxy)
+            start = fixtures.START + timedelta(days=random.randint(0, 360))
+            yield base + "/datasets.json?" + urllib.urlencode({ 'contains' : "POINT (%s %s)" % (x, y),
+                                                                'start'    : start.isoformat(),
+                                                                'end'      : (start + timedelta(days=2)).isoformat() }), None
+        elif endpoint == 'shoreline_geoms':
+            x, y = random.uniform(minx, maxx - 0.25), random.uniform(miny, maxy - 0.25)
+            # The view takes miny,minx,maxy,maxx
+            bounds = "%s,%s,%s,%s" % (y, x, y + 0.25, x + 0.25)
+            yield base + "/shorelines/%s/geoms" % random.choice(shoreline_ids), urllib.urlencode({ 'bounds' : bounds })
+
+
+def drive(endpoint, base, run_ids, shoreline_ids, concurrency, total):
+    supply = requests_for(endpoint, base, run_ids, shoreline_ids)
+    lock = threading.Lock()
+    latencies = []
+    errors = [0]
+    remaining = [total]
+
+    def worker():
+        while True:
+            with lock:
+                if remaining[0] <= 0:
+                    return
+                remaining[0] -= 1
+                url, data = next(supply)
+            started = time.time()
+            try:
+                urllib2.urlopen(url, data).read()
+            except (urllib2.URLError, IOError):
+                with lock:
+                    errors[0] += 1
+                continue
+            elapsed = time.time() - started
+            with lock:
+                latencies.append(elapsed)
+
+    before = counters()
+    started = time.time()
+    threads = [threading.Thread(target=worker) for i in range(concurrency)]
+    for t in threads:
+        t.start()
+    for t in threads:
+        t.join()
+    wall = time.time() - started
+    after = counters()
+
+    result = {
+        'endpoint'          : endpoint,
+        'requests'          : total,
+        'errors'            : errors[0],
+        'concurrency'       : concurrency,
+        'requests_per_sec'  : round(total / wall, 2),
+        'mongo_ops_per_request' : round((after[0] - before[0]) / float(total), 2),
+        'redis_commands_per_request' : round((after[1] - before[1]) / float(total), 2),
+    }
+    if latencies:
+        values = np.percentile(np.array(latencies) * 1000, PERCENTILES)
+        for p, v in zip(PERCENTILES, values):
+            result['p%d_ms' % p] = round(float(v), 2)
+        result['max_ms'] = round(max(latencies) * 1000, 2)
+    return result
+
+
+def serve():
+    from werkzeug.serving import make_server
+    from larva_service import app
+
+    server = make_server("127.0.0.1", 0, app, threaded=True)
+    thread = threading.Thread(target=server.serve_forever)
+    thread.daemon = True
+    thread.start()
+    return "http://127.0.0.1:%d" % server.server_port
+
+
+def load(args):
+    mongo = connect()
+    run_ids = [str(r['_id']) for r in mongo['runs'].find({}, { '_id' : 1 }).limit(10000)]
+    shoreline_ids = [str(s['_id']) for s in mongo['shorelines'].find({}, { '_id' : 1 })]
+    if not run_ids or not shoreline_ids:
+        raise SystemExit("The benchmark database is empty, run 'seed' first")
+
+    base = args.url.rstrip("/") if args.url else serve()
+    counts = {
+        'runs'       : mongo['runs'].count(),
+        'datasets'   : mongo['datasets'].count(),
+        'shorelines' : len(shoreline_ids),
+    }
+    print "Load testing %s with %d runs, %d datasets and %d shorelines" % (base, counts['runs'], counts['datasets'], counts['shorelines'])
+
+    results = []
+    for endpoint in args.endpoints:
+        # Listings return every document, so they get fewer requests
+        total = args.requests if endpoint not in ['runs_list', 'datasets_list'] else max(1, args.requests // 10)
+        result = drive(endpoint, base, run_ids, shoreline_ids, args.concurrency, total)
+        print "%-16s %8s req/s  p50 %8s ms  p99 %8s ms  %s mongo ops  %s redis commands per request" % (
+            endpoint, result['requests_per_sec'], result.get('p50_ms'), result.get('p99_ms'),
+            result['mongo_ops_per_request'], result['redis_commands_per_request'])
+        results.append(result)
+
+    report = {
+        'version'   : git_version(),
+        'created'   : datetime.utcnow().isoformat(),
+        'url'       : args.url or "in-process",
+        'documents' : counts,
+        'endpoints' : results,
+    }
+    if not os.path.exists(args.output):
+        os.makedirs(args.output)
+    path = os.path.join(args.output, "web-%s-%s.json" % (datetime.utcnow().strftime("%Y%m%dT%H%M%S"), report['version']))
+    with open(path, "w") as f:
+        json.dump(report, f, indent=2, sort_keys=True)
+    print "Results written to %s" % path
+
+
+def main(argv=None):
+    parser = argparse.ArgumentParser(description="larva_service web tier load benchmark")
+    parser.add_argument("--workdir", default=os.path.join("/tmp", "larva_benchmark"), help="Fixtures, output and cache")
+    commands = parser.add_subparsers()
+
+    seeding = commands.add_parser("seed", help="Replace the benchmark database contents")
+    seeding.add_argument("--runs", type=int, default=10000)
+    seeding.add_argument("--datasets", type=int, default=1000)
+    seeding.add_argument("--shorelines", type=int, default=100)
+    seeding.add_argument("--islands", type=int, default=5000, help="Polygons in the shared synthetic shoreline")
+    seeding.set_defaults(func=seed)
+
+    loading = commands.add_parser("load", help="Drive the endpoints and store the results")
+    loading.add_argument("--url", default=None, help="Running server to test, served in-process if empty")
+    loading.add_argument("--concurrency", type=int, default=8)
+    loading.add_argument("--requests", type=int, default=500, help="Requests per lookup endpoint, a tenth of this for listings")
+    loading.add_argument("--endpoints", type=lambda v: v.split(","), default=ENDPOINTS, help="Comma separated: %s" % ", ".join(ENDPOINTS))
+    loading.add_argument("--output", default=RESULTS_PATH, help="Folder for the results file")
+    loading.set_defaults(func=load)
+
+    args = parser.parse_args(argv)
+    for endpoint in getattr(args, 'endpoints', []):
+        if endpoint not in ENDPOINTS:
+            parser.error("Unknown endpoint '%s'" % endpoint)
+
+    configure(os.path.abspath(args.workdir))
+    return args.func(args)
+
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -27,6 +27,30 @@ if app.config.get('OUTPUT_PATH', None) is None:
 if not os.path.exists(app.config['OUTPUT_PATH']):
     os.makedirs(app.config['OUTPUT_PATH'])
 
+# Setup BATHY_GRID_PATH
+if app.config.get('BATHY_GRID_PATH', None) is None:
+    app.config['BATHY_GRID_PATH'] = os.path.join(app.config['CACHE_PATH'], "bathy")
+if not os.path.exists(app.config['BATHY_GRID_PATH']):
+    os.makedirs(app.config['BATHY_GRID_PATH'])
+
+# Setup SHORELINE_INDEX_PATH
+if app.config.get('SHORELINE_INDEX_PATH', None) is None:
+    app.config['SHORELINE_INDEX_PATH'] = os.path.join(app.config['CACHE_PATH'], "shorelines")
+if not os.path.exists(app.config['SHORELINE_INDEX_PATH']):
+    os.makedirs(app.config['SHORELINE_INDEX_PATH'])
+
+# Setup PARTICLE_STORE_PATH
+if app.config.get('PARTICLE_STORE_PATH', None) is None:
+    app.config['PARTICLE_STORE_PATH'] = os.path.join(app.config['OUTPUT_PATH'], "particles")
+if not os.path.exists(app.config['PARTICLE_STORE_PATH']):
+    os.makedirs(app.config['PARTICLE_STORE_PATH'])
+
+# Setup HYDRO_CACHE_PATH
+if app.config.get('HYDRO_CACHE_PATH', None) is None:
+    app.config['HYDRO_CACHE_PATH'] = os.path.join(app.config['OUTPUT_PATH'], "hydro_cache")
+if not os.path.exists(app.config['HYDRO_CACHE_PATH']):
+    os.makedirs(app.config['HYDRO_CACHE_PATH'])
+
 # Create logging
 if app.config.get('LOG_FILE') is True:
     import logging
@@ -43,6 +67,7 @@ run_queue        = Queue('runs',       connection=redis_connection, default_time
 particle_queue   = Queue('particles',  connection=redis_connection, default_timeout=86400)   # 1 day timeout
 dataset_queue    = Queue('datasets',   connection=redis_connection, default_timeout=600)     # 10 min timeout
 shoreline_queue  = Queue('shorelines', connection=redis_connection, default_timeout=600)     # 10 min timeout
+analysis_queue   = Queue('analyses',   connection=redis_connection, default_timeout=21600)   # 6 hour timeout
 
 # Create the database connection
 db = MongoKit(app)
@@ -51,6 +76,19 @@ from flask.ext.cache import Cache
 cache = Cache(app)
 
 
+# Bumped whenever datasets or shorelines change.  Cached form choices are keyed
+# on it so every web worker sees the change without a restart.
+CHOICES_VERSION_KEY = "larva_service:choices_version"
+
+
+def choices_version():
+    return redis_connection.get(CHOICES_VERSION_KEY) or "0"
+
+
+def invalidate_choices():
+    redis_connection.incr(CHOICES_VERSION_KEY)
+
+
 # Create datetime jinja2 filter
 def datetimeformat(value, format='%a, %b %d %Y at %I:%M%p'):
     if isinstance(value, datetime.datetime):
@@ -0,0 +1,116 @@
+import json
+import math
+import traceback
+
+import redis
+from rq import Worker
+
+from paegan.logger import logger
+from paegan.transport.controllers import DistributedModelController
+from paegan.transport.controllers.distributed import particle_runner
+
+from larva_service.resources import MemoryCeilingExceeded
+
+# Moving average of the seconds a particle task spends on one particle-step
+STEP_SECONDS_KEY = "larva_service:particle_step_seconds"
+# Weight of the newest observation in the moving average
+SMOOTHING = 0.2
+
+
+def batch_size(particles, steps, workers, step_seconds=None, target_seconds=60., fixed=None):
+    """
+    Particles to run in each particle task.  Batches are kept small enough
+    to give every worker about two tasks, so they balance out, and once the
+    time a particle takes is known, no larger than needed for a task to run
+    'target_seconds' and make the cost of starting one small next to it.
+    """
+    if fixed:
+        return max(1, int(fixed))
+    size = int(math.ceil(particles / (max(1, workers) * 2.)))
+    if step_seconds:
+        size = min(size, int(math.ceil(target_seconds / (step_seconds * max(1, steps)))))
+    return max(1, size)
+
+
+def batches(items, size):
+    return [items[i:i + size] for i in range(0, len(items), size)]
+
+
+def particle_workers(queue):
+    """
+    Number of live workers listening on 'queue'
+    """
+    return len([w for w in Worker.all(connection=queue.connection) if queue.name in w.queue_names()])
+
+
+def step_seconds(connection):
+    value = connection.get(STEP_SECONDS_KEY)
+    return float(value) if value is not None else None
+
+
+def record_step_seconds(connection, seconds):
+    """
+    Fold the seconds per particle-step a particle task took into the moving
+    average used to size the next batches
+    """
+    previous = step_seconds(connection)
+    if previous is not None:
+        seconds = SMOOTHING * seconds + (1 - SMOOTHING) * previous
+    connection.set(STEP_SECONDS_KEY, seconds)
+
+
+def fail_particles(model, parts):
+    rc = redis.from_url(model.redis_url)
+    for p in parts:
+        rc.publish(model.redis_results_channel, json.dumps({"status" : "FAILED", "uid" : p.uid }))
+
+
+def run_batch(parts, model, monitor, runner=particle_runner):
+    """
+    Run a particle task's particles one after the other.  paegan's
+    particle_runner catches the MemoryCeilingExceeded the monitor raises and
+    fails only the particle it was running, and the monitor doesn't raise
+    again, so once the ceiling is exceeded the rest of the batch is failed
+    too and the task fails with it.
+    """
+    for i, part in enumerate(parts):
+        # particle_runner adds a handler publishing to the run's log every time it is called
+        handlers = list(logger.handlers)
+        escaped = False
+        try:
+            runner(part, model)
+        except MemoryCeilingExceeded:
+            escaped = True
+        finally:
+            for h in logger.handlers[len(handlers):]:
+                logger.removeHandler(h)
+
+        if monitor.exceeded is not None:
+            fail_particles(model, parts[i if escaped else i + 1:])
+            raise MemoryCeilingExceeded(monitor.exceeded)
+
+
+class BatchingModelController(DistributedModelController):
+    """
+    Enqueues particles in batches of 'batch_size' per task instead of one
+    task per particle.  Every particle still publishes its own result, so
+    progress is reported per particle.
+    """
+
+    def __init__(self, **kwargs):
+        self.batch_size = kwargs.pop('batch_size', 1)
+        super(BatchingModelController, self).__init__(**kwargs)
+
+    def start_tasks(self, **kwargs):
+        task_queue_call = kwargs.get('task_queue_call')
+        if not task_queue_call:
+            return super(BatchingModelController, self).start_tasks(**kwargs)
+
+        logger.progress((5, 'Running model'))
+        for batch in batches(self.particles, self.batch_size):
+            try:
+                task_queue_call(func=particle_runner, args=(batch, self,))
+            except Exception:
+                logger.exception(traceback.format_exc())
+                fail_particles(self, batch)
+        return True
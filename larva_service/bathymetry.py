@@ -0,0 +1,253 @@
+import os
+import json
+import hashlib
+import tempfile
+
+import numpy as np
+
+from larva_service import app
+
+# Grids already opened by this process, keyed by grid path
+_grids = {}
+
+
+class BathyGrid(object):
+    """
+    A regular lon/lat bathymetry grid stored as a raw .npy array with a small
+    JSON index next to it.  The array is opened read-only as a memory map, so
+    every worker on a node reads the same pages out of the page cache.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(path + ".json", "r") as f:
+            self.index = json.load(f)
+        self.values = np.load(path + ".npy", mmap_mode='r')
+
+        self.x0 = self.index['x0']
+        self.y0 = self.index['y0']
+        self.dx = self.index['dx']
+        self.dy = self.index['dy']
+        self.ny, self.nx = self.values.shape
+
+    def depth(self, lons, lats):
+        """
+        Bilinearly interpolated depth (negative down) for arrays of points.
+        Points outside of the grid are clamped to the nearest edge.
+        """
+        lons = np.atleast_1d(np.asarray(lons, dtype=np.float64))
+        lats = np.atleast_1d(np.asarray(lats, dtype=np.float64))
+
+        fx = np.clip((lons - self.x0) / self.dx, 0, self.nx - 1)
+        fy = np.clip((lats - self.y0) / self.dy, 0, self.ny - 1)
+
+        i0 = np.floor(fx).astype(np.intp)
+        j0 = np.floor(fy).astype(np.intp)
+        i1 = np.minimum(i0 + 1, self.nx - 1)
+        j1 = np.minimum(j0 + 1, self.ny - 1)
+        wx = fx - i0
+        wy = fy - j0
+
+        # Fancy indexing on the memmap only touches the pages we need
+        v00 = self.values[j0, i0]
+        v01 = self.values[j0, i1]
+        v10 = self.values[j1, i0]
+        v11 = self.values[j1, i1]
+
+        return (v00 * (1 - wx) * (1 - wy) +
+                v01 * wx * (1 - wy) +
+                v10 * (1 - wx) * wy +
+                v11 * wx * wy)
+
+
+def grid_path(source):
+    """
+    Where the grid of 'source' is kept: its name, for people looking in the
+    folder, and a hash of its absolute path, mtime and size, so sources with
+    the same file name and new versions of a source get their own grid
+    """
+    source = os.path.abspath(source)
+    stat = os.stat(source)
+    digest = hashlib.sha1("%s\0%r\0%d" % (source, stat.st_mtime, stat.st_size)).hexdigest()[:16]
+    name = os.path.splitext(os.path.basename(source))[0]
+    return os.path.join(app.config['BATHY_GRID_PATH'], "%s-%s" % (name, digest))
+
+
+def remove_old_grids(source, path):
+    """
+    Delete the grids built from earlier versions of 'source'.  Processes
+    that have them mapped keep reading them until they let go.
+    """
+    folder = os.path.dirname(path)
+    for filename in os.listdir(folder):
+        other = os.path.join(folder, os.path.splitext(filename)[0])
+        if not filename.endswith(".json") or other == path:
+            continue
+        try:
+            with open(other + ".json", "r") as f:
+                built_from = json.load(f).get('source')
+        except (IOError, ValueError):
+            continue
+        if built_from == source:
+            for ext in [".npy", ".json"]:
+                try:
+                    os.remove(other + ext)
+                except OSError:
+                    pass
+
+
+def is_stale(source, path):
+    try:
+        with open(path + ".json", "r") as f:
+            index = json.load(f)
+    except (IOError, ValueError):
+        return True
+
+    if not os.path.exists(path + ".npy"):
+        return True
+
+    return index.get('source') != source or index.get('source_mtime') != os.path.getmtime(source)
+
+
+def build_grid(source, path, variable='z'):
+    """
+    Convert a regular 2D bathymetry variable in a NetCDF file into a
+    memory-mappable grid at 'path'.  The array is written in row blocks so
+    global grids never have to fit in memory, and both files are renamed
+    into place so concurrent readers never see a partial grid.
+    """
+    import netCDF4
+
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+
+    nc = netCDF4.Dataset(source)
+    try:
+        var = nc.variables[variable]
+        if len(var.dimensions) != 2:
+            raise ValueError("Bathymetry variable '%s' must be 2D, got %s" % (variable, var.dimensions))
+
+        yname, xname = var.dimensions
+        xs = nc.variables[xname][:].astype(np.float64)
+        ys = nc.variables[yname][:].astype(np.float64)
+
+        dx = (xs[-1] - xs[0]) / (len(xs) - 1)
+        dy = (ys[-1] - ys[0]) / (len(ys) - 1)
+        if not np.allclose(np.diff(xs), dx, rtol=1e-3) or not np.allclose(np.diff(ys), dy, rtol=1e-3):
+            raise ValueError("Bathymetry file %s is not on a regular grid" % source)
+
+        f, tmp_array = tempfile.mkstemp(dir=folder, suffix=".npy")
+        os.close(f)
+        out = np.lib.format.open_memmap(tmp_array, mode='w+', dtype=np.float32, shape=var.shape)
+
+        # Roughly 64MB of float32 per block
+        rows = max(1, (16 * 1024 * 1024) // len(xs))
+        for start in range(0, var.shape[0], rows):
+            block = np.ma.asarray(var[start:start + rows, :]).astype(np.float32)
+            out[start:start + rows, :] = np.ma.filled(block, np.nan)
+        out.flush()
+        del out
+
+        index = {
+            'source'       : source,
+            'source_mtime' : os.path.getmtime(source),
+            'variable'     : variable,
+            'x0'           : float(xs[0]),
+            'y0'           : float(ys[0]),
+            'dx'           : float(dx),
+            'dy'           : float(dy),
+            'shape'        : list(var.shape)
+        }
+    finally:
+        nc.close()
+
+    f, tmp_index = tempfile.mkstemp(dir=folder, suffix=".json")
+    with os.fdopen(f, "w") as idx:
+        json.dump(index, idx)
+
+    # The index is moved last, readers treat it as the "grid is ready" marker
+    os.chmod(tmp_array, 0644)
+    os.chmod(tmp_index, 0644)
+    os.rename(tmp_array, path + ".npy")
+    os.rename(tmp_index, path + ".json")
+
+    return path
+
+
+def shared_grid(source=None):
+    """
+    The process-wide BathyGrid for 'source' (defaults to BATHY_PATH),
+    converting the NetCDF file the first time it is needed.
+    """
+    if source is None:
+        source = app.config.get('BATHY_PATH')
+    source = os.path.abspath(source)
+
+    path = grid_path(source)
+    grid = _grids.get(path)
+    if grid is None:
+        if is_stale(source, path):
+            app.logger.info("Building shared bathymetry grid %s from %s" % (path, source))
+            build_grid(source, path, variable=app.config.get('BATHY_VARIABLE'))
+            remove_old_grids(source, path)
+        grid = BathyGrid(path)
+        _grids[path] = grid
+
+    return grid
+
+
+class MappedBathymetry(object):
+    """
+    Drop-in replacement for paegan.transport.bathymetry.Bathymetry that reads
+    from the shared memory-mapped grid instead of opening the NetCDF file in
+    every forcer.
+    """
+
+    def __init__(self, **kwargs):
+        self._type = kwargs.pop("type", "hover")
+        self._grid = shared_grid(kwargs.pop("file", None))
+
+    def close(self):
+        pass
+
+    def get_depth(self, location):
+        return float(self._grid.depth(location.longitude, location.latitude)[0])
+
+    def intersect(self, **kwargs):
+        end_point = kwargs.pop('end_point')
+        depth = self.get_depth(location=end_point)
+        # Bathymetry and a particle's depth are both negative down
+        return bool(depth < 0 and depth > end_point.depth)
+
+    def react(self, **kwargs):
+        from paegan.location4d import Location4D
+
+        react_type = kwargs.get("type", self._type)
+        if react_type == 'hover':
+            end_point = kwargs.pop('end_point')
+            depth = self.get_depth(location=end_point)
+            return Location4D(latitude=end_point.latitude, longitude=end_point.longitude, depth=(depth + 1.))
+        elif react_type == 'stick':
+            pass
+        elif react_type == 'reverse':
+            start_point = kwargs.pop('start_point')
+            return Location4D(latitude=start_point.latitude, longitude=start_point.longitude, depth=start_point.depth)
+        else:
+            raise ValueError("Bathymetry interaction type not supported")
+
+
+def use_shared_bathymetry():
+    """
+    Swap paegan's per-forcer Bathymetry for MappedBathymetry in this process.
+    Falls back to paegan's own reader if the grid can not be built.
+    """
+    try:
+        shared_grid()
+    except Exception:
+        app.logger.exception("Could not load the shared bathymetry grid, particles will read %s directly" % app.config.get('BATHY_PATH'))
+        return False
+
+    import paegan.transport.forcers as forcers
+    forcers.Bathymetry = MappedBathymetry
+    return True
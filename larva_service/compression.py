@@ -0,0 +1,118 @@
+import os
+import zlib
+import gzip
+from StringIO import StringIO
+
+from flask import request
+
+try:
+    import brotli
+except ImportError:
+    brotli = None
+
+# Output files given a gzip sidecar when exported, and what to serve them as
+PRECOMPRESSED = {
+    '.json'    : 'application/json',
+    '.geojson' : 'application/json',
+}
+
+# Responses compressed on the way out
+COMPRESSIBLE = ['application/json', 'text/html', 'text/plain', 'text/csv']
+
+# Smaller responses and files aren't worth compressing
+MIN_BYTES = 1024
+
+
+def gzip_bytes(data, level=6):
+    buf = StringIO()
+    # A fixed mtime, so the same data always compresses to the same bytes
+    f = gzip.GzipFile(fileobj=buf, mode="wb", compresslevel=level, mtime=0)
+    try:
+        f.write(data)
+    finally:
+        f.close()
+    return buf.getvalue()
+
+
+def sidecar(path):
+    """
+    The precompressed copy of an output file, or None
+    """
+    compressed = path + ".gz"
+    return compressed if os.path.exists(compressed) else None
+
+
+def is_sidecar(path):
+    return path.endswith(".gz") and os.path.exists(path[:-3])
+
+
+def precompress(folder, level=9):
+    """
+    Write a gzip sidecar next to every JSON and GeoJSON file in 'folder',
+    like "trackline.geojson.gz", for the upload to S3 and for servers
+    serving NON_S3_OUTPUT_URL (nginx's gzip_static) to send instead.
+    Returns the sidecars written.
+    """
+    written = []
+    for filename in sorted(os.listdir(folder)):
+        path = os.path.join(folder, filename)
+        if os.path.splitext(filename)[1] not in PRECOMPRESSED or not os.path.isfile(path) or os.path.getsize(path) < MIN_BYTES:
+            continue
+        tmp = path + ".gz.tmp"
+        with open(path, "rb") as src:
+            f = gzip.GzipFile(tmp, mode="wb", compresslevel=level, mtime=0)
+            try:
+                for block in iter(lambda: src.read(1024 * 1024), ""):
+                    f.write(block)
+            finally:
+                f.close()
+        os.rename(tmp, path + ".gz")
+        written.append(path + ".gz")
+    return written
+
+
+def accepts(encoding):
+    return request.accept_encodings[encoding] > 0
+
+
+def _gzip_stream(chunks, level=6):
+    compressor = zlib.compressobj(level, zlib.DEFLATED, 16 + zlib.MAX_WBITS)
+    for chunk in chunks:
+        if isinstance(chunk, unicode):
+            chunk = chunk.encode('utf-8')
+        data = compressor.compress(chunk)
+        if data:
+            yield data
+    yield compressor.flush()
+
+
+def compress_response(response):
+    """
+    Compress JSON, HTML and text responses for clients that accept it, with
+    brotli when it is installed and asked for, gzip otherwise.  Streamed
+    responses are gzipped as they are streamed.
+    """
+    if response.status_code != 200 or response.direct_passthrough or 'Content-Encoding' in response.headers:
+        return response
+    if response.mimetype not in COMPRESSIBLE:
+        return response
+
+    response.vary.add('Accept-Encoding')
+
+    if response.is_streamed:
+        if accepts('gzip'):
+            response.response = _gzip_stream(response.response)
+            response.headers['Content-Encoding'] = 'gzip'
+            response.headers.pop('Content-Length', None)
+        return response
+
+    data = response.get_data()
+    if len(data) < MIN_BYTES:
+        return response
+    if brotli is not None and accepts('br'):
+        response.set_data(brotli.compress(data, quality=5))
+        response.headers['Content-Encoding'] = 'br'
+    elif accepts('gzip'):
+        response.set_data(gzip_bytes(data))
+        response.headers['Content-Encoding'] = 'gzip'
+    return response
@@ -18,6 +18,62 @@ CACHE_PATH = os.environ.get('CACHE_PATH', "undefined")
 OUTPUT_PATH = os.environ.get('OUTPUT_PATH', "undefined")
 SHORE_PATH = os.environ.get('SHORE_PATH', "undefined")
 
+# Memory-mapped copy of BATHY_PATH shared by all workers on a node
+BATHY_GRID_PATH = os.environ.get('BATHY_GRID_PATH', None)
+BATHY_VARIABLE = os.environ.get('BATHY_VARIABLE', "z")
+
+# Spatial indexes built when shorelines are imported
+SHORELINE_INDEX_PATH = os.environ.get('SHORELINE_INDEX_PATH', None)
+
+# Columnar particle output kept locally for the /runs/<id>/particles endpoint
+PARTICLE_STORE_PATH = os.environ.get('PARTICLE_STORE_PATH', None)
+
+# Forcing data kept by DAP runs, compressed and stored once per content when not on S3
+HYDRO_CACHE_PATH = os.environ.get('HYDRO_CACHE_PATH', None)
+
+# Density grids cached per particle store, the least recently used are deleted past this
+DENSITY_CACHE_ENTRIES = int(os.environ.get('DENSITY_CACHE_ENTRIES', 50)) or None
+
+# Disk quotas for the run output and caches in GB, and the order finished runs are
+# evicted in to stay under them: "lru" (least recently viewed) or "age".  Runs older
+# than RETENTION_DAYS are evicted whatever the quotas.
+OUTPUT_QUOTA_GB = float(os.environ.get('OUTPUT_QUOTA_GB', 0)) or None
+CACHE_QUOTA_GB = float(os.environ.get('CACHE_QUOTA_GB', 0)) or None
+RETENTION_POLICY = os.environ.get('RETENTION_POLICY', 'lru')
+RETENTION_DAYS = int(os.environ.get('RETENTION_DAYS', 30)) or None
+
+# Fail runs and particle tasks that use more memory than this, in MB
+MEMORY_CEILING_MB = int(os.environ.get('MEMORY_CEILING_MB', 0)) or None
+PARTICLE_MEMORY_CEILING_MB = int(os.environ.get('PARTICLE_MEMORY_CEILING_MB', 0)) or None
+
+# Seconds a distributed run waits for its particle tasks to report their usage
+# (and profiles) once their results are in
+PARTICLE_REPORT_TIMEOUT = int(os.environ.get('PARTICLE_REPORT_TIMEOUT', 30))
+
+# Particles per distributed particle task: sized so tasks run about PARTICLE_BATCH_SECONDS
+# while every particle worker gets some, unless fixed with PARTICLE_BATCH_SIZE
+PARTICLE_BATCH_SIZE = int(os.environ.get('PARTICLE_BATCH_SIZE', 0)) or None
+PARTICLE_BATCH_SECONDS = float(os.environ.get('PARTICLE_BATCH_SECONDS', 60))
+
+# Seconds a run or particle task routed to a host with its files warm waits for a
+# worker there before any worker can take it
+LOCALITY_FALLBACK_SECONDS = int(os.environ.get('LOCALITY_FALLBACK_SECONDS', 30))
+
+# Logging of runs: each kind of repetitive message is limited to LOG_RATE_BURST
+# records every LOG_RATE_INTERVAL seconds, the run page shows the last LOG_TAIL_LINES
+LOG_RATE_BURST = int(os.environ.get('LOG_RATE_BURST', 20))
+LOG_RATE_INTERVAL = float(os.environ.get('LOG_RATE_INTERVAL', 10))
+LOG_TAIL_LINES = int(os.environ.get('LOG_TAIL_LINES', 200))
+
+# Responses of the read endpoints are cached in Redis, shared by the web workers, for
+# RESPONSE_CACHE_SECONDS (0 to turn the cache off) or until what they show changes.
+# Ones that change on their own, like the status of a running run, for at most
+# RESPONSE_CACHE_LIVE_SECONDS.  Clients may keep the responses of finished runs
+# FINAL_MAX_AGE seconds without revalidating.
+RESPONSE_CACHE_SECONDS = int(os.environ.get('RESPONSE_CACHE_SECONDS', 86400))
+RESPONSE_CACHE_LIVE_SECONDS = int(os.environ.get('RESPONSE_CACHE_LIVE_SECONDS', 5))
+FINAL_MAX_AGE = int(os.environ.get('FINAL_MAX_AGE', 86400))
+
 # Database
 MONGO_URI = os.environ.get('MONGO_URI')
 url = urlparse.urlparse(MONGO_URI)
@@ -38,6 +94,12 @@ REDIS_DB = url.path[1:]
 
 # Redis Results
 RESULTS_REDIS_URI = os.environ.get('RESULTS_REDIS_URI')
+# How distributed runs pass particle results and logs: "streams" (Redis >= 5) or "pubsub".
+# Particle tasks wait while a run's stream holds more than STREAM_MAX_BACKLOG unread
+# messages, for at most STREAM_BACKPRESSURE_TIMEOUT seconds
+RESULTS_TRANSPORT = os.environ.get('RESULTS_TRANSPORT', 'streams')
+STREAM_MAX_BACKLOG = int(os.environ.get('STREAM_MAX_BACKLOG', 10000))
+STREAM_BACKPRESSURE_TIMEOUT = float(os.environ.get('STREAM_BACKPRESSURE_TIMEOUT', 300))
 
 BEHAVIOR_ROOT = 'http://behavior.larvamap.axiomdatascience.com'
 
@@ -0,0 +1,161 @@
+import os
+import json
+import math
+import zlib
+import struct
+import hashlib
+
+import numpy as np
+
+from larva_service.particles import ParticleStore
+
+KINDS = ['density', 'presence']
+
+# Refuse grids bigger than this many cells
+MAX_CELLS = 4000000
+
+
+def grid_bounds(lons, lats, cell_size, bbox=None):
+    """
+    Grid extent snapped outward to whole cells
+    """
+    if bbox is None:
+        if len(lons) == 0:
+            raise ValueError("No particle positions to grid")
+        bbox = (lons.min(), lats.min(), lons.max(), lats.max())
+
+    minx = math.floor(bbox[0] / cell_size) * cell_size
+    miny = math.floor(bbox[1] / cell_size) * cell_size
+    maxx = max(math.ceil(bbox[2] / cell_size) * cell_size, minx + cell_size)
+    maxy = max(math.ceil(bbox[3] / cell_size) * cell_size, miny + cell_size)
+    return minx, miny, maxx, maxy
+
+
+def histogram(lons, lats, particle_ids, bounds, cell_size, kind='density'):
+    """
+    Grid particle positions into (y, x) cells of 'cell_size' degrees.
+
+    * density: fraction of all particle positions that fall in each cell
+    * presence: fraction of particles that were ever in each cell
+    """
+    if kind not in KINDS:
+        raise ValueError("kind must be one of %s" % ", ".join(KINDS))
+
+    minx, miny, maxx, maxy = bounds
+    nx = int(round((maxx - minx) / cell_size))
+    ny = int(round((maxy - miny) / cell_size))
+    if nx * ny > MAX_CELLS:
+        raise ValueError("A %dx%d grid is too large, use a bigger cell size" % (nx, ny))
+
+    ix = np.floor((lons - minx) / cell_size).astype(np.int64)
+    iy = np.floor((lats - miny) / cell_size).astype(np.int64)
+    # Points exactly on the max edge belong to the last cell
+    ix[(ix == nx) & np.isclose(lons, maxx)] = nx - 1
+    iy[(iy == ny) & np.isclose(lats, maxy)] = ny - 1
+    inside = (ix >= 0) & (ix < nx) & (iy >= 0) & (iy < ny)
+    cells = iy[inside] * nx + ix[inside]
+
+    if kind == 'density':
+        counts = np.bincount(cells, minlength=nx * ny).astype(np.float64)
+        total = float(len(lons)) or 1.
+    else:
+        # Count each particle at most once per cell
+        pairs = np.unique(particle_ids[inside].astype(np.int64) * (nx * ny) + cells)
+        counts = np.bincount(pairs % (nx * ny), minlength=nx * ny).astype(np.float64)
+        total = float(len(np.unique(particle_ids))) or 1.
+
+    return (counts / total).reshape(ny, nx)
+
+
+def compute_density(store_path, cell_size, time=None, bbox=None, kind='density'):
+    times, particles, data = ParticleStore(store_path).query(time=time, bbox=bbox, fields=['longitude', 'latitude'])
+    lons = data['longitude']
+    lats = data['latitude']
+    pids = np.repeat(particles[np.newaxis, :], lons.shape[0], axis=0)
+
+    valid = ~(np.isnan(lons) | np.isnan(lats))
+    lons, lats, pids = lons[valid], lats[valid], pids[valid]
+
+    bounds = grid_bounds(lons, lats, cell_size, bbox=bbox)
+    return bounds, histogram(lons, lats, pids, bounds, cell_size, kind=kind)
+
+
+def prune(folder, max_entries):
+    """
+    Delete all but the 'max_entries' most recently used grids in 'folder'
+    """
+    entries = []
+    for filename in os.listdir(folder):
+        path = os.path.join(folder, filename)
+        if filename.endswith(".npz"):
+            try:
+                entries.append((os.path.getmtime(path), path))
+            except OSError:
+                pass
+    entries.sort(reverse=True)
+    for _, path in entries[max_entries:]:
+        try:
+            os.remove(path)
+        except OSError:
+            pass
+
+
+def cached_density(store_path, cell_size, time=None, bbox=None, kind='density', max_entries=None):
+    """
+    compute_density, cached on disk next to the particle store.  Finished
+    runs never change, so entries are never invalidated, only pruned to the
+    'max_entries' most recently used and removed with the store.
+    """
+    params = json.dumps([cell_size, time, bbox and list(bbox), kind])
+    folder = store_path + ".density"
+    path = os.path.join(folder, hashlib.sha1(params).hexdigest() + ".npz")
+
+    if os.path.exists(path):
+        cached = np.load(path)
+        bounds, values = tuple(cached['bounds'].tolist()), cached['values']
+        try:
+            # Used, so pruned last
+            os.utime(path, None)
+        except OSError:
+            pass
+        return bounds, values
+
+    bounds, values = compute_density(store_path, cell_size, time=time, bbox=bbox, kind=kind)
+
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    tmp = path + ".%d.tmp" % os.getpid()
+    with open(tmp, "wb") as f:
+        np.savez_compressed(f, bounds=np.array(bounds), values=values.astype(np.float32))
+    os.rename(tmp, path)
+
+    if max_entries:
+        prune(folder, max_entries)
+
+    return bounds, values
+
+
+def to_png(values):
+    """
+    Render a (y, x) grid as an RGBA PNG, north up.  Empty cells are
+    transparent, the rest shade from yellow to red with increasing value.
+    """
+    height, width = values.shape
+    peak = values.max() or 1.
+    scaled = values / peak
+
+    rgba = np.zeros((height, width, 4), dtype=np.uint8)
+    rgba[..., 0] = 255
+    rgba[..., 1] = (220 * (1 - scaled)).astype(np.uint8)
+    rgba[..., 3] = np.where(values > 0, 96 + 159 * scaled, 0).astype(np.uint8)
+
+    # Row 0 of the grid is the southern edge, PNG rows start at the top
+    raw = b"".join(b"\x00" + rgba[row].tostring() for row in range(height - 1, -1, -1))
+
+    def chunk(tag, data):
+        return struct.pack(">I", len(data)) + tag + data + struct.pack(">I", zlib.crc32(tag + data) & 0xffffffff)
+
+    return (b"\x89PNG\r\n\x1a\n" +
+            chunk(b"IHDR", struct.pack(">IIBBBBB", width, height, 8, 6, 0, 0, 0)) +
+            chunk(b"IDAT", zlib.compress(raw, 6)) +
+            chunk(b"IEND", b""))
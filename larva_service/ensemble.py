@@ -0,0 +1,143 @@
+import numpy as np
+
+from larva_service.particles import ParticleStore
+
+EARTH_RADIUS_KM = 6371.0088
+
+PERCENTILES = [5, 25, 50, 75, 95]
+
+
+def haversine(lon1, lat1, lon2, lat2):
+    """
+    Great circle distance in km between arrays of points
+    """
+    lon1, lat1, lon2, lat2 = [np.radians(a) for a in (lon1, lat1, lon2, lat2)]
+    a = np.sin((lat2 - lat1) / 2.) ** 2 + np.cos(lat1) * np.cos(lat2) * np.sin((lon2 - lon1) / 2.) ** 2
+    return 2 * EARTH_RADIUS_KM * np.arcsin(np.sqrt(np.minimum(a, 1.)))
+
+
+class Land(object):
+    """
+    Point-on-land test against shoreline polygons, buffered by 'buffer' degrees
+    """
+
+    def __init__(self, polygons, buffer=0.):
+        from shapely.ops import cascaded_union
+        from shapely.prepared import prep
+
+        land = cascaded_union(polygons)
+        if buffer:
+            land = land.buffer(buffer)
+        self.bounds = land.bounds
+        self._land = prep(land)
+
+    def contains(self, lons, lats):
+        from shapely import vectorized
+
+        minx, miny, maxx, maxy = self.bounds
+        result = np.zeros(lons.shape, dtype=bool)
+        # Only points inside the land's envelope need the exact test, done for all of them at once
+        candidates = (lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy)
+        if candidates.any():
+            result[candidates] = vectorized.contains(self._land, lons[candidates], lats[candidates])
+        return result
+
+
+def particle_bounds(store_path, chunk_size=256):
+    """
+    (minx, miny, maxx, maxy) of every particle position in a particle store,
+    read in chunks of 'chunk_size' timesteps, or None if it has none
+    """
+    bounds = None
+    for times, particles, data in ParticleStore(store_path).chunks(['longitude', 'latitude'], size=chunk_size):
+        lons, lats = data['longitude'], data['latitude']
+        valid = ~(np.isnan(lons) | np.isnan(lats))
+        if not valid.any():
+            continue
+        box = (lons[valid].min(), lats[valid].min(), lons[valid].max(), lats[valid].max())
+        bounds = box if bounds is None else (min(bounds[0], box[0]), min(bounds[1], box[1]), max(bounds[2], box[2]), max(bounds[3], box[3]))
+    return bounds
+
+
+def analyze_run(store_path, land=None, chunk_size=256):
+    """
+    Per-particle statistics for one run, read from its particle store in
+    chunks of 'chunk_size' timesteps.
+
+    Returns a dict of arrays, one value per particle:
+    * distance: km travelled along the track
+    * beached_hours: hours from release until first on land, NaN if never
+    * settled: whether the particle ever settled
+    """
+    store = ParticleStore(store_path)
+
+    distance = None
+    beached_hours = None
+    settled = None
+    last_lon = last_lat = None
+    release = None
+
+    for times, particles, data in store.chunks(['longitude', 'latitude', 'settled'], size=chunk_size):
+        lons = data['longitude'].astype(np.float64)
+        lats = data['latitude'].astype(np.float64)
+
+        if distance is None:
+            distance = np.zeros(len(particles))
+            beached_hours = np.empty(len(particles))
+            beached_hours.fill(np.nan)
+            settled = np.zeros(len(particles), dtype=bool)
+            release = times[0]
+
+        # Prepend the last row of the previous chunk so steps across chunk boundaries count
+        if last_lon is not None:
+            lons = np.vstack((last_lon, lons))
+            lats = np.vstack((last_lat, lats))
+
+        steps = haversine(lons[:-1], lats[:-1], lons[1:], lats[1:])
+        distance += np.nansum(steps, axis=0)
+
+        if last_lon is not None:
+            lons, lats = lons[1:], lats[1:]
+        last_lon, last_lat = lons[-1:], lats[-1:]
+
+        settled |= np.nansum(data['settled'], axis=0) > 0
+
+        if land is not None:
+            valid = ~(np.isnan(lons) | np.isnan(lats))
+            on_land = np.zeros(lons.shape, dtype=bool)
+            on_land[valid] = land.contains(lons[valid], lats[valid])
+
+            hit = on_land.any(axis=0) & np.isnan(beached_hours)
+            first = on_land.argmax(axis=0)
+            beached_hours[hit] = (times[first[hit]] - release) / 3600.
+
+    if distance is None:
+        return { 'distance' : np.array([]), 'beached_hours' : np.array([]), 'settled' : np.array([], dtype=bool) }
+
+    return { 'distance' : distance, 'beached_hours' : beached_hours, 'settled' : settled }
+
+
+def describe(values):
+    values = values[~np.isnan(values)]
+    if len(values) == 0:
+        return None
+    stats = { 'mean' : float(values.mean()), 'min' : float(values.min()), 'max' : float(values.max()) }
+    for p, v in zip(PERCENTILES, np.percentile(values, PERCENTILES)):
+        stats['p%d' % p] = float(v)
+    return stats
+
+
+def summarize(per_particle, beaching=True):
+    """
+    Ensemble statistics from concatenated per-particle arrays
+    """
+    count = len(per_particle['distance'])
+    beached = ~np.isnan(per_particle['beached_hours'])
+
+    return {
+        'particles'           : count,
+        'distance_km'         : describe(per_particle['distance']),
+        'settled_probability' : float(per_particle['settled'].mean()) if count else None,
+        'arrival_probability' : float(beached.mean()) if count and beaching else None,
+        'hours_to_beaching'   : describe(per_particle['beached_hours']) if beaching else None,
+    }
@@ -0,0 +1,47 @@
+import time
+import multiprocessing
+from collections import OrderedDict
+
+# Output formats a run can ask for, mapped to their paegan.transport.export class
+EXPORTERS = OrderedDict([
+    ('trackline',             'H5Trackline'),
+    ('trackline_with_points', 'H5TracklineWithPoints'),
+    ('particle_tracklines',   'H5ParticleTracklines'),
+    ('particle_multipoint',   'H5ParticleMultiPoint'),
+    ('shapefile',             'H5GDALShapefile'),
+])
+
+
+def export_one(name, output_path, h5_file):
+    """
+    Run a single exporter against the results file.  Module level so it can be
+    sent to a process pool.
+    """
+    import paegan.transport.export as ex
+
+    started = time.time()
+    try:
+        getattr(ex, EXPORTERS[name]).export(output_path, h5_file)
+    except Exception as e:
+        return name, { 'status' : u'failed', 'seconds' : round(time.time() - started, 3), 'message' : unicode(e) }
+    else:
+        return name, { 'status' : u'success', 'seconds' : round(time.time() - started, 3) }
+
+
+def export_results(names, output_path, h5_file, processes=None):
+    """
+    Run the requested exporters concurrently, each in its own process reading
+    the shared results file.  Returns a dict of per-export status and duration.
+    """
+    names = [n for n in names if n in EXPORTERS]
+    if not names:
+        return {}
+
+    processes = processes or min(len(names), multiprocessing.cpu_count())
+    pool = multiprocessing.Pool(processes)
+    try:
+        pending = [pool.apply_async(export_one, (name, output_path, h5_file)) for name in names]
+        return dict(p.get() for p in pending)
+    finally:
+        pool.close()
+        pool.join()
@@ -0,0 +1,152 @@
+import os
+import hashlib
+import tempfile
+
+import numpy as np
+
+# Caches are stored once per content hash, under this key on S3 and this
+# folder in HYDRO_CACHE_PATH otherwise
+S3_PREFIX = "hydro_cache"
+
+# Roughly 64MB of values are copied or hashed at a time
+BLOCK_VALUES = 16 * 1024 * 1024
+
+
+def _blocks(var):
+    """
+    Slices along the first dimension of 'var' small enough to hold in memory
+    """
+    if not var.shape or var.shape[0] == 0:
+        yield Ellipsis
+        return
+    rows = max(1, BLOCK_VALUES // max(1, int(np.prod(var.shape[1:]))))
+    for start in range(0, var.shape[0], rows):
+        yield slice(start, start + rows)
+
+
+def _attributes(obj):
+    return sorted((a, obj.getncattr(a)) for a in obj.ncattrs())
+
+
+def content_hash(path):
+    """
+    SHA-1 of the dimensions, attributes and values of a NetCDF file, which,
+    unlike the file's bytes, don't depend on how or when it was written
+    """
+    import netCDF4
+
+    digest = hashlib.sha1()
+    nc = netCDF4.Dataset(path)
+    try:
+        nc.set_auto_maskandscale(False)
+        for name, dim in sorted(nc.dimensions.items()):
+            digest.update(repr((name, len(dim))))
+        digest.update(repr(_attributes(nc)))
+        for name, var in sorted(nc.variables.items()):
+            digest.update(repr((name, str(var.dtype), var.dimensions, _attributes(var))))
+            for block in _blocks(var):
+                digest.update(np.ascontiguousarray(var[block]).tostring())
+    finally:
+        nc.close()
+    return digest.hexdigest()
+
+
+def compress(source, path, complevel=4):
+    """
+    Copy a NetCDF file to a NetCDF4 file at 'path' with every variable zlib
+    compressed and shuffled.  Written to a temporary file and renamed into
+    place, so a concurrent run with the same cache never sees a partial one.
+    """
+    import netCDF4
+
+    folder = os.path.dirname(path)
+    if not os.path.exists(folder):
+        os.makedirs(folder)
+    f, tmp = tempfile.mkstemp(dir=folder, suffix=".nc")
+    os.close(f)
+
+    src = netCDF4.Dataset(source)
+    dst = netCDF4.Dataset(tmp, "w", format="NETCDF4")
+    try:
+        src.set_auto_maskandscale(False)
+        dst.setncatts(dict(_attributes(src)))
+        for name, dim in src.dimensions.items():
+            dst.createDimension(name, None if dim.isunlimited() else len(dim))
+        for name, var in src.variables.items():
+            attributes = dict(_attributes(var))
+            fill_value = attributes.pop('_FillValue', None)
+            out = dst.createVariable(name, var.dtype, var.dimensions, zlib=True, shuffle=True, complevel=complevel, fill_value=fill_value)
+            out.set_auto_maskandscale(False)
+            out.setncatts(attributes)
+            for block in _blocks(var):
+                out[block] = var[block]
+    except Exception:
+        dst.close()
+        os.remove(tmp)
+        raise
+    finally:
+        src.close()
+    dst.close()
+    os.chmod(tmp, 0644)
+    os.rename(tmp, path)
+    return path
+
+
+def _bucket(config):
+    from boto.s3.connection import S3Connection
+    return S3Connection().get_bucket(config['S3_BUCKET'])
+
+
+def keep(cache_file, config):
+    """
+    Store a run's forcing cache compressed, once per content.  Returns the
+    content hash the run references it by and the path or URL to list in
+    its output.
+    """
+    digest = content_hash(cache_file)
+    filename = digest + ".nc"
+
+    if config['USE_S3'] is True:
+        from boto.s3.key import Key
+
+        bucket = _bucket(config)
+        key_name = "%s/%s" % (S3_PREFIX, filename)
+        if bucket.get_key(key_name) is None:
+            compressed = compress(cache_file, os.path.join(os.path.dirname(cache_file), "compressed", filename))
+            try:
+                k = Key(bucket)
+                k.key = key_name
+                k.set_contents_from_filename(compressed)
+                k.set_acl('public-read')
+            finally:
+                os.remove(compressed)
+        return digest, "http://%s.s3.amazonaws.com/%s" % (config['S3_BUCKET'], key_name)
+
+    path = local_path(digest, config['HYDRO_CACHE_PATH'])
+    if not os.path.exists(path):
+        compress(cache_file, path)
+    return digest, path
+
+
+def referenced(digest, db):
+    return db.Run.find({ 'hydro_cache' : digest }).count() > 0
+
+
+def local_path(digest, folder):
+    return os.path.join(folder, digest + ".nc")
+
+
+def release(digest, config, db):
+    """
+    Delete the stored cache once no run references it anymore
+    """
+    if not digest or referenced(digest, db):
+        return False
+
+    if config['USE_S3'] is True:
+        _bucket(config).delete_key("%s/%s.nc" % (S3_PREFIX, digest))
+    else:
+        path = local_path(digest, config['HYDRO_CACHE_PATH'])
+        if os.path.exists(path):
+            os.remove(path)
+    return True
@@ -0,0 +1,180 @@
+import time
+import socket
+
+from rq import Worker, Queue
+from rq.job import Job
+from rq.worker import WorkerStatus
+from rq.exceptions import DequeueTimeout, NoSuchJobError
+from rq.compat import as_text
+
+# Sorted set per host of the hydro, shoreline and bathymetry paths its workers
+# used recently, scored by when
+WARM_KEY = "larva_service:warm:%s"
+# Sorted set per queue of "<host queue> <job id>" routed to a host, scored by
+# when they fall back to the shared queue
+ROUTED_KEY = "larva_service:routed:%s"
+
+# Seconds a resource is assumed to stay in a host's page cache after use
+WARM_SECONDS = 3600
+
+
+def host_queue_name(name, host):
+    return "%s@%s" % (name, host)
+
+
+def advertise(connection, resources, host=None):
+    """
+    Note that the workers on this host have 'resources' warm
+    """
+    resources = [r for r in resources if r]
+    if not resources:
+        return
+    key = WARM_KEY % (host or socket.gethostname())
+    now = time.time()
+    pipe = connection.pipeline(transaction=False)
+    for r in resources:
+        # ZADD takes its arguments in a different order on Redis and StrictRedis clients
+        pipe.execute_command('ZADD', key, now, r)
+    pipe.zremrangebyscore(key, 0, now - WARM_SECONDS)
+    pipe.expire(key, WARM_SECONDS)
+    pipe.execute()
+
+
+def warm_hosts(queue, resources):
+    """
+    Hosts with workers listening on their own queue for 'queue', as
+    { host : [number of workers, resources warm on it] }
+    """
+    resources = [r for r in resources if r]
+    prefix = queue.name + "@"
+    hosts = {}
+    for w in Worker.all(connection=queue.connection):
+        for name in w.queue_names():
+            if name.startswith(prefix):
+                host = name[len(prefix):]
+                hosts.setdefault(host, [0, 0])[0] += 1
+
+    if not hosts or not resources:
+        return {}
+
+    since = time.time() - WARM_SECONDS
+    pipe = queue.connection.pipeline(transaction=False)
+    for host in hosts:
+        for r in resources:
+            pipe.zscore(WARM_KEY % host, r)
+    scores = iter(pipe.execute())
+    for host in hosts:
+        hosts[host][1] = sum(1 for r in resources if (next(scores) or 0) > since)
+    return dict((h, v) for h, v in hosts.items() if v[1] > 0)
+
+
+class Router(object):
+    """
+    Picks the queue for each job of a group that needs the same resources.
+    Hosts are filled warmest first, two jobs per worker so their workers
+    have the next one ready, and the rest go to the shared queue.  Routed
+    jobs nobody on their host started within 'fallback' seconds are moved to
+    the shared queue by the next LocalityWorker to look.
+    """
+
+    def __init__(self, queue, resources, fallback=30):
+        self.queue = queue
+        self.fallback = fallback
+        hosts = warm_hosts(queue, resources)
+        self._slots = []
+        for host in sorted(hosts, key=lambda h: hosts[h][1], reverse=True):
+            self._slots.extend([host] * hosts[host][0] * 2)
+
+    def enqueue_call(self, *args, **kwargs):
+        if not self._slots:
+            return self.queue.enqueue_call(*args, **kwargs)
+
+        host_queue = Queue(host_queue_name(self.queue.name, self._slots.pop(0)), connection=self.queue.connection, default_timeout=self.queue._default_timeout)
+        job = host_queue.enqueue_call(*args, **kwargs)
+        self.queue.connection.execute_command('ZADD', ROUTED_KEY % self.queue.name, time.time() + self.fallback, "%s %s" % (host_queue.name, job.id))
+        return job
+
+
+def enqueue(queue, resources, fallback=30, **kwargs):
+    """
+    Enqueue a single job on a host with 'resources' warm, if there is one
+    """
+    return Router(queue, resources, fallback=fallback).enqueue_call(**kwargs)
+
+
+def release_overdue(queue):
+    """
+    Move jobs routed to a host's queue that are still waiting past their
+    fallback time to 'queue'
+    """
+    connection = queue.connection
+    key = ROUTED_KEY % queue.name
+    released = 0
+    for member in connection.zrangebyscore(key, 0, time.time()):
+        # Whoever removes the entry moves the job
+        if not connection.zrem(key, member):
+            continue
+        host_queue, job_id = as_text(member).split(" ", 1)
+        if not Queue(host_queue, connection=connection).remove(job_id):
+            # Already started
+            continue
+        try:
+            job = Job.fetch(job_id, connection=connection)
+        except NoSuchJobError:
+            continue
+        queue.enqueue_job(job)
+        released += 1
+    return released
+
+
+class LocalityWorker(Worker):
+    """
+    Listens on a queue of its host's own in front of each of its queues, and
+    moves jobs other hosts did not start in time to the shared queues.
+
+        rqworker -c larva_service.defaults -w larva_service.locality.LocalityWorker particles
+    """
+
+    release_interval = 5
+
+    def __init__(self, queues, *args, **kwargs):
+        super(LocalityWorker, self).__init__(queues, *args, **kwargs)
+        # Workers looked up with find_by_key start without queues and get the ones they registered
+        self.shared_queues = [q for q in self.queues if "@" not in q.name]
+        if self.shared_queues and len(self.shared_queues) == len(self.queues):
+            host = socket.gethostname()
+            own = [self.queue_class(host_queue_name(q.name, host), connection=self.connection) for q in self.shared_queues]
+            self.queues = own + self.shared_queues
+
+    def release_overdue(self):
+        for q in self.shared_queues:
+            try:
+                release_overdue(q)
+            except Exception:
+                self.log.exception("Could not release routed jobs from %s" % q.name)
+
+    def dequeue_job_and_maintain_ttl(self, timeout):
+        # Like rq's, but waking up every release_interval seconds to release overdue jobs
+        qnames = self.queue_names()
+
+        self.set_state(WorkerStatus.IDLE)
+        self.procline('Listening on {0}'.format(','.join(qnames)))
+        self.log.info('*** Listening on {0}...'.format(', '.join(qnames)))
+
+        result = None
+        wait = None if timeout is None else min(timeout, self.release_interval)
+        while True:
+            self.heartbeat()
+            self.release_overdue()
+
+            try:
+                result = self.queue_class.dequeue_any(self.queues, wait, connection=self.connection)
+                if result is not None:
+                    job, queue = result
+                    self.log.info('{0}: {1} ({2})'.format(queue.name, job.description, job.id))
+                break
+            except DequeueTimeout:
+                pass
+
+        self.heartbeat()
+        return result
@@ -0,0 +1,108 @@
+import os
+import json
+from datetime import datetime
+
+import numpy as np
+
+from larva_service.particles import ParticleStore
+from larva_service.ensemble import haversine, describe
+
+# Center tracklines paegan writes, in order of preference
+TRACKLINE_FILES = ['simple_trackline.geojson', 'trackline.geojson']
+
+# Particle states counted at the end of a run
+STATES = ['settled', 'dead', 'halted']
+
+
+def read_trackline(output_path):
+    """
+    The center trackline in a run's local output, or None
+    """
+    for filename in TRACKLINE_FILES:
+        path = os.path.join(output_path, filename)
+        if os.path.exists(path):
+            with open(path) as f:
+                return json.load(f)
+    return None
+
+
+def particle_summary(store_path, chunk_size=256):
+    """
+    Statistics of a run from its particle store, read in one pass of
+    'chunk_size' timesteps at a time
+    """
+    store = ParticleStore(store_path)
+
+    start = end = None
+    timesteps = 0
+    bounds = None
+    depths = None
+    distance = None
+    last = None
+    state = None
+
+    for times, particles, data in store.chunks(['longitude', 'latitude', 'depth'] + STATES, size=chunk_size):
+        lons = data['longitude'].astype(np.float64)
+        lats = data['latitude'].astype(np.float64)
+        depth = data['depth'].astype(np.float64)
+
+        if distance is None:
+            distance = np.zeros(len(particles))
+            last = (np.empty(len(particles)), np.empty(len(particles)))
+            last[0].fill(np.nan)
+            last[1].fill(np.nan)
+            state = dict((s, np.zeros(len(particles), dtype=bool)) for s in STATES)
+            start = times[0]
+        end = times[-1]
+        timesteps += len(times)
+
+        valid = ~(np.isnan(lons) | np.isnan(lats))
+        if valid.any():
+            box = (lons[valid].min(), lats[valid].min(), lons[valid].max(), lats[valid].max())
+            bounds = box if bounds is None else (min(bounds[0], box[0]), min(bounds[1], box[1]), max(bounds[2], box[2]), max(bounds[3], box[3]))
+
+        if not np.isnan(depth).all():
+            low, high = np.nanmin(depth), np.nanmax(depth)
+            depths = (low, high) if depths is None else (min(depths[0], low), max(depths[1], high))
+
+        # Steps across chunk boundaries count
+        lons = np.vstack((last[0], lons))
+        lats = np.vstack((last[1], lats))
+        distance += np.nansum(haversine(lons[:-1], lats[:-1], lons[1:], lats[1:]), axis=0)
+        last = (lons[-1], lats[-1])
+
+        # The state of each particle at the last time it reported one
+        for s in STATES:
+            values = data[s]
+            reported = ~np.isnan(values).all(axis=0)
+            if reported.any():
+                latest = len(values) - 1 - np.argmax(~np.isnan(values[::-1]), axis=0)
+                state[s][reported] = values[latest[reported], np.flatnonzero(reported)] > 0
+
+    if distance is None:
+        return { 'particles' : 0, 'timesteps' : 0 }
+
+    summary = {
+        'particles'   : len(distance),
+        'timesteps'   : timesteps,
+        'start'       : datetime.utcfromtimestamp(start),
+        'end'         : datetime.utcfromtimestamp(end),
+        'bounds'      : [float(b) for b in bounds] if bounds is not None else None,
+        'depth'       : { 'min' : float(depths[0]), 'max' : float(depths[1]) } if depths is not None else None,
+        'distance_km' : describe(distance),
+    }
+    for s in STATES:
+        summary[s] = int(state[s].sum())
+    return summary
+
+
+def summarize(output_path, store_path=None):
+    """
+    Metadata of a finished run from its local output, before it is
+    uploaded anywhere.  Returns the run's summary and its center trackline.
+    """
+    summary = {}
+    if store_path and os.path.exists(store_path):
+        summary = particle_summary(store_path)
+
+    return summary, read_trackline(output_path)
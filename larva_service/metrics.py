@@ -0,0 +1,91 @@
+import time
+from datetime import datetime
+from collections import OrderedDict
+from contextlib import contextmanager
+
+from larva_service import redis_connection
+
+# Upper bounds (seconds) of the phase duration histogram buckets
+BUCKETS = [1, 5, 15, 60, 300, 900, 3600, 10800, 43200, 86400]
+
+PHASES_KEY = "larva_service:metrics:phases"
+PHASE_KEY = "larva_service:metrics:phase:%s"
+
+
+class PhaseTimer(object):
+    """
+    Wall clock durations of the named phases of a run, in the order they ran
+    """
+
+    def __init__(self):
+        self.timings = OrderedDict()
+
+    @contextmanager
+    def phase(self, name):
+        started = time.time()
+        try:
+            yield
+        finally:
+            self.timings[name] = round(self.timings.get(name, 0) + time.time() - started, 3)
+
+    def add(self, name, seconds):
+        self.timings[name] = round(seconds, 3)
+
+
+def queue_wait(job, fallback=None):
+    """
+    Seconds 'job' waited in its queue since it was last enqueued, so reruns
+    and retries don't count the time since the run was created.  From
+    'fallback' if the job has no enqueued_at.
+    """
+    enqueued = getattr(job, 'enqueued_at', None) or fallback
+    if enqueued is None:
+        return 0.
+    return max(0., (datetime.utcnow() - enqueued).total_seconds())
+
+
+def record_timings(timings, connection=None):
+    """
+    Add a run's phase durations to the cumulative histograms kept in Redis
+    """
+    r = connection or redis_connection
+    pipe = r.pipeline(transaction=False)
+    for name, seconds in timings.items():
+        key = PHASE_KEY % name
+        pipe.sadd(PHASES_KEY, name)
+        for le in BUCKETS:
+            if seconds <= le:
+                pipe.hincrby(key, str(le), 1)
+        pipe.hincrby(key, "+Inf", 1)
+        pipe.hincrby(key, "count", 1)
+        pipe.hincrbyfloat(key, "sum", seconds)
+    pipe.execute()
+
+
+def render(queues, connection=None):
+    """
+    Prometheus text exposition of the phase histograms and queue depths
+    """
+    r = connection or redis_connection
+    lines = [
+        "# HELP larva_run_phase_seconds Duration of each phase of a model run",
+        "# TYPE larva_run_phase_seconds histogram"
+    ]
+
+    phases = sorted(r.smembers(PHASES_KEY))
+    pipe = r.pipeline(transaction=False)
+    for name in phases:
+        pipe.hgetall(PHASE_KEY % name)
+
+    for name, values in zip(phases, pipe.execute()):
+        for le in [str(b) for b in BUCKETS] + ["+Inf"]:
+            lines.append('larva_run_phase_seconds_bucket{phase="%s",le="%s"} %s' % (name, le, values.get(le, 0)))
+        lines.append('larva_run_phase_seconds_sum{phase="%s"} %s' % (name, values.get("sum", 0)))
+        lines.append('larva_run_phase_seconds_count{phase="%s"} %s' % (name, values.get("count", 0)))
+
+    lines.append("# HELP larva_queue_depth Jobs waiting in each queue")
+    lines.append("# TYPE larva_queue_depth gauge")
+    for q in queues:
+        lines.append('larva_queue_depth{queue="%s"} %d' % (q.name, q.count))
+
+    return "\n".join(lines) + "\n"
@@ -1,4 +1,4 @@
-from larva_service.models import run, dataset, shoreline
+from larva_service.models import run, dataset, shoreline, analysis, trackline
 
 
 def remove_mongo_keys(d, extra=None):
@@ -0,0 +1,37 @@
+from mongokit import Document
+from larva_service import db, redis_connection
+from datetime import datetime
+from rq.job import Job
+
+
+class Analysis(Document):
+    __collection__ = 'analyses'
+    use_dot_notation = True
+    structure = {
+        'name'              : unicode,  # Name of the analysis
+        'run_ids'           : list,     # Runs in the ensemble
+        'shoreline_buffer'  : float,    # Degrees around the shoreline that count as arrival
+        'results'           : dict,     # Per run and ensemble statistics
+        'message'           : unicode,  # Error message, if the analysis failed
+        'task_id'           : unicode,  # Task computing the analysis
+        'created'           : datetime,
+        'started'           : datetime,
+        'ended'             : datetime
+    }
+    default_values = {
+                      'created': datetime.utcnow,
+                      'shoreline_buffer': 0.01
+                      }
+
+    # Fields of the JSON API, larva_service.serialize
+    api_fields = ['name', 'run_ids', 'shoreline_buffer', 'results', 'message', 'created', 'started', 'ended']
+
+    def status(self):
+        if self.task_id and Job.exists(self.task_id, connection=redis_connection):
+            job = Job.fetch(self.task_id, connection=redis_connection)
+            job.refresh()
+            return job.status
+        else:
+            return "unknown"
+
+db.register([Analysis])
@@ -1,13 +1,21 @@
 import json
 import os
 from flask.ext.mongokit import Document
-from larva_service import app, db, redis_connection
+from mongokit import DocumentMigration
+from larva_service import app, db, redis_connection, invalidate_choices
 from datetime import datetime
 from shapely.geometry import Point
 from shapely.wkt import loads
-from paegan.cdm.dataset import CommonDataset
-from shapely.geometry import box
+from shapely.geometry import box, mapping, shape
+from shapely.affinity import translate
 from rq.job import Job
+from larva_service.responses import invalidate
+
+
+class DatasetMigration(DocumentMigration):
+    def allmigration01__add_footprint_field(self):
+        self.target = {'footprint': {'$exists': False}}
+        self.update = {'$set': {'footprint': None}}
 
 
 class Dataset(Document):
@@ -21,6 +29,7 @@ class Dataset(Document):
         'location'          : unicode,  # DAP endpoint
         'bbox'              : unicode,  # WKT of the bounding box
         'geometry'          : unicode,  # WKT of the bounding polygon
+        'footprint'         : dict,     # GeoJSON of the bounding polygon (or box), indexed for dataset selection
         'variables'         : dict,     # dict of variables, including attributes
         'keywords'          : list,     # keywords pulled from global attributes of dataset
         'messages'          : list,     # Error messages
@@ -31,6 +40,22 @@ class Dataset(Document):
     default_values = {
                       'created': datetime.utcnow
                       }
+    migration_handler = DatasetMigration
+
+    # Fields of the JSON API, larva_service.serialize.  Variables are served
+    # by /datasets/<id>/variables, or with ?variables=true
+    api_fields = ['name', 'starting', 'ending', 'timestep', 'location', 'bbox', 'geometry', 'keywords', 'messages', 'task_id', 'created', 'updated']
+
+    def save(self, *args, **kwargs):
+        self.footprint = footprint(self.geometry, self.bbox)
+        super(Dataset, self).save(*args, **kwargs)
+        invalidate_choices()
+        invalidate("datasets", "datasets:%s" % self._id)
+
+    def delete(self):
+        super(Dataset, self).delete()
+        invalidate_choices()
+        invalidate("datasets", "datasets:%s" % self._id)
 
     def status(self):
         if Job.exists(self.task_id, connection=redis_connection):
@@ -44,6 +69,8 @@ class Dataset(Document):
         """
         Compute bounds for this dataset
         """
+        from paegan.cdm.dataset import CommonDataset
+
         try:
 
             nc = CommonDataset.open(self.location)
@@ -104,4 +131,118 @@ class Dataset(Document):
 
         return marker_positions
 
+def match_variables(variables, q=None, standard_name=None):
+    """
+    Sorted [(name, attributes)] of the variables whose name, standard_name or
+    long_name contain 'q' (ignoring case) and whose standard_name is
+    'standard_name'
+    """
+    q = q.lower() if q else None
+    matched = []
+    for name, attributes in sorted((variables or {}).items()):
+        if standard_name and attributes.get('standard_name') != standard_name:
+            continue
+        if q and not any(q in unicode(v).lower() for v in [name, attributes.get('standard_name', ''), attributes.get('long_name', '')]):
+            continue
+        matched.append((name, attributes))
+    return matched
+
+
+def footprint(*wkts):
+    """
+    GeoJSON of the first of a dataset's WKT bounds (its polygon, then its
+    box) that a 2dsphere index accepts, or None.  Bounds on 0-360 longitudes
+    are moved to -180-180.  Bounds crossing the antimeridian, spanning half
+    the globe or more, or reaching a pole aren't indexed: Mongo reads their
+    edges as the shorter way around, or rejects them.
+    """
+    for wkt in wkts:
+        if not wkt:
+            continue
+        try:
+            geo = loads(wkt)
+        except Exception:
+            continue
+
+        minx, miny, maxx, maxy = geo.bounds
+        if minx >= 180 and maxx <= 360:
+            geo = translate(geo, xoff=-360)
+            minx, maxx = minx - 360, maxx - 360
+        if minx < -180 or maxx > 180 or maxx - minx >= 180 or miny <= -90 or maxy >= 90:
+            continue
+
+        # Mongo rejects self intersecting polygons and repeated vertices
+        geo = geo.simplify(0)
+        if not geo.is_valid:
+            geo = geo.buffer(0)
+        if geo.is_empty or geo.geom_type not in ['Point', 'Polygon']:
+            continue
+        return json.loads(json.dumps(mapping(geo)))
+    return None
+
+
+def dataset_query(geometry=None, starting=None, ending=None):
+    """
+    Mongo query for the datasets whose footprint meets 'geometry' (a shapely
+    geometry) and whose time bounds cover 'starting' to 'ending'.  Served by
+    the indexes index_datasets() creates.
+    """
+    query = {}
+    if geometry is not None:
+        query['footprint'] = { '$geoIntersects' : { '$geometry' : json.loads(json.dumps(mapping(geometry))) } }
+    if starting is not None:
+        query['starting'] = { '$lte' : starting }
+    if ending is not None:
+        query['ending'] = { '$gte' : ending }
+    return query
+
+
+def covering(docs, geometry=None):
+    """
+    The dataset documents (with their footprint) that contain all of
+    'geometry', best first: the smallest footprint, as that is the most
+    detailed model, then the most recently updated
+    """
+    matched = []
+    for doc in docs:
+        fp = shape(doc['footprint']) if doc.get('footprint') else None
+        if geometry is not None and (fp is None or not fp.contains(geometry)):
+            continue
+        matched.append((fp.area if fp is not None else 0, doc))
+
+    matched.sort(key=lambda m: m[1].get('updated') or m[1].get('created') or datetime.min, reverse=True)
+    matched.sort(key=lambda m: m[0])
+    return [doc for area, doc in matched]
+
+
+def select_dataset(geometry, starting, ending):
+    """
+    The dataset document best covering 'geometry' from 'starting' to
+    'ending', or None
+    """
+    docs = db.datasets.find(dataset_query(geometry, starting, ending), { 'variables' : False })
+    matched = covering(docs, geometry)
+    return matched[0] if matched else None
+
+
+def index_datasets():
+    """
+    Create the indexes dataset selection uses and give the datasets saved
+    before it their footprint, returning how many were given one
+    """
+    db.datasets.ensure_index([('footprint', '2dsphere'), ('starting', 1), ('ending', 1)])
+    db.datasets.ensure_index([('starting', 1), ('ending', 1)])
+
+    updated = 0
+    for d in db.datasets.find({ 'footprint' : None }, { 'geometry' : True, 'bbox' : True }):
+        fp = footprint(d.get('geometry'), d.get('bbox'))
+        if fp is None:
+            continue
+        db.datasets.update({ '_id' : d['_id'] }, { '$set' : { 'footprint' : fp } })
+        updated += 1
+    if updated:
+        invalidate("datasets")
+    return updated
+
+
 db.register([Dataset])
@@ -1,7 +1,7 @@
 from mongokit import Document, DocumentMigration
-from larva_service import db, app, redis_connection
+from larva_service import db, app, redis_connection, slugify
 from flask import url_for
-from datetime import datetime, date
+from datetime import datetime, date, timedelta
 import json
 import urllib2
 import pytz
@@ -12,6 +12,14 @@ import geojson
 from shapely.wkt import loads
 from rq.job import Job
 
+from larva_service.exports import EXPORTERS
+from larva_service.responses import invalidate
+from larva_service.models.trackline import save_trackline, load_trackline, has_trackline
+from larva_service.models.dataset import select_dataset
+
+# hydro_path of runs that run on whichever dataset covers them best
+AUTO_HYDRO_PATH = u"auto"
+
 
 class RunMigration(DocumentMigration):
     def allmigration01__add_results_field(self):
@@ -38,6 +46,127 @@ class RunMigration(DocumentMigration):
         self.target = {'final_message': {'$exists': False}}
         self.update = {'$set': {'final_message': ''}}
 
+    def allmigration07__add_output_formats_fields(self):
+        self.target = {'output_formats': {'$exists': False}}
+        self.update = {'$set': {'output_formats': list(EXPORTERS.keys()), 'exports': {}}}
+
+    def allmigration08__add_particle_store_field(self):
+        self.target = {'particle_store': {'$exists': False}}
+        self.update = {'$set': {'particle_store': u''}}
+
+    def allmigration09__add_timings_field(self):
+        self.target = {'timings': {'$exists': False}}
+        self.update = {'$set': {'timings': {}}}
+
+    def allmigration10__add_profile_fields(self):
+        self.target = {'profile': {'$exists': False}}
+        self.update = {'$set': {'profile': False, 'profile_particles': False}}
+
+    def allmigration11__add_resources_field(self):
+        self.target = {'resources': {'$exists': False}}
+        self.update = {'$set': {'resources': {}}}
+
+    def allmigration12__add_disk_field(self):
+        self.target = {'disk': {'$exists': False}}
+        self.update = {'$set': {'disk': {}}}
+
+    def allmigration13__add_hydro_cache_fields(self):
+        self.target = {'keep_hydro_cache': {'$exists': False}}
+        self.update = {'$set': {'keep_hydro_cache': False, 'hydro_cache': u''}}
+
+    def allmigration14__add_summary_field(self):
+        self.target = {'summary': {'$exists': False}}
+        self.update = {'$set': {'summary': {}}}
+
+
+def run_status(task_result, task_id):
+    if task_result is not None and task_result != "":
+        return task_result
+    elif task_id and Job.exists(task_id, connection=redis_connection):
+        job = Job.fetch(task_id, connection=redis_connection)
+        return job.status
+    else:
+        return "unknown"
+
+
+def s3_filename(run_name, outfile):
+    """
+    The name an output file is uploaded to S3 under, after the run and still
+    after the file, so profile.pstats and particle_profile.pstats don't
+    overwrite each other and model.log.gz is still a gzipped log
+    """
+    return "%s-%s" % (slugify(unicode(run_name)), os.path.basename(outfile))
+
+
+def file_key_and_link(run_id, file_path):
+    """
+    { file type : link } for one of a run's output files
+    """
+    url = urlparse(file_path)
+    if url.scheme == '':
+        base_access_url = app.config.get('NON_S3_OUTPUT_URL', None)
+        if base_access_url is None:
+            # Serve assets through Flask... not desired!
+            app.logger.warning("Serving static output through Flask is not desirable! Set the NON_S3_OUTPUT_URL config variable.")
+
+            filename = url.path.split("/")[-1]
+            # We can get a context here to use url_for
+            with app.app_context():
+                file_link = url_for("run_output_download", run_id=run_id, filename=filename)
+        else:
+            file_link = base_access_url + file_path.replace(app.config.get("OUTPUT_PATH"), "")
+
+    else:
+        file_link = file_path
+
+        # Local file
+    url = urlparse(file_link)
+    name, ext = os.path.splitext(url.path)
+    compressed = ext == ".gz"
+    if compressed:
+        name, ext = os.path.splitext(name)
+
+    file_type = "Unknown (%s)" % ext
+    if ext == ".zip":
+        file_type = "Shapefile"
+    elif ext == ".nc":
+        if 'cache' in name:
+            file_type = "Forcing Data"
+        else:
+            file_type = "NetCDF"
+    elif ext == ".json":
+        file_type = "JSON"
+    elif ext == ".geojson":
+        if "particle_tracklines" in name:
+            file_type = "Particle Tracklines (GeoJSON)"
+        elif "simple_trackline" in name:
+            file_type = "Simple Trackline (GeoJSON)"
+        elif "full_trackline" in name:
+            file_type = "Center Trackline (GeoJSON)"
+        elif "particle_multipoint" in name:
+            file_type = "Particle MultiPoint (GeoJSON)"
+    elif ext == ".avi":
+        file_type = "Animation"
+    elif ext == ".log":
+        file_type = "Logfile"
+    elif ext == ".h5":
+        file_type = "HDF5 Data File"
+    elif ext == ".pstats":
+        if name.endswith("particle_profile"):
+            file_type = "Particle Profile (pstats)"
+        else:
+            file_type = "Profile (pstats)"
+    elif ext == ".collapsed":
+        if name.endswith("particle_profile"):
+            file_type = "Particle Profile (collapsed stacks)"
+        else:
+            file_type = "Profile (collapsed stacks)"
+
+    if compressed:
+        file_type += " (gzip)"
+
+    return { file_type : file_link }
+
 
 class Run(Document):
     __collection__ = 'runs'
@@ -63,60 +192,124 @@ class Run(Document):
         'email'              : unicode,   # Email of the person who ran the model
         'output'             : list,
         'task_result'        : unicode,
-        'trackline'          : unicode,   # GeoJSON
+        'trackline'          : unicode,   # Unused, tracklines are in their own collection
         'started'            : datetime,
         'ended'              : datetime,
         'shoreline_path'     : unicode,
         'shoreline_feature'  : unicode,
         'final_message'      : unicode,   # Message from the Job
+        'output_formats'     : list,      # Names of the exports to produce, see larva_service.exports
+        'exports'            : dict,      # Status and duration of each export
+        'particle_store'     : unicode,   # Local path of the columnar particle output
+        'timings'            : dict,      # Seconds spent in each phase of the run
+        'profile'            : bool,      # Save a profile of the model run with the output
+        'profile_particles'  : bool,      # Also profile the particle tasks of distributed runs
+        'resources'          : dict,      # Peak RSS, CPU time and I/O of the run and its particle tasks
+        'disk'               : dict,      # Bytes of local output and cache, and when the output was evicted
+        'keep_hydro_cache'   : bool,      # Keep the forcing data a DAP run cached with its output
+        'hydro_cache'        : unicode,   # Content hash of the kept forcing data, stored once for all runs with it
+        'summary'            : dict,      # Particles, bounds, depths, distances and final states, see larva_service.metadata
     }
     default_values = {  'created': datetime.utcnow,
                         'time_chunk'  : 10,
                         'horiz_chunk' : 5,
-                        'time_method' : u'interp' }
+                        'time_method' : u'interp',
+                        'output_formats' : [unicode(f) for f in EXPORTERS.keys()],
+                        'profile' : False,
+                        'profile_particles' : False,
+                        'keep_hydro_cache' : False }
     migration_handler = RunMigration
 
-    restrict_loading = ["output", "task_result", "trackline", "task_id", "created", "cached_behavior", "output", "started", "ended", "final_message", "_id"]
+    restrict_loading = ["output", "task_result", "trackline", "task_id", "created", "cached_behavior", "output", "started", "ended", "final_message", "exports", "particle_store", "timings", "resources", "disk", "hydro_cache", "summary", "_id"]
+
+    # Fields of the JSON API, larva_service.serialize
+    api_fields = ["name", "behavior", "particles", "hydro_path", "geometry", "release_depth", "start", "duration", "timestep",
+                  "horiz_dispersion", "vert_dispersion", "time_chunk", "horiz_chunk", "time_method", "created", "email",
+                  "started", "ended", "shoreline_path", "shoreline_feature", "final_message", "output_formats", "exports",
+                  "particle_store", "timings", "profile", "profile_particles", "resources", "disk", "keep_hydro_cache",
+                  "hydro_cache", "summary"]
 
-    def compute(self):
+    # Fields the run tasks fill in, written together when the run ends
+    result_fields = ["started", "ended", "output", "task_result", "final_message", "exports", "particle_store", "hydro_cache", "timings", "resources", "disk", "summary"]
+
+    def save(self, *args, **kwargs):
+        super(Run, self).save(*args, **kwargs)
+        invalidate("runs", "runs:%s" % self._id)
+
+    def delete(self):
+        super(Run, self).delete()
+        invalidate("runs", "runs:%s" % self._id)
+
+    def compute(self, summary=None, trackline=None):
         """
-        Add any metadata to this object from the model run output
+        Add any metadata to this object from the model run output.  Run
+        tasks pass the summary and trackline larva_service.metadata read from
+        their local output, otherwise the trackline is read back from the
+        output files.  Saved with save_results().
         """
         try:
-            self.set_trackline()
+            if trackline is not None:
+                save_trackline(self._id, trackline)
+            elif summary is None:
+                self.set_trackline()
         except:
             app.logger.exception("Could not process trackline results.")
 
+        if summary is not None:
+            self.summary = summary
+
         if Job.exists(self.task_id, connection=redis_connection):
             job = Job.fetch(self.task_id, connection=redis_connection)
             self.task_result = unicode(job.meta.get("outcome", ""))
             self.final_message = unicode(job.meta.get("message", ""))
 
-        self.save()
+    def save_results(self):
+        """
+        Write the fields the run task filled in with a single partial update
+        """
+        self.validate()
+        db.runs.update({ '_id' : self._id }, { '$set' : dict((k, self[k]) for k in self.result_fields) })
+        invalidate("runs", "runs:%s" % self._id)
 
     def set_trackline(self):
-        if self.trackline is None:
-            for filepath in self.output:
-                if os.path.basename(filepath) in ['trackline.geojson', 'simple_trackline.geojson']:
-                    # Get GeoJSON trackline and cache locally as GeoJSON
-                    try:
-                        t = urllib2.urlopen(filepath)
-                        self.trackline = unicode(geojson.loads(t.read()))
-                    except ValueError:
-                        t = open(filepath, 'r')
-                        self.trackline = unicode(geojson.loads(t.read()))
-                        t.close()
-
-        return self.trackline
+        """
+        Store the center trackline from the run's output in the tracklines
+        collection, see larva_service.models.trackline
+        """
+        if self.trackline or has_trackline(self._id):
+            return self.get_trackline()
+
+        geo = None
+        for filepath in self.output:
+            if os.path.basename(filepath) in ['trackline.geojson', 'simple_trackline.geojson']:
+                try:
+                    t = urllib2.urlopen(filepath)
+                    geo = json.loads(t.read())
+                except ValueError:
+                    t = open(filepath, 'r')
+                    geo = json.loads(t.read())
+                    t.close()
+
+        if geo is not None:
+            save_trackline(self._id, geo)
+        return geo
+
+    def get_trackline(self):
+        """
+        The center trackline as a GeoJSON object, decoded when asked for
+        """
+        if self.trackline:
+            # Runs from before tracklines had their own collection
+            geo = json.loads(self.trackline)
+            if self._id is not None:
+                save_trackline(self._id, geo)
+                db.runs.update({ '_id' : self._id }, { '$set' : { 'trackline' : None } })
+            self.trackline = None
+            return geo
+        return load_trackline(self._id)
 
     def status(self):
-        if self.task_result is not None and self.task_result != "":
-            return self.task_result
-        elif self.task_id and Job.exists(self.task_id, connection=redis_connection):
-            job = Job.fetch(self.task_id, connection=redis_connection)
-            return job.status
-        else:
-            return "unknown"
+        return run_status(self.task_result, self.task_id)
 
     def progress(self):
         if self.task_result is not None and self.task_result != "":
@@ -145,10 +338,11 @@ class Run(Document):
         else:
             return "unknown"
 
-    def google_maps_trackline(self):
-        if self.trackline:
+    def google_maps_trackline(self, trackline=None):
+        trackline = trackline or self.get_trackline()
+        if trackline:
             try:
-                return list(geojson.utils.coords(geojson.loads(self.trackline)))
+                return list(geojson.utils.coords(trackline))
             except AttributeError:
                 return []
         return []
@@ -168,61 +362,14 @@ class Run(Document):
         return marker_positions
 
     def get_file_key_and_link(self, file_path):
-        url = urlparse(file_path)
-        if url.scheme == '':
-            base_access_url = app.config.get('NON_S3_OUTPUT_URL', None)
-            if base_access_url is None:
-                # Serve assets through Flask... not desired!
-                app.logger.warning("Serving static output through Flask is not desirable! Set the NON_S3_OUTPUT_URL config variable.")
-
-                filename = url.path.split("/")[-1]
-                # We can get a context here to use url_for
-                with app.app_context():
-                    file_link = url_for("run_output_download", run_id=self._id, filename=filename)
-            else:
-                file_link = base_access_url + file_path.replace(app.config.get("OUTPUT_PATH"), "")
-
-        else:
-            file_link = file_path
-
-            # Local file
-        url = urlparse(file_link)
-        name, ext = os.path.splitext(url.path)
-
-        file_type = "Unknown (%s)" % ext
-        if ext == ".zip":
-            file_type = "Shapefile"
-        elif ext == ".nc":
-            if 'cache' in name:
-                file_type = "Forcing Data"
-            else:
-                file_type = "NetCDF"
-        elif ext == ".json":
-            file_type = "JSON"
-        elif ext == ".geojson":
-            if "particle_tracklines" in name:
-                file_type = "Particle Tracklines (GeoJSON)"
-            elif "simple_trackline" in name:
-                file_type = "Simple Trackline (GeoJSON)"
-            elif "full_trackline" in name:
-                file_type = "Center Trackline (GeoJSON)"
-            elif "particle_multipoint" in name:
-                file_type = "Particle MultiPoint (GeoJSON)"
-        elif ext == ".avi":
-            file_type = "Animation"
-        elif ext == ".log":
-            file_type = "Logfile"
-        elif ext == ".h5":
-            file_type = "HDF5 Data File"
-
-        return { file_type : file_link }
+        return file_key_and_link(self._id, file_path)
 
     def output_files(self):
         return (self.get_file_key_and_link(file_path) for file_path in self.output)
 
     def run_config(self):
 
-        skip_keys = ['_id', 'cached_behavior', 'created', 'task_id', 'output', 'trackline', 'task_result', 'started', 'ended', 'final_message']
+        skip_keys = ['_id', 'cached_behavior', 'created', 'task_id', 'output', 'trackline', 'task_result', 'started', 'ended', 'final_message', 'exports', 'particle_store', 'timings', 'resources', 'disk', 'hydro_cache', 'summary']
         d = {}
         for key, value in self.iteritems():
             if key not in skip_keys:
@@ -260,6 +407,19 @@ class Run(Document):
             elif key == 'release_depth' or key == 'horiz_dispersion' or key == 'vert_dispersion':
                 self[key] = float(value)
 
+            elif key == 'profile' or key == 'profile_particles' or key == 'keep_hydro_cache':
+                if isinstance(value, basestring):
+                    value = value.lower() in ['true', '1', 'yes', 'on']
+                self[key] = bool(value)
+
+            elif key == 'output_formats':
+                if isinstance(value, basestring):
+                    value = value.split(",")
+                unknown = [f for f in value if f not in EXPORTERS]
+                if unknown:
+                    app.logger.warning("Unknown output formats: %s.  Ignoring." % ", ".join(unknown))
+                self[key] = [unicode(f) for f in value if f in EXPORTERS]
+
             else:
                 try:
                     if value is not None:
@@ -274,5 +434,22 @@ class Run(Document):
             except:
                 pass
 
+    def select_hydro_path(self):
+        """
+        Run on the dataset best covering the release geometry for the whole
+        run when hydro_path is AUTO_HYDRO_PATH.  Returns False if none does.
+        """
+        if self.hydro_path != AUTO_HYDRO_PATH:
+            return True
+        if not self.geometry or self.start is None:
+            return False
+
+        ending = self.start + timedelta(days=self.duration or 0)
+        dataset = select_dataset(loads(self.geometry), self.start, ending)
+        if dataset is None:
+            return False
+        self.hydro_path = dataset['location']
+        return True
+
 
 db.register([Run])
@@ -1,13 +1,14 @@
 import json
 import os
+import time
 from mongokit import Document, DocumentMigration
-from larva_service import app, db, redis_connection
+from larva_service import app, db, redis_connection, invalidate_choices
 from datetime import datetime
 from shapely.geometry import Point, asShape, Polygon, MultiPolygon
 from shapely.wkt import loads
-from paegan.transport.shoreline import Shoreline as PTShoreline
 from shapely.geometry import box
 from rq.job import Job
+from larva_service.responses import invalidate
 
 
 class RunMigration(DocumentMigration):
@@ -15,6 +16,10 @@ class RunMigration(DocumentMigration):
         self.target = {'path_type':{'$exists': False}}
         self.update = {'$set':{'path_type':u''}}
 
+    def allmigration02__add_index_fields(self):
+        self.target = {'index_path':{'$exists': False}}
+        self.update = {'$set':{'index_path':u'', 'index_stats':{}}}
+
 
 class Shoreline(Document):
     __collection__ = 'shorelines'
@@ -27,6 +32,8 @@ class Shoreline(Document):
         'title'             : unicode,  # title of the shoreline in WFS
         'bbox'              : unicode,  # WKT of the bounding box
         'geometry'          : unicode,  # WKT of the bounding polygon (unused currently)
+        'index_path'        : unicode,  # Directory of the persisted spatial index
+        'index_stats'       : dict,     # Statistics from building the spatial index
         'task_id'           : unicode,  # id of import task
         'created'           : datetime,
         'updated'           : datetime
@@ -36,6 +43,19 @@ class Shoreline(Document):
                       }
     migration_handler = RunMigration
 
+    # Fields of the JSON API, larva_service.serialize
+    api_fields = ['name', 'path', 'path_type', 'feature_name', 'title', 'bbox', 'geometry', 'index_path', 'index_stats', 'task_id', 'created', 'updated']
+
+    def save(self, *args, **kwargs):
+        super(Shoreline, self).save(*args, **kwargs)
+        invalidate_choices()
+        invalidate("shorelines", "shorelines:%s" % self._id)
+
+    def delete(self):
+        super(Shoreline, self).delete()
+        invalidate_choices()
+        invalidate("shorelines", "shorelines:%s" % self._id)
+
     def status(self):
         if Job.exists(self.task_id, connection=redis_connection):
             job = Job.fetch(self.task_id, connection=redis_connection)
@@ -45,6 +65,8 @@ class Shoreline(Document):
             return "unknown"
 
     def get_info(self):
+        from paegan.transport.shoreline import Shoreline as PTShoreline
+
         s = PTShoreline(path=self.path, feature_name=self.feature_name)
         caps = s.get_feature_type_info()
 
@@ -53,9 +75,41 @@ class Shoreline(Document):
             self.bbox  = unicode(caps['LatLongBoundingBox'].wkt)
             self.title = unicode(caps['Name'])
 
+    def build_index(self):
+        """
+        Build and persist a packed spatial index of every polygon in this shoreline
+        """
+        from larva_service.shoreline_index import build_index
+        from paegan.transport.shoreline import Shoreline as PTShoreline
+
+        s = PTShoreline(path=self.path, feature_name=self.feature_name)
+        caps = s.get_feature_type_info()
+        if caps is None:
+            raise ValueError("Could not determine the extent of shoreline %s" % self.path)
+
+        extent = caps['LatLongBoundingBox']
+        started = time.time()
+        if self.path_type == u'ShorelineWFS':
+            geoms = s.get_geoms_for_bounds(extent.wkt)
+        else:
+            geoms = s.get_geoms_for_bounds(extent.bounds)
+        s.close()
+
+        index_path = os.path.join(app.config['SHORELINE_INDEX_PATH'], unicode(self._id))
+        stats = build_index(geoms, index_path)
+        stats['seconds'] = round(time.time() - started, 3)
+        stats['built'] = datetime.utcnow()
+
+        self.index_path = unicode(index_path)
+        self.index_stats = stats
+
     def google_maps_coordinates(self, bbox=None):
         marker_positions = []
-        if bbox:
+        if bbox and self.index_path and os.path.exists(self.index_path):
+            from larva_service.shoreline_index import load_index
+            geo = load_index(self.index_path).query(bbox)
+        elif bbox:
+            from paegan.transport.shoreline import Shoreline as PTShoreline
             s = PTShoreline(path=self.path, feature_name=self.feature_name)
             geo_json = s.get_geoms_for_bounds(bbox)
             geo = [asShape(g) for g in geo_json]
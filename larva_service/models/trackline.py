@@ -0,0 +1,71 @@
+import json
+from mongokit import Document
+from bson.binary import Binary
+from larva_service import db
+from datetime import datetime
+
+from larva_service import tracklines
+from larva_service.responses import invalidate
+
+
+class Trackline(Document):
+    """
+    The center trackline of a run, encoded by larva_service.tracklines and
+    keyed by the run's _id so the run documents stay small
+    """
+    __collection__ = 'tracklines'
+    use_dot_notation = True
+    structure = {
+        'data'      : Binary,   # See larva_service.tracklines
+        'positions' : int,      # Number of positions in the trackline
+        'created'   : datetime,
+    }
+    default_values = { 'created': datetime.utcnow }
+
+
+def save_trackline(run_id, geo):
+    t = db.Trackline()
+    t['_id'] = run_id
+    t.data = Binary(tracklines.encode(geo))
+    t.positions = tracklines.count(geo)
+    t.save()
+    invalidate("runs:%s" % run_id)
+    return t
+
+
+def load_trackline(run_id):
+    """
+    The trackline of a run as a GeoJSON object, or None
+    """
+    doc = db.tracklines.find_one({ '_id' : run_id }, { 'data' : True })
+    if doc is None:
+        return None
+    return tracklines.decode(doc['data'])
+
+
+def has_trackline(run_id):
+    return db.tracklines.find({ '_id' : run_id }).limit(1).count(True) > 0
+
+
+def delete_trackline(run_id):
+    db.tracklines.remove({ '_id' : run_id })
+    invalidate("runs:%s" % run_id)
+
+
+def migrate_tracklines():
+    """
+    Move the GeoJSON strings runs stored before tracklines had their own
+    collection, returning how many were moved
+    """
+    moved = 0
+    for r in db.runs.find({ 'trackline' : { '$nin' : [None, u''] } }, { 'trackline' : True }):
+        try:
+            save_trackline(r['_id'], json.loads(r['trackline']))
+        except ValueError:
+            pass
+        db.runs.update({ '_id' : r['_id'] }, { '$set' : { 'trackline' : None } })
+        moved += 1
+    return moved
+
+
+db.register([Trackline])
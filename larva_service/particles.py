@@ -0,0 +1,148 @@
+import os
+import calendar
+from datetime import datetime
+
+import numpy as np
+
+# Per-particle variables written by paegan's ResultsPyTable
+FIELDS = ['latitude', 'longitude', 'depth', 'u_vector', 'v_vector', 'w_vector', 'temperature',
+          'salinity', 'age', 'lifestage', 'progress', 'settled', 'halted', 'dead']
+
+
+def build_store(results_file, store_file, chunk_times=64, complevel=5):
+    """
+    Pivot paegan's row oriented results.h5 into a columnar store: one
+    compressed (time x particle) array per variable, chunked along time so a
+    time slice only decompresses the chunks it covers.  Missing values are NaN.
+    """
+    import tables
+
+    with tables.open_file(results_file, mode="r") as h5:
+        table = h5.root.trajectories.model_results
+        times, ti = np.unique(table.col('time'), return_inverse=True)
+        particles, pi = np.unique(table.col('particle'), return_inverse=True)
+
+        shape = (len(times), len(particles))
+        chunkshape = (max(1, min(chunk_times, len(times))), max(1, len(particles)))
+        filters = tables.Filters(complevel=complevel, complib='zlib', shuffle=True)
+
+        tmp_file = store_file + ".tmp"
+        with tables.open_file(tmp_file, mode="w", title="Particle output") as store:
+            store.create_array('/', 'time', times.astype(np.float64))
+            store.create_array('/', 'particle', particles.astype(np.int32))
+
+            for field in FIELDS:
+                grid = np.empty(shape, dtype=np.float32)
+                grid.fill(np.nan)
+                if field in table.colnames:
+                    grid[ti, pi] = table.col(field).astype(np.float32)
+
+                carray = store.create_carray('/', field, tables.Float32Atom(dflt=np.nan), shape, filters=filters, chunkshape=chunkshape)
+                carray[:] = grid
+
+    os.rename(tmp_file, store_file)
+    return store_file
+
+
+def parse_time(value):
+    """
+    Epoch seconds or an ISO8601 UTC timestamp to epoch seconds, None if empty
+    """
+    value = value.strip()
+    if not value:
+        return None
+
+    try:
+        return float(value)
+    except ValueError:
+        pass
+
+    for fmt in ('%Y-%m-%dT%H:%M:%S', '%Y-%m-%dT%H:%M', '%Y-%m-%d'):
+        try:
+            return float(calendar.timegm(datetime.strptime(value.rstrip('Z'), fmt).utctimetuple()))
+        except ValueError:
+            continue
+
+    raise ValueError("Could not parse time '%s'" % value)
+
+
+class ParticleStore(object):
+
+    def __init__(self, path):
+        self.path = path
+
+    def query(self, time=None, bbox=None, fields=None):
+        """
+        Read a slice of the store.
+
+        * time: "start/end" (either side may be empty) or a single time, which
+          selects the nearest model timestep
+        * bbox: (minx, miny, maxx, maxy), values outside of it are masked
+        * fields: list of variables, defaults to all of them
+
+        Returns the epoch times, particle ids and a dict of (time x particle) arrays.
+        """
+        import tables
+
+        fields = fields or FIELDS
+        unknown = [f for f in fields if f not in FIELDS]
+        if unknown:
+            raise ValueError("Unknown fields: %s" % ", ".join(unknown))
+
+        with tables.open_file(self.path, mode="r") as store:
+            times = store.root.time[:]
+            particles = store.root.particle[:]
+
+            start, end = 0, len(times)
+            if time:
+                if '/' in time:
+                    lower, upper = [parse_time(t) for t in time.split('/', 1)]
+                    if lower is not None:
+                        start = int(np.searchsorted(times, lower, side='left'))
+                    if upper is not None:
+                        end = int(np.searchsorted(times, upper, side='right'))
+                elif len(times):
+                    start = int(np.abs(times - parse_time(time)).argmin())
+                    end = start + 1
+
+            # Only the chunks covering [start:end] are read and decompressed
+            data = dict((f, getattr(store.root, f)[start:end, :]) for f in fields)
+
+            if bbox is not None:
+                minx, miny, maxx, maxy = bbox
+                lons = data['longitude'] if 'longitude' in data else store.root.longitude[start:end, :]
+                lats = data['latitude'] if 'latitude' in data else store.root.latitude[start:end, :]
+                outside = ~((lons >= minx) & (lons <= maxx) & (lats >= miny) & (lats <= maxy))
+                for f in data:
+                    data[f][outside] = np.nan
+
+        return times[start:end], particles, data
+
+    def chunks(self, fields, size=256):
+        """
+        Yield (times, particles, data) blocks of at most 'size' timesteps, so a
+        whole run never has to be held in memory.
+        """
+        import tables
+
+        with tables.open_file(self.path, mode="r") as store:
+            times = store.root.time[:]
+            particles = store.root.particle[:]
+            for start in range(0, len(times), size):
+                data = dict((f, getattr(store.root, f)[start:start + size, :]) for f in fields)
+                yield times[start:start + size], particles, data
+
+    def query_json(self, **kwargs):
+        times, particles, data = self.query(**kwargs)
+
+        def to_list(a):
+            # NaN is not valid JSON, send null instead
+            a = a.astype(object)
+            a[np.isnan(a.astype(np.float64))] = None
+            return a.tolist()
+
+        return {
+            'times'     : [datetime.utcfromtimestamp(t).isoformat() for t in times],
+            'particles' : particles.tolist(),
+            'fields'    : dict((f, to_list(v)) for f, v in data.items())
+        }
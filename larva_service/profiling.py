@@ -0,0 +1,127 @@
+import os
+import signal
+import marshal
+import pstats
+import cProfile
+import tempfile
+from collections import Counter
+from contextlib import contextmanager
+
+from larva_service.resources import drain
+
+# Redis list the particle tasks of a run push their profiles onto
+PROFILE_KEY = "larva_service:profile:%s"
+
+# Seconds of CPU time between stack samples
+SAMPLE_INTERVAL = 0.005
+
+
+class Profiler(object):
+    """
+    cProfile for exact per-function totals, plus a SIGPROF stack sampler for
+    collapsed stacks that flamegraph tools read.  Sampling only works on the
+    main thread, elsewhere only the cProfile half runs.
+    """
+
+    def __init__(self, interval=SAMPLE_INTERVAL):
+        self.interval = interval
+        self.stacks = Counter()
+        self._profile = cProfile.Profile()
+        self._previous = None
+        self._sampling = False
+
+    def _sample(self, signum, frame):
+        stack = []
+        while frame is not None:
+            code = frame.f_code
+            stack.append("%s (%s:%d)" % (code.co_name, os.path.basename(code.co_filename), code.co_firstlineno))
+            frame = frame.f_back
+        self.stacks[";".join(reversed(stack))] += 1
+
+    def start(self):
+        try:
+            self._previous = signal.signal(signal.SIGPROF, self._sample)
+        except ValueError:
+            self._sampling = False
+        else:
+            # Restart system calls the sampler interrupts instead of failing them
+            signal.siginterrupt(signal.SIGPROF, False)
+            signal.setitimer(signal.ITIMER_PROF, self.interval, self.interval)
+            self._sampling = True
+        self._profile.enable()
+
+    def stop(self):
+        self._profile.disable()
+        if self._sampling:
+            signal.setitimer(signal.ITIMER_PROF, 0, 0)
+            signal.signal(signal.SIGPROF, self._previous or signal.SIG_DFL)
+            self._sampling = False
+
+    def dumps(self):
+        """
+        The profile as one string, for sending to the run task
+        """
+        self._profile.create_stats()
+        return marshal.dumps((self._profile.stats, dict(self.stacks)))
+
+
+@contextmanager
+def profiled(prefix, enabled=True):
+    """
+    Profile the block and write '<prefix>.pstats' and '<prefix>.collapsed',
+    also when it raises.
+    """
+    if not enabled:
+        yield
+        return
+
+    profiler = Profiler()
+    profiler.start()
+    try:
+        yield
+    finally:
+        profiler.stop()
+        save([profiler.dumps()], prefix)
+
+
+def save(profiles, prefix):
+    """
+    Merge Profiler.dumps() strings into '<prefix>.pstats' and
+    '<prefix>.collapsed'.  Returns the paths written, none if there were no
+    profiles.
+    """
+    stats = None
+    stacks = Counter()
+    for dumped in profiles:
+        raw_stats, raw_stacks = marshal.loads(dumped)
+        stacks.update(raw_stacks)
+
+        # pstats only loads from files
+        f, tmp = tempfile.mkstemp(suffix=".pstats")
+        try:
+            with os.fdopen(f, "wb") as out:
+                marshal.dump(raw_stats, out)
+            if stats is None:
+                stats = pstats.Stats(tmp)
+            else:
+                stats.add(tmp)
+        finally:
+            os.remove(tmp)
+
+    if stats is None:
+        return []
+
+    stats.dump_stats(prefix + ".pstats")
+    with open(prefix + ".collapsed", "w") as f:
+        for stack, count in sorted(stacks.items()):
+            f.write("%s %d\n" % (stack, count))
+
+    return [prefix + ".pstats", prefix + ".collapsed"]
+
+
+def collect(run_id, connection, expected=0, timeout=0):
+    """
+    Pop the profiles the particle tasks of a run have pushed, waiting for
+    'expected' of them (one per task)
+    """
+    return drain(connection, PROFILE_KEY % run_id, expected, timeout)
@@ -0,0 +1,208 @@
+import os
+import json
+import math
+import time
+import signal
+import thread
+import threading
+
+# Redis list the particle tasks of a run push their usage onto
+RESOURCES_KEY = "larva_service:resources:%s"
+
+PAGE_SIZE = os.sysconf("SC_PAGE_SIZE")
+CLOCK_TICKS = float(os.sysconf("SC_CLK_TCK"))
+
+
+class MemoryCeilingExceeded(Exception):
+    pass
+
+
+def _read(path):
+    try:
+        with open(path) as f:
+            return f.read()
+    except (IOError, OSError):
+        # The process exited between listing and reading
+        return None
+
+
+def process_tree(pid):
+    """
+    pid and all of its live descendants
+    """
+    pids = [pid]
+    i = 0
+    while i < len(pids):
+        for tid in os.listdir("/proc/%d/task" % pids[i]) if os.path.exists("/proc/%d/task" % pids[i]) else []:
+            children = _read("/proc/%d/task/%s/children" % (pids[i], tid))
+            if children:
+                pids.extend(int(c) for c in children.split())
+        i += 1
+    return pids
+
+
+def sample(pid):
+    """
+    RSS bytes, CPU seconds and I/O bytes of a process tree.  CPU time and I/O
+    of descendants that already exited are included through their parents'
+    child totals.
+    """
+    usage = { 'rss_bytes' : 0, 'cpu_seconds' : 0., 'read_bytes' : 0, 'write_bytes' : 0 }
+    for p in process_tree(pid):
+        statm = _read("/proc/%d/statm" % p)
+        stat = _read("/proc/%d/stat" % p)
+        if statm is None or stat is None:
+            continue
+        usage['rss_bytes'] += int(statm.split()[1]) * PAGE_SIZE
+
+        # Fields after the parenthesised command name, utime is the 14th field overall
+        fields = stat.rsplit(")", 1)[1].split()
+        usage['cpu_seconds'] += sum(int(v) for v in fields[11:15]) / CLOCK_TICKS
+
+        io = _read("/proc/%d/io" % p)
+        if io:
+            values = dict(line.split(": ") for line in io.splitlines() if ": " in line)
+            usage['read_bytes'] += int(values.get('read_bytes', 0))
+            usage['write_bytes'] += int(values.get('write_bytes', 0))
+    return usage
+
+
+class ResourceMonitor(object):
+    """
+    Samples the usage of this process and its descendants on a background
+    thread.  If 'ceiling_mb' is set and the tree's RSS goes over it, the
+    descendants are terminated and MemoryCeilingExceeded is raised in the
+    main thread, so the task fails like any other error instead of being
+    killed by the kernel.
+
+    A main thread blocked waiting on a lock (like a distributed run joining
+    paegan's result listener) only handles the signal once it wakes up, so
+    'on_exceeded' is called from the monitor thread first to wake it.
+    """
+
+    def __init__(self, ceiling_mb=None, interval=1.0, on_exceeded=None):
+        self.ceiling_mb = ceiling_mb
+        self.on_exceeded = on_exceeded
+        self.interval = interval
+        self.pid = os.getpid()
+        self.peak_rss_bytes = 0
+        self.exceeded = None
+        self._start = None
+        self._last = None
+        self._stop = threading.Event()
+        self._thread = None
+        self._previous = None
+        self._signals = False
+
+    def _raise(self, signum, frame):
+        raise MemoryCeilingExceeded(self.exceeded)
+
+    def _sample(self):
+        usage = sample(self.pid)
+        self._last = usage
+        self.peak_rss_bytes = max(self.peak_rss_bytes, usage['rss_bytes'])
+        return usage
+
+    def _check(self):
+        usage = self._sample()
+        if self.ceiling_mb and self.exceeded is None and usage['rss_bytes'] > self.ceiling_mb * 1024 * 1024:
+            self.exceeded = "Memory ceiling of %d MB exceeded (%d MB in use)" % (self.ceiling_mb, usage['rss_bytes'] / 1024 / 1024)
+            for p in process_tree(self.pid)[1:]:
+                try:
+                    os.kill(p, signal.SIGTERM)
+                except OSError:
+                    pass
+            if self.on_exceeded is not None:
+                try:
+                    self.on_exceeded()
+                except Exception:
+                    pass
+            if self._signals:
+                os.kill(self.pid, signal.SIGUSR1)
+            else:
+                thread.interrupt_main()
+
+    def _watch(self):
+        while not self._stop.wait(self.interval):
+            self._check()
+
+    def start(self):
+        try:
+            self._previous = signal.signal(signal.SIGUSR1, self._raise)
+            self._signals = True
+        except ValueError:
+            # Not on the main thread, fall back to a KeyboardInterrupt there
+            self._signals = False
+        self._start = sample(self.pid)
+        self._last = self._start
+        self.peak_rss_bytes = self._start['rss_bytes']
+        self._thread = threading.Thread(name="ResourceMonitor", target=self._watch)
+        self._thread.daemon = True
+        self._thread.start()
+
+    def stop(self):
+        self._stop.set()
+        self._thread.join()
+        if self._signals:
+            signal.signal(signal.SIGUSR1, self._previous or signal.SIG_DFL)
+            self._signals = False
+        # Totals since the last sample, without enforcing the ceiling now the handler is gone
+        self._sample()
+        return self.usage()
+
+    def usage(self):
+        return {
+            'peak_rss_mb'     : round(self.peak_rss_bytes / 1024. / 1024., 1),
+            'cpu_seconds'     : round(self._last['cpu_seconds'] - self._start['cpu_seconds'], 2),
+            'read_bytes'      : self._last['read_bytes'] - self._start['read_bytes'],
+            'write_bytes'     : self._last['write_bytes'] - self._start['write_bytes'],
+            'ceiling_mb'      : self.ceiling_mb,
+            'exceeded'        : self.exceeded is not None,
+        }
+
+
+def summarize_tasks(usages):
+    """
+    Combined usage of a run's particle tasks
+    """
+    if not usages:
+        return None
+    return {
+        'tasks'           : len(usages),
+        'peak_rss_mb'     : max(u['peak_rss_mb'] for u in usages),
+        'cpu_seconds'     : round(sum(u['cpu_seconds'] for u in usages), 2),
+        'read_bytes'      : sum(u['read_bytes'] for u in usages),
+        'write_bytes'     : sum(u['write_bytes'] for u in usages),
+        'exceeded'        : sum(1 for u in usages if u['exceeded']),
+    }
+
+
+def drain(connection, key, expected=0, timeout=0):
+    """
+    Pop everything pushed onto the list 'key', waiting up to 'timeout'
+    seconds for at least 'expected' entries.  Particle tasks push after
+    their results are published, so the run can get to it first.
+    """
+    entries = []
+    deadline = time.time() + timeout
+    while len(entries) < expected:
+        remaining = int(math.ceil(deadline - time.time()))
+        if remaining <= 0:
+            break
+        popped = connection.blpop(key, remaining)
+        if popped is None:
+            break
+        entries.append(popped[1])
+
+    pipe = connection.pipeline()
+    pipe.lrange(key, 0, -1)
+    pipe.delete(key)
+    return entries + pipe.execute()[0]
+
+
+def collect_usage(run_id, connection, expected=0, timeout=0):
+    """
+    Pop the usage the particle tasks of a run have pushed, waiting for
+    'expected' of them (one per task)
+    """
+    return [json.loads(u) for u in drain(connection, RESOURCES_KEY % run_id, expected, timeout)]
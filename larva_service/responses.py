@@ -0,0 +1,148 @@
+"""
+Conditional GET and a response cache shared by every web worker.
+
+Responses are cached in Redis under the request's URL and the versions of
+the documents they were built from.  Saving or deleting a document bumps
+its version (and its collection's), so the next request builds a fresh
+response and stale ones expire on their own.  Every response carries an
+ETag, and a Last-Modified when it is built from a single document, so
+clients can revalidate with a 304 instead of downloading it again.
+"""
+import hashlib
+import calendar
+import cPickle as pickle
+from datetime import datetime
+
+from flask import request, current_app, Response
+
+from larva_service import redis_connection
+from larva_service.compression import COMPRESSIBLE, MIN_BYTES, gzip_bytes, accepts
+
+VERSION_KEY = "larva_service:version:%s"
+RESPONSE_KEY = "larva_service:response:%s"
+
+# Cache-Control for responses that can still change and for ones that never will
+REVALIDATE = "no-cache"
+IMMUTABLE = "public, max-age=%d, immutable"
+
+
+def versions(names):
+    if not names:
+        return ""
+    return "-".join(v or "0" for v in redis_connection.mget([VERSION_KEY % n for n in names]))
+
+
+def invalidate(*names):
+    """
+    Drop the cached responses built from any of 'names', like "runs" for
+    every run listing or "runs:<id>" for the responses of a single run
+    """
+    pipe = redis_connection.pipeline(transaction=False)
+    for n in names:
+        pipe.incr(VERSION_KEY % n)
+    pipe.execute()
+
+
+def etag(*parts):
+    return hashlib.sha1("\0".join(p if isinstance(p, str) else unicode(p).encode('utf-8') for p in parts)).hexdigest()
+
+
+def timestamp(value):
+    if isinstance(value, datetime):
+        return calendar.timegm(value.utctimetuple())
+    return None
+
+
+class Cached(object):
+    """
+    What a view returns to cached(): the response, and how it may be reused
+
+    * last_modified: when the document the response was built from changed
+    * final: the response will not change again (finished runs), clients
+      may keep it for FINAL_MAX_AGE seconds without revalidating
+    * live: the response changes without its documents being saved (like
+      the status of a running run), only cached for RESPONSE_CACHE_LIVE_SECONDS
+    * validator: what the ETag is derived from, the response body if None
+    """
+
+    def __init__(self, response, last_modified=None, final=False, live=False, validator=None):
+        self.response = response
+        self.last_modified = last_modified
+        self.final = final
+        self.live = live
+        self.validator = validator
+
+
+def cached(names, build):
+    """
+    The response to this request, from the shared cache while none of
+    'names' changed, otherwise from build(), which returns a Cached.
+    Conditional requests get a 304 when their validators still match.
+
+    Streamed responses (listings) are never held in memory or cached.  Their
+    ETag comes from the versions of 'names', so only the ETag is kept, to
+    answer conditional requests without building anything.
+    """
+    config = current_app.config
+    key = RESPONSE_KEY % etag(request.full_path, versions(names))
+
+    entry = None
+    if config.get('RESPONSE_CACHE_SECONDS'):
+        data = redis_connection.get(key)
+        if data is not None:
+            entry = pickle.loads(data)
+
+    if entry is not None and entry[0] is None:
+        # A streamed response, built again unless the client has it
+        _, _, mimetype, tag, last_modified, cache_control = entry
+        if tag in request.if_none_match:
+            return _conditional(Response(mimetype=mimetype), tag, last_modified, cache_control)
+        entry = None
+
+    if entry is None:
+        result = build()
+        response = result.response
+        if not isinstance(response, Response) or response.status_code != 200:
+            # Errors and redirects are never cached
+            return response
+
+        cache_control = IMMUTABLE % config['FINAL_MAX_AGE'] if result.final else REVALIDATE
+        timeout = config.get('RESPONSE_CACHE_SECONDS')
+        if result.live:
+            timeout = min(timeout, config.get('RESPONSE_CACHE_LIVE_SECONDS'))
+
+        if response.is_streamed:
+            if result.live:
+                # Changes without its documents changing, no ETag describes it
+                response.headers['Cache-Control'] = REVALIDATE
+                return response
+            tag = etag(key, result.validator if result.validator is not None else "")
+            entry = (None, None, response.mimetype, tag, timestamp(result.last_modified), cache_control)
+            if timeout:
+                redis_connection.setex(key, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), int(timeout))
+            return _conditional(response, tag, entry[4], cache_control)
+
+        body = response.get_data()
+        tag = etag(key, result.validator if result.validator is not None else body)
+        # Kept gzipped too, so hits don't compress the same body over and over
+        gzipped = gzip_bytes(body) if response.mimetype in COMPRESSIBLE and len(body) >= MIN_BYTES else None
+        entry = (body, gzipped, response.mimetype, tag, timestamp(result.last_modified), cache_control)
+        if timeout:
+            redis_connection.setex(key, pickle.dumps(entry, pickle.HIGHEST_PROTOCOL), int(timeout))
+
+    body, gzipped, mimetype, tag, last_modified, cache_control = entry
+    response = Response(body, mimetype=mimetype)
+    if gzipped is not None:
+        response.vary.add('Accept-Encoding')
+        if accepts('gzip'):
+            response.set_data(gzipped)
+            response.headers['Content-Encoding'] = 'gzip'
+    return _conditional(response, tag, last_modified, cache_control)
+
+
+def _conditional(response, tag, last_modified, cache_control):
+    response.set_etag(tag)
+    if last_modified is not None:
+        response.last_modified = last_modified
+    response.headers['Cache-Control'] = cache_control
+    return response.make_conditional(request)
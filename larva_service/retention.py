@@ -0,0 +1,270 @@
+import os
+import time
+import calendar
+import shutil
+from datetime import datetime, timedelta
+from urlparse import urlparse
+
+from bson.objectid import ObjectId
+from rq.job import Job
+
+from larva_service.hydro_cache import referenced, local_path
+
+# Sorted set of run ids scored by when their output was last viewed or downloaded
+ACCESS_KEY = "larva_service:run_access"
+LOCK_KEY = "larva_service:retention"
+
+# Runs that are neither finished nor known to rq are left alone this long after being created
+IN_FLIGHT_SECONDS = 2 * 24 * 60 * 60
+# Directories without a run are left alone this long after they last changed
+ORPHAN_SECONDS = 60 * 60
+
+GB = 1024 * 1024 * 1024
+
+
+def du(path):
+    """
+    Bytes used by a file or everything under a directory
+    """
+    if not os.path.exists(path):
+        return 0
+    if not os.path.isdir(path):
+        return os.lstat(path).st_size
+    total = 0
+    for root, dirs, files in os.walk(path):
+        for f in files:
+            try:
+                total += os.lstat(os.path.join(root, f)).st_size
+            except OSError:
+                pass
+    return total
+
+
+def run_ids(path):
+    """
+    Run directories in 'path', leaving out the shared ones like the
+    bathymetry grid, shoreline indexes and particle stores
+    """
+    if not os.path.isdir(path):
+        return []
+    return [d for d in os.listdir(path) if ObjectId.is_valid(d) and os.path.isdir(os.path.join(path, d))]
+
+
+def touch(connection, run_id):
+    connection.execute_command('ZADD', ACCESS_KEY, time.time(), str(run_id))
+
+
+def in_flight(run, connection, now=None):
+    if run.task_result:
+        return False
+    if run.task_id and Job.exists(run.task_id, connection=connection):
+        return Job.fetch(run.task_id, connection=connection).get_status() in ("queued", "started", "deferred")
+    # The job is gone without the run recording an outcome, give it the benefit of the doubt for a while
+    now = now or datetime.utcnow()
+    return run.created is None or now - run.created < timedelta(seconds=IN_FLIGHT_SECONDS)
+
+
+def last_used(run, accessed, policy):
+    """
+    Timestamp runs are evicted in order of, oldest first
+    """
+    finished = run.ended if isinstance(run.ended, datetime) else run.created
+    finished = calendar.timegm(finished.timetuple()) if isinstance(finished, datetime) else 0
+    if policy == "lru":
+        return max(finished, accessed or 0)
+    return finished
+
+
+class Retention(object):
+    """
+    Keeps OUTPUT_PATH and CACHE_PATH under their quotas by deleting the
+    output and caches of finished runs, least recently used (or oldest, with
+    the "age" policy) first.  Runs older than 'max_age_days' are deleted
+    whatever the quota.  Runs still queued or running are never touched, and
+    runs whose output is deleted have it removed from their output list.
+    """
+
+    def __init__(self, db, connection, output_path, cache_path, particle_store_path=None, hydro_cache_path=None,
+                 output_quota_gb=None, cache_quota_gb=None, policy="lru", max_age_days=None):
+        self.db = db
+        self.connection = connection
+        self.output_path = output_path
+        self.cache_path = cache_path
+        self.particle_store_path = particle_store_path
+        self.hydro_cache_path = hydro_cache_path
+        self.output_quota = output_quota_gb * GB if output_quota_gb else None
+        self.cache_quota = cache_quota_gb * GB if cache_quota_gb else None
+        self.policy = policy
+        self.max_age = timedelta(days=max_age_days) if max_age_days else None
+
+    def particle_store(self, run_id):
+        if self.particle_store_path is None:
+            return None
+        return os.path.join(self.particle_store_path, run_id + ".h5")
+
+    def density_cache(self, run_id):
+        store = self.particle_store(run_id)
+        return None if store is None else store + ".density"
+
+    def usage(self):
+        """
+        Bytes used by the output and caches of every run, as
+        { run_id : { 'output_bytes' : ..., 'cache_bytes' : ... } }
+        """
+        sizes = {}
+        for run_id in run_ids(self.output_path):
+            sizes.setdefault(run_id, { 'output_bytes' : 0, 'cache_bytes' : 0 })['output_bytes'] += du(os.path.join(self.output_path, run_id))
+        if self.particle_store_path is not None and os.path.isdir(self.particle_store_path):
+            for filename in os.listdir(self.particle_store_path):
+                # Density grids cached next to a store count with it
+                store = filename[:-len(".density")] if filename.endswith(".density") else filename
+                run_id, ext = os.path.splitext(store)
+                if ext == ".h5" and ObjectId.is_valid(run_id):
+                    sizes.setdefault(run_id, { 'output_bytes' : 0, 'cache_bytes' : 0 })['output_bytes'] += du(os.path.join(self.particle_store_path, filename))
+        for run_id in run_ids(self.cache_path):
+            sizes.setdefault(run_id, { 'output_bytes' : 0, 'cache_bytes' : 0 })['cache_bytes'] += du(os.path.join(self.cache_path, run_id))
+        return sizes
+
+    def summary(self, sizes=None):
+        sizes = self.usage() if sizes is None else sizes
+        summary = {}
+        for name, path, quota, key in [("output", self.output_path, self.output_quota, 'output_bytes'), ("cache", self.cache_path, self.cache_quota, 'cache_bytes')]:
+            free = None
+            if os.path.isdir(path):
+                st = os.statvfs(path)
+                free = st.f_bavail * st.f_frsize
+            summary[name] = {
+                'path'            : path,
+                'runs'            : sum(1 for s in sizes.values() if s[key]),
+                'used_bytes'      : sum(s[key] for s in sizes.values()),
+                'quota_bytes'     : quota,
+                'free_bytes'      : free,
+            }
+        return summary
+
+    def evict_output(self, run_id, run=None):
+        shutil.rmtree(os.path.join(self.output_path, run_id), ignore_errors=True)
+        store = self.particle_store(run_id)
+        if store is not None and os.path.exists(store):
+            os.remove(store)
+        if store is not None:
+            shutil.rmtree(self.density_cache(run_id), ignore_errors=True)
+
+        if run is not None:
+            # The run's reference to the forcing data it shares with other runs goes with its output
+            digest = run.hydro_cache
+            shared = local_path(digest, self.hydro_cache_path) if digest and self.hydro_cache_path else None
+            if shared in run.output:
+                run.hydro_cache = u''
+
+            # Files uploaded to S3 are still there
+            run.output = [f for f in run.output if f != shared and (urlparse(f).scheme != '' or os.path.exists(f))]
+            if run.particle_store and not os.path.exists(run.particle_store):
+                run.particle_store = u''
+            disk = dict(run.disk or {})
+            disk['output_bytes'] = 0
+            disk['evicted'] = datetime.utcnow()
+            run.disk = disk
+            run.save()
+
+            if shared is not None and not run.hydro_cache and not referenced(digest, self.db) and os.path.exists(shared):
+                os.remove(shared)
+
+    def release_hydro_caches(self):
+        """
+        Delete stored forcing data no run references anymore, like that of
+        deleted runs
+        """
+        if self.hydro_cache_path is None or not os.path.isdir(self.hydro_cache_path):
+            return
+        for filename in os.listdir(self.hydro_cache_path):
+            digest, ext = os.path.splitext(filename)
+            path = os.path.join(self.hydro_cache_path, filename)
+            # Skip caches being written
+            if ext != ".nc" or time.time() - os.path.getmtime(path) < ORPHAN_SECONDS:
+                continue
+            if not referenced(digest, self.db):
+                os.remove(path)
+
+    def evict_cache(self, run_id, run=None):
+        shutil.rmtree(os.path.join(self.cache_path, run_id), ignore_errors=True)
+        if run is not None:
+            disk = dict(run.disk or {})
+            disk['cache_bytes'] = 0
+            run.disk = disk
+            run.save()
+
+    def enforce(self, now=None):
+        """
+        Delete what has to go, returning the ids of the runs whose output or
+        cache was deleted
+        """
+        now = now or datetime.utcnow()
+        sizes = self.usage()
+        accessed = dict((k, float(v)) for k, v in self.connection.zrange(ACCESS_KEY, 0, -1, withscores=True))
+
+        candidates = []
+        for run_id in sizes:
+            run = self.db.Run.find_one({ '_id' : ObjectId(run_id) })
+            if run is None:
+                # Deleted runs, once nothing has written to them for a while
+                paths = [os.path.join(self.output_path, run_id), os.path.join(self.cache_path, run_id)]
+                changed = max(os.path.getmtime(p) for p in paths if os.path.exists(p)) if any(os.path.exists(p) for p in paths) else 0
+                if time.time() - changed > ORPHAN_SECONDS:
+                    candidates.append((-1, run_id, None))
+            elif not in_flight(run, self.connection, now=now):
+                candidates.append((last_used(run, accessed.get(run_id), self.policy), run_id, run))
+        candidates.sort(key=lambda c: c[0])
+
+        evicted = set()
+        output_used = sum(s['output_bytes'] for s in sizes.values())
+        cache_used = sum(s['cache_bytes'] for s in sizes.values())
+        cutoff = calendar.timegm((now - self.max_age).timetuple()) if self.max_age else None
+
+        for used_at, run_id, run in candidates:
+            expired = run is None or (cutoff is not None and used_at < cutoff)
+
+            # Empty directories left behind go too
+            cache_dir = os.path.join(self.cache_path, run_id)
+            if os.path.isdir(cache_dir) and (expired or not sizes[run_id]['cache_bytes'] or (self.cache_quota and cache_used > self.cache_quota)):
+                self.evict_cache(run_id, run)
+                cache_used -= sizes[run_id]['cache_bytes']
+                evicted.add(run_id)
+
+            output_dir = os.path.join(self.output_path, run_id)
+            if sizes[run_id]['output_bytes'] and (expired or (self.output_quota and output_used > self.output_quota)):
+                self.evict_output(run_id, run)
+                output_used -= sizes[run_id]['output_bytes']
+                evicted.add(run_id)
+                self.connection.zrem(ACCESS_KEY, run_id)
+            elif os.path.isdir(output_dir) and not sizes[run_id]['output_bytes']:
+                shutil.rmtree(output_dir, ignore_errors=True)
+
+        self.release_hydro_caches()
+        return evicted
+
+
+def from_config(config, db, connection):
+    return Retention(db,
+                     connection,
+                     config['OUTPUT_PATH'],
+                     config['CACHE_PATH'],
+                     particle_store_path=config.get('PARTICLE_STORE_PATH'),
+                     hydro_cache_path=config.get('HYDRO_CACHE_PATH'),
+                     output_quota_gb=config.get('OUTPUT_QUOTA_GB'),
+                     cache_quota_gb=config.get('CACHE_QUOTA_GB'),
+                     policy=config.get('RETENTION_POLICY', "lru"),
+                     max_age_days=config.get('RETENTION_DAYS'))
+
+
+def enforce(config, db, connection):
+    """
+    Enforce retention unless another worker already is
+    """
+    lock = connection.lock(LOCK_KEY, timeout=3600)
+    if not lock.acquire(blocking=False):
+        return set()
+    try:
+        return from_config(config, db, connection).enforce()
+    finally:
+        lock.release()
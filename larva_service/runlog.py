@@ -0,0 +1,183 @@
+import re
+import gzip
+import time
+import logging
+import threading
+import collections
+
+# Redis list holding the last lines of a run's log, for the run page
+TAIL_KEY = "larva_service:log_tail:%s"
+TAIL_TTL = 7 * 24 * 60 * 60
+
+
+class RateLimitFilter(logging.Filter):
+    """
+    Lets through at most 'burst' records of each kind of message every
+    'interval' seconds and notes how many were dropped on the next one let
+    through.  Kinds are messages with their numbers blanked, so the same
+    message about different particles or positions counts together.
+    Progress records, warnings and errors always pass.
+    """
+
+    NUMBERS = re.compile(r"[-+]?\d+(\.\d+)?")
+
+    def __init__(self, burst=20, interval=10., max_kinds=10000):
+        logging.Filter.__init__(self)
+        self.burst = burst
+        self.interval = interval
+        self.max_kinds = max_kinds
+        self._kinds = {}
+        self._lock = threading.Lock()
+
+    def filter(self, record):
+        if record.levelno >= logging.WARNING or record.levelno == getattr(logging, 'PROGRESS', None):
+            return True
+
+        try:
+            message = record.getMessage()
+        except Exception:
+            return True
+
+        key = (record.name, record.levelno, self.NUMBERS.sub("#", message))
+        now = time.time()
+        with self._lock:
+            state = self._kinds.get(key)
+            if state is None:
+                if len(self._kinds) >= self.max_kinds:
+                    self._kinds.clear()
+                # passed in this window, window start, dropped since the last one passed
+                state = self._kinds[key] = [0, now, 0]
+
+            if now - state[1] >= self.interval:
+                state[0] = 0
+                state[1] = now
+
+            state[0] += 1
+            if state[0] > self.burst:
+                state[2] += 1
+                return False
+
+            dropped = state[2]
+            state[2] = 0
+
+        if dropped:
+            record.msg = "%s (%d similar messages dropped)" % (message, dropped)
+            record.args = ()
+        return True
+
+
+def rate_limit(logger, burst=20, interval=10.):
+    """
+    Install a RateLimitFilter on 'logger', replacing any earlier one.  Filters
+    on a logger run before its handlers, so dropped records never reach a
+    queue or pub/sub channel, and forked processes inherit it.
+    """
+    for f in list(logger.filters):
+        if isinstance(f, RateLimitFilter):
+            logger.removeFilter(f)
+    f = RateLimitFilter(burst=burst, interval=interval)
+    logger.addFilter(f)
+    return f
+
+
+class RunLogHandler(logging.Handler):
+    """
+    Writes a run's log gzip compressed, in batches of 'batch' lines or every
+    'interval' seconds, and keeps the last 'tail' lines in memory and, when
+    given a connection, in a capped Redis list for the run page.
+    """
+
+    def __init__(self, path, connection=None, key=None, tail=200, batch=500, interval=2.):
+        logging.Handler.__init__(self)
+        self.path = path
+        self.connection = connection
+        self.key = key
+        self.batch = batch
+        self.interval = interval
+        self.tail = collections.deque(maxlen=tail)
+        self._file = gzip.open(path, "ab", 6)
+        self._pending = []
+        self._last = time.time()
+
+    def emit(self, record):
+        try:
+            line = self.format(record)
+        except Exception:
+            self.handleError(record)
+            return
+        self.write_lines([line])
+
+    def write_lines(self, lines):
+        self.acquire()
+        try:
+            lines = [l.encode("utf-8") if isinstance(l, unicode) else l for l in lines]
+            self._pending.extend(lines)
+            self.tail.extend(lines)
+            if len(self._pending) >= self.batch or time.time() - self._last >= self.interval:
+                self._flush()
+        finally:
+            self.release()
+
+    def _flush(self):
+        if self._pending:
+            self._file.write("".join(l + "\n" for l in self._pending))
+            if self.connection is not None and self.key is not None:
+                pipe = self.connection.pipeline(transaction=False)
+                pipe.rpush(self.key, *self._pending[-self.tail.maxlen:])
+                pipe.ltrim(self.key, -self.tail.maxlen, -1)
+                pipe.expire(self.key, TAIL_TTL)
+                pipe.execute()
+            self._pending = []
+        self._last = time.time()
+
+    def flush(self):
+        self.acquire()
+        try:
+            self._flush()
+        finally:
+            self.release()
+
+    def close(self):
+        self.acquire()
+        try:
+            if not self._file.closed:
+                self._flush()
+                self._file.close()
+        finally:
+            self.release()
+        logging.Handler.close(self)
+
+
+def follow(path, handler, stop, interval=0.5):
+    """
+    Pass lines appended to 'path' to handler.write_lines until stop()
+    returns True, then pass whatever is left.  For logs written by code that
+    owns its own file, like paegan's multiprocessing log handler.
+    """
+    position = 0
+    partial = ""
+    while True:
+        done = stop()
+        try:
+            with open(path) as f:
+                f.seek(position)
+                data = f.read()
+                position = f.tell()
+        except IOError:
+            data = ""
+
+        if data:
+            lines = (partial + data).split("\n")
+            partial = lines.pop()
+            if lines:
+                handler.write_lines(lines)
+
+        if done:
+            if partial:
+                handler.write_lines([partial])
+            return
+        time.sleep(interval)
+
+
+def tail(run_id, connection):
+    return connection.lrange(TAIL_KEY % run_id, 0, -1)
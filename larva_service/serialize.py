@@ -0,0 +1,69 @@
+import json
+import calendar
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from flask import Response, stream_with_context
+
+# Streamed responses are written in pieces of about this many bytes
+STREAM_BYTES = 64 * 1024
+
+
+def _default(obj):
+    if isinstance(obj, datetime):
+        # Milliseconds since the epoch, as MongoKit's to_json() wrote them
+        return calendar.timegm(obj.utctimetuple()) * 1000 + obj.microsecond // 1000
+    if isinstance(obj, ObjectId):
+        return unicode(obj)
+    raise TypeError("%r is not JSON serializable" % obj)
+
+_encoder = json.JSONEncoder(default=_default, separators=(',', ':'))
+
+
+def dumps(obj):
+    return _encoder.encode(obj)
+
+
+def projection(fields):
+    """
+    Mongo projection loading only 'fields' (and _id)
+    """
+    return dict((f, True) for f in fields)
+
+
+def api_document(doc, fields):
+    """
+    The whitelisted 'fields' of a raw or MongoKit document, and its _id as a
+    string, ready for dumps()
+    """
+    js = dict((f, doc.get(f)) for f in fields)
+    js['_id'] = unicode(doc['_id'])
+    return js
+
+
+def response(obj, status=200):
+    return Response(dumps(obj), status=status, mimetype='application/json')
+
+
+def stream(key, items):
+    """
+    Response of { key : [item, ...] }, encoding 'items' as they are read
+    from the cursor instead of building the whole list first
+    """
+    def generate():
+        buf = ['{"%s":[' % key]
+        size = 0
+        first = True
+        for item in items:
+            piece = dumps(item)
+            buf.append(piece if first else ',' + piece)
+            first = False
+            size += len(piece)
+            if size >= STREAM_BYTES:
+                yield ''.join(buf)
+                buf = []
+                size = 0
+        buf.append(']}')
+        yield ''.join(buf)
+
+    return Response(stream_with_context(generate()), mimetype='application/json')
@@ -0,0 +1,231 @@
+import os
+import json
+import math
+import shutil
+import tempfile
+
+import numpy as np
+from shapely import wkb, wkt
+from shapely.geometry import Polygon, MultiPolygon
+
+from larva_service import app, db
+
+# Indexes already opened by this process, keyed by index path
+_indexes = {}
+
+# Shoreline paths with an index installed into paegan, see use_shoreline_index
+_installed = {}
+_indexed_shoreline = None
+
+
+class ShorelineIndex(object):
+    """
+    A packed, two level R-tree over shoreline polygons.  Polygons are ordered
+    with Sort-Tile-Recursive packing and grouped into fixed size leaf nodes,
+    so a bounding box query only tests the polygons under matching nodes.
+    All arrays are memory mapped, loading an index takes milliseconds.
+    """
+
+    def __init__(self, path):
+        self.path = path
+        with open(os.path.join(path, "index.json"), "r") as f:
+            self.meta = json.load(f)
+        self.node_size = self.meta['node_size']
+        self.bounds = tuple(self.meta['bounds'])
+        self.nodes = np.load(os.path.join(path, "nodes.npy"), mmap_mode='r')
+        self.boxes = np.load(os.path.join(path, "boxes.npy"), mmap_mode='r')
+        self.offsets = np.load(os.path.join(path, "offsets.npy"), mmap_mode='r')
+        self.wkb = np.load(os.path.join(path, "wkb.npy"), mmap_mode='r')
+
+    def __len__(self):
+        return len(self.boxes)
+
+    def candidates(self, bounds):
+        """
+        Indexes of the polygons whose bounding boxes intersect 'bounds',
+        either a (minx, miny, maxx, maxy) tuple or a WKT string.
+        """
+        if isinstance(bounds, basestring):
+            bounds = wkt.loads(bounds).bounds
+        minx, miny, maxx, maxy = bounds
+
+        def overlaps(b):
+            return (b[:, 0] <= maxx) & (b[:, 2] >= minx) & (b[:, 1] <= maxy) & (b[:, 3] >= miny)
+
+        hits = []
+        for node in np.flatnonzero(overlaps(self.nodes)):
+            start = node * self.node_size
+            leaf = self.boxes[start:start + self.node_size]
+            hits.append(np.flatnonzero(overlaps(leaf)) + start)
+
+        if not hits:
+            return np.array([], dtype=np.intp)
+        return np.concatenate(hits)
+
+    def query(self, bounds):
+        return [self.geometry(i) for i in self.candidates(bounds)]
+
+    def geometry(self, i):
+        return wkb.loads(self.wkb[self.offsets[i]:self.offsets[i + 1]].tostring())
+
+
+def str_order(boxes, node_size):
+    """
+    Sort-Tile-Recursive ordering: vertical slices by x center, each sorted by y center
+    """
+    count = len(boxes)
+    cx = (boxes[:, 0] + boxes[:, 2]) / 2.
+    cy = (boxes[:, 1] + boxes[:, 3]) / 2.
+
+    leaves = int(math.ceil(count / float(node_size)))
+    slices = max(1, int(math.ceil(math.sqrt(leaves))))
+    per_slice = int(math.ceil(leaves / float(slices))) * node_size
+
+    by_x = np.argsort(cx, kind='mergesort')
+    order = []
+    for start in range(0, count, per_slice):
+        chunk = by_x[start:start + per_slice]
+        order.append(chunk[np.argsort(cy[chunk], kind='mergesort')])
+
+    return np.concatenate(order)
+
+
+def build_index(geoms, path, node_size=64):
+    """
+    Pack shapely (Multi)Polygons into a ShorelineIndex at 'path' (a directory).
+    Returns build statistics.
+    """
+    polys = []
+    for geom in geoms:
+        if isinstance(geom, Polygon):
+            polys.append(geom)
+        elif isinstance(geom, MultiPolygon):
+            polys.extend(list(geom))
+
+    if not polys:
+        raise ValueError("No polygons to index")
+
+    boxes = np.array([p.bounds for p in polys], dtype=np.float64)
+    order = str_order(boxes, node_size)
+    boxes = boxes[order]
+
+    blobs = [polys[i].wkb for i in order]
+    offsets = np.zeros(len(blobs) + 1, dtype=np.int64)
+    offsets[1:] = np.cumsum([len(b) for b in blobs])
+    data = np.frombuffer(b"".join(blobs), dtype=np.uint8)
+
+    starts = np.arange(0, len(boxes), node_size)
+    nodes = np.column_stack((np.minimum.reduceat(boxes[:, 0], starts),
+                             np.minimum.reduceat(boxes[:, 1], starts),
+                             np.maximum.reduceat(boxes[:, 2], starts),
+                             np.maximum.reduceat(boxes[:, 3], starts)))
+
+    meta = {
+        'node_size' : node_size,
+        'features'  : len(polys),
+        'vertices'  : int(sum(len(p.exterior.coords) for p in polys)),
+        'bounds'    : [float(boxes[:, 0].min()), float(boxes[:, 1].min()), float(boxes[:, 2].max()), float(boxes[:, 3].max())]
+    }
+
+    parent = os.path.dirname(os.path.normpath(path))
+    if not os.path.exists(parent):
+        os.makedirs(parent)
+
+    # Write everything into a sibling directory and swap it in at the end
+    tmp = tempfile.mkdtemp(dir=parent)
+    np.save(os.path.join(tmp, "nodes.npy"), nodes)
+    np.save(os.path.join(tmp, "boxes.npy"), boxes)
+    np.save(os.path.join(tmp, "offsets.npy"), offsets)
+    np.save(os.path.join(tmp, "wkb.npy"), data)
+    with open(os.path.join(tmp, "index.json"), "w") as f:
+        json.dump(meta, f)
+    os.chmod(tmp, 0755)
+
+    shutil.rmtree(path, ignore_errors=True)
+    os.rename(tmp, path)
+    _indexes.pop(path, None)
+
+    meta['bytes'] = sum(os.path.getsize(os.path.join(path, f)) for f in os.listdir(path))
+    return meta
+
+
+def load_index(path):
+    index = _indexes.get(path)
+    if index is None:
+        index = ShorelineIndex(path)
+        _indexes[path] = index
+    return index
+
+
+def _indexed_shoreline_class():
+    # paegan is only imported by the workers, so the subclass is built on first use
+    global _indexed_shoreline
+    if _indexed_shoreline is not None:
+        return _indexed_shoreline
+
+    from paegan.transport.shoreline import Shoreline, ShorelineFile
+
+    class IndexedShoreline(ShorelineFile):
+        """
+        paegan ShorelineFile that answers spatial queries from a ShorelineIndex
+        instead of re-reading the shapefile or WFS server for every forcer.
+        """
+
+        def __new__(cls, **kwargs):
+            return object.__new__(cls)
+
+        def __init__(self, index=None, path=None, **kwargs):
+            self._index = index
+            self._file = os.path.normpath(path) if path else index.path
+            Shoreline.__init__(self, **kwargs)
+
+        def close(self):
+            pass
+
+        def get_capabilities(self):
+            from shapely.geometry import box
+            return { 'LatLongBoundingBox' : box(*self._index.bounds), 'Name' : os.path.basename(self._file).split('.')[0] }
+
+        def get_geoms_for_bounds(self, bounds):
+            return self._index.query(bounds)
+
+    _indexed_shoreline = IndexedShoreline
+    return _indexed_shoreline
+
+
+def _shoreline_factory(**kwargs):
+    from paegan.transport.shoreline import Shoreline
+
+    index_path = _installed.get(os.path.normpath(kwargs.get('path') or ''))
+    if index_path is None:
+        return Shoreline(**kwargs)
+
+    try:
+        index = load_index(index_path)
+    except Exception:
+        app.logger.exception("Could not load shoreline index %s" % index_path)
+        return Shoreline(**kwargs)
+
+    return _indexed_shoreline_class()(index=index, **kwargs)
+
+
+def use_shoreline_index(shoreline_path, shoreline_feature=None):
+    """
+    If the shoreline at 'shoreline_path' was indexed when it was imported,
+    make paegan's forcers and controllers in this process query that index.
+    """
+    query = { 'path' : shoreline_path }
+    if shoreline_feature:
+        query['feature_name'] = shoreline_feature
+    shoreline = db.Shoreline.find_one(query)
+
+    if shoreline is None or not shoreline.index_path or not os.path.exists(shoreline.index_path):
+        return False
+
+    _installed[os.path.normpath(shoreline_path)] = shoreline.index_path
+
+    import paegan.transport.forcers as forcers
+    import paegan.transport.controllers.base as base
+    forcers.Shoreline = _shoreline_factory
+    base.Shoreline = _shoreline_factory
+    return True
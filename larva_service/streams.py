@@ -0,0 +1,230 @@
+"""
+Redis Streams in place of the pub/sub channels distributed runs use for
+particle results and logs.
+
+paegan publishes and subscribes through plain redis clients, so the redis
+module is patched in the run and particle processes: channels registered with
+use_streams() are written to a capped stream of the same name in batches, and
+read back through a consumer group that acknowledges and deletes entries once
+they are handled.  Producers wait while a stream holds more than
+'max_backlog' unhandled entries, so a lagging consumer slows them down instead
+of losing messages.  Other channels keep using pub/sub.
+"""
+import os
+import time
+import socket
+import threading
+
+import redis
+
+GROUP = "larva_service"
+
+_Redis = redis.Redis
+
+_streams = set()
+
+# Messages published by every client in this process and not yet written, in
+# the order they were published.  paegan publishes a particle's results and
+# its COMPLETED status through different clients, and the run stops reading
+# once every particle has completed, so they must reach the stream in order.
+_buffer = []
+_lock = threading.RLock()
+_state = { 'last_flush' : time.time(), 'client' : None }
+_gave_up = set()
+
+settings = {
+    'max_backlog'   : 10000,   # Unhandled entries a stream can hold before producers wait
+    'timeout'       : 300.,    # Seconds a producer waits before writing anyway
+    'batch'         : 50,      # Messages buffered before a write
+    'interval'      : 0.5,     # Seconds a message can stay buffered
+    'read_count'    : 500,     # Entries fetched per read
+}
+
+
+class StreamingRedis(_Redis):
+
+    def publish(self, channel, message):
+        if channel not in _streams:
+            return super(StreamingRedis, self).publish(channel, message)
+
+        with _lock:
+            _buffer.append((channel, message))
+            # Kept to write out what is left in flush_all()
+            _state['client'] = self
+            if len(_buffer) >= settings['batch'] or time.time() - _state['last_flush'] >= settings['interval']:
+                self.flush()
+        # pub/sub returns the number of receivers, which nothing here uses
+        return 1
+
+    def flush(self):
+        """
+        Write out everything buffered in this process, by any client
+        """
+        # Held while writing, so a later batch can't overtake this one
+        with _lock:
+            messages = list(_buffer)
+            del _buffer[:]
+            _state['last_flush'] = time.time()
+            if not messages:
+                return
+
+            cap = settings['max_backlog'] * 2
+            streams = []
+            pipe = super(StreamingRedis, self).pipeline(transaction=False)
+            for stream, message in messages:
+                # Trimming only happens if producers ever outrun the backpressure timeout
+                pipe.execute_command('XADD', stream, 'MAXLEN', '~', cap, '*', 'data', message)
+                if stream not in streams:
+                    streams.append(stream)
+            for stream in streams:
+                pipe.execute_command('XLEN', stream)
+            lengths = pipe.execute()[len(messages):]
+
+            for stream, length in zip(streams, lengths):
+                if length > settings['max_backlog'] and stream not in _gave_up:
+                    self.wait_for(stream)
+
+    def wait_for(self, stream):
+        """
+        Block until the consumers have worked the stream down to half of
+        max_backlog, or the timeout passes.  A consumer that misses the
+        timeout is assumed gone and not waited for again.
+        """
+        deadline = time.time() + settings['timeout']
+        delay = 0.05
+        while time.time() < deadline:
+            if self.execute_command('XLEN', stream) <= settings['max_backlog'] / 2:
+                return
+            time.sleep(delay)
+            delay = min(delay * 2, 1.)
+        _gave_up.add(stream)
+
+    def pubsub(self, **kwargs):
+        return StreamPubSub(self, super(StreamingRedis, self).pubsub(**kwargs))
+
+
+class StreamPubSub(object):
+    """
+    The parts of redis' PubSub that paegan and the run tasks use, reading
+    registered channels from their streams
+    """
+
+    def __init__(self, client, pubsub):
+        self.client = client
+        self._pubsub = pubsub
+        self._pubsub_channels = False
+        self.consumer = "%s:%d:%d" % (socket.gethostname(), os.getpid(), id(self))
+        self.streams = []
+        self._pending = []
+        self._delivered = []
+
+    def subscribe(self, *channels):
+        for channel in channels:
+            if channel in _streams:
+                try:
+                    self.client.execute_command('XGROUP', 'CREATE', channel, GROUP, '0', 'MKSTREAM')
+                except redis.ResponseError as e:
+                    if 'BUSYGROUP' not in str(e):
+                        raise
+                self.streams.append(channel)
+                self._pending.append({ 'type' : 'subscribe', 'pattern' : None, 'channel' : channel, 'data' : len(self.streams) })
+            else:
+                self._pubsub.subscribe(channel)
+                self._pubsub_channels = True
+
+    def unsubscribe(self, *channels):
+        self.acknowledge()
+        channels = channels or list(self.streams)
+        self.streams = [s for s in self.streams if s not in channels]
+        if self._pubsub_channels:
+            self._pubsub.unsubscribe(*channels)
+
+    def acknowledge(self):
+        """
+        Acknowledge and delete everything handed out so far, so the stream
+        length is what is still to be handled
+        """
+        if not self._delivered:
+            return
+        pipe = self.client.pipeline(transaction=False)
+        by_stream = {}
+        for stream, entry_id in self._delivered:
+            by_stream.setdefault(stream, []).append(entry_id)
+        for stream, ids in by_stream.items():
+            pipe.execute_command('XACK', stream, GROUP, *ids)
+            pipe.execute_command('XDEL', stream, *ids)
+        pipe.execute()
+        self._delivered = []
+
+    def _read(self, block_ms):
+        if not self.streams:
+            return
+        args = ['XREADGROUP', 'GROUP', GROUP, self.consumer, 'COUNT', settings['read_count']]
+        if block_ms:
+            args += ['BLOCK', int(block_ms)]
+        args += ['STREAMS'] + self.streams + ['>'] * len(self.streams)
+        for stream, entries in self.client.execute_command(*args) or []:
+            for entry_id, fields in entries:
+                values = dict(zip(fields[::2], fields[1::2]))
+                self._pending.append({ 'type' : 'message', 'pattern' : None, 'channel' : stream, 'data' : values.get('data'), 'id' : entry_id })
+
+    def get_message(self, ignore_subscribe_messages=False, timeout=0):
+        # Whatever was handed out before has been handled by the time the next message is asked for
+        self.acknowledge()
+
+        if not self._pending:
+            if self._pubsub_channels:
+                # Waits on the channels only when there are no streams to wait on
+                message = self._pubsub.get_message(ignore_subscribe_messages=ignore_subscribe_messages, timeout=0 if self.streams else timeout)
+                if message is not None:
+                    return message
+            self._read(timeout * 1000)
+
+        while self._pending:
+            message = self._pending.pop(0)
+            if message['type'] == 'message':
+                self._delivered.append((message['channel'], message.pop('id')))
+                return message
+            if not ignore_subscribe_messages:
+                return message
+        return None
+
+    def listen(self):
+        while self.streams or self._pending or self._pubsub_channels:
+            message = self.get_message(timeout=1)
+            if message is not None:
+                yield message
+
+    def close(self):
+        self.acknowledge()
+        self._pubsub.close()
+
+
+def from_url(url, db=None, **kwargs):
+    return StreamingRedis.from_url(url, db=db, **kwargs)
+
+
+def use_streams(channels, **kwargs):
+    """
+    Carry 'channels' over streams in this process.  Clients created through
+    redis.Redis or redis.from_url from now on support them.
+    """
+    settings.update((k, v) for k, v in kwargs.items() if v is not None)
+    _streams.update(channels)
+    redis.Redis = StreamingRedis
+    redis.from_url = from_url
+
+
+def flush_all():
+    """
+    Write out every message still buffered in this process
+    """
+    with _lock:
+        if _buffer and _state['client'] is not None:
+            _state['client'].flush()
+
+
+def delete_streams(channels, connection):
+    connection.delete(*channels)
+    _streams.difference_update(channels)
+    _gave_up.difference_update(channels)
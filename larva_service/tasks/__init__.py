@@ -1 +1,2 @@
-from larva_service.tasks import local, dataset, shoreline, distributed
+# Task modules are imported by the workers by name (see the enqueue calls in
+# larva_service.views), so the web tier never has to load paegan.
@@ -0,0 +1,81 @@
+from bson.objectid import ObjectId
+from datetime import datetime
+import os
+
+import numpy as np
+
+from larva_service import app, db
+from larva_service.ensemble import Land, analyze_run, summarize, particle_bounds
+
+
+def land_for_run(run, buffer):
+    # Land polygons around the run's particles, from the shoreline's import-time index
+    query = { 'path' : run.shoreline_path or app.config.get("SHORE_PATH") }
+    if run.shoreline_feature:
+        query['feature_name'] = run.shoreline_feature
+    shoreline = db.Shoreline.find_one(query)
+    if shoreline is None or not shoreline.index_path or not os.path.exists(shoreline.index_path):
+        return None
+
+    from larva_service.shoreline_index import load_index
+
+    # From the run summary, or a pass over the particle store in chunks for runs from before summaries
+    bounds = (run.summary or {}).get('bounds') or particle_bounds(run.particle_store)
+    if bounds is None:
+        return None
+
+    bounds = (bounds[0] - buffer, bounds[1] - buffer, bounds[2] + buffer, bounds[3] + buffer)
+    polygons = load_index(shoreline.index_path).query(bounds)
+    if not polygons:
+        return None
+    return Land(polygons, buffer=buffer)
+
+
+def run(analysis_id):
+
+    with app.app_context():
+
+        analysis = db.Analysis.find_one( { '_id' : ObjectId(analysis_id) } )
+        if analysis is None:
+            return "No Analysis exists, aborting analysis for ID %s" % analysis_id
+
+        analysis.started = datetime.utcnow()
+        analysis.save()
+
+        try:
+            results = { 'runs' : {} }
+            collected = { 'distance' : [], 'beached_hours' : [], 'settled' : [] }
+            beaching = True
+
+            for run_id in analysis.run_ids:
+                run = db.Run.find_one( { '_id' : ObjectId(run_id) } )
+                if run is None or not run.particle_store or not os.path.exists(run.particle_store):
+                    results['runs'][unicode(run_id)] = None
+                    continue
+
+                # One run's per-particle arrays at a time, the tracks themselves are streamed in chunks
+                land = land_for_run(run, analysis.shoreline_buffer)
+                beaching = beaching and land is not None
+                per_particle = analyze_run(run.particle_store, land=land)
+
+                results['runs'][unicode(run_id)] = summarize(per_particle, beaching=land is not None)
+                for k, v in per_particle.items():
+                    collected[k].append(v)
+
+            if collected['distance']:
+                ensemble = dict((k, np.concatenate(v)) for k, v in collected.items())
+                results['ensemble'] = summarize(ensemble, beaching=beaching)
+            else:
+                results['ensemble'] = None
+
+            analysis.results = results
+            analysis.message = u""
+
+        except Exception as e:
+            app.logger.exception("Failed analysis %s" % analysis_id)
+            analysis.message = unicode(e)
+
+        analysis.ended = datetime.utcnow()
+        analysis.save()
+
+        return "Analyzed %s (%s)" % (analysis_id, analysis.name)
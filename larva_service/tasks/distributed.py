@@ -1,4 +1,4 @@
-from larva_service import app, db, slugify, particle_queue, redis_connection
+from larva_service import app, db, particle_queue, redis_connection
 from flask import current_app
 from shapely.wkt import loads
 import json
@@ -15,12 +15,13 @@ from datetime import datetime
 from urlparse import urljoin, urlparse
 
 import threading
+from functools import partial
 
 from paegan.transport.models.behavior import LarvaBehavior
 from paegan.transport.models.transport import Transport
-from paegan.transport.controllers import DistributedModelController, CachingModelController
+from paegan.transport.controllers import CachingModelController
+from paegan.transport.controllers.distributed import particle_runner
 
-from logging import FileHandler
 
 from boto.s3.connection import S3Connection
 from boto.s3.key import Key
@@ -33,7 +34,91 @@ import time
 
 import redis
 
-import paegan.transport.export as ex
+from larva_service.bathymetry import use_shared_bathymetry
+from larva_service.exports import export_results
+from larva_service.models.run import s3_filename
+from larva_service.particles import build_store
+from larva_service.metadata import summarize as summarize_output
+from larva_service.compression import PRECOMPRESSED, precompress, sidecar, is_sidecar
+from larva_service.shoreline_index import use_shoreline_index
+from larva_service.metrics import PhaseTimer, record_timings, queue_wait
+from larva_service.profiling import PROFILE_KEY, Profiler, profiled, save, collect
+from larva_service.resources import RESOURCES_KEY, ResourceMonitor, collect_usage, summarize_tasks
+from larva_service.runlog import TAIL_KEY, RunLogHandler, rate_limit
+from larva_service.retention import du, enforce as enforce_retention
+from larva_service.streams import use_streams, flush_all, delete_streams
+from larva_service.locality import Router, advertise
+from larva_service.batching import BatchingModelController, run_batch, batch_size, particle_workers, step_seconds, record_step_seconds
+
+
+def use_results_transport(channels):
+    # paegan publishes and subscribes through redis' pub/sub, carry its channels over streams instead
+    if current_app.config['RESULTS_TRANSPORT'] == "streams":
+        use_streams(channels, max_backlog=current_app.config['STREAM_MAX_BACKLOG'], timeout=current_app.config['STREAM_BACKPRESSURE_TIMEOUT'])
+
+
+def particle(parts, model, run_id=None, profile=False):
+    with app.app_context():
+        from paegan.logger import logger
+
+        use_shared_bathymetry()
+        use_shoreline_index(model.shoreline_path, model.shoreline_feature)
+        # Drop repetitive messages before they are published to the run
+        rate_limit(logger, burst=current_app.config['LOG_RATE_BURST'], interval=current_app.config['LOG_RATE_INTERVAL'])
+        use_results_transport([model.redis_log_channel, model.redis_results_channel])
+
+        monitor = ResourceMonitor(ceiling_mb=current_app.config.get('PARTICLE_MEMORY_CEILING_MB'))
+        profiler = Profiler() if profile else None
+        monitor.start()
+        if profiler is not None:
+            profiler.start()
+        started = time.time()
+        try:
+            # A batch of particles, or a single one from before batching
+            if not isinstance(parts, list):
+                parts = [parts]
+            run_batch(parts, model, monitor)
+            # The hydro, shoreline and bathymetry are in this host's page cache now
+            try:
+                advertise(redis_connection, [model.hydrodataset, model.shoreline_path, model.bathy_path])
+            except Exception:
+                app.logger.exception("Could not advertise warm resources")
+            try:
+                record_step_seconds(redis_connection, (time.time() - started) / (len(parts) * max(1, len(model.times) - 1)))
+            except Exception:
+                app.logger.exception("Could not record the particle timing")
+        finally:
+            # Write out results and logs still buffered for the streams
+            try:
+                flush_all()
+            except Exception:
+                app.logger.exception("Could not write out buffered results")
+            if profiler is not None:
+                profiler.stop()
+            usage = monitor.stop()
+
+            job = get_current_job(connection=redis_connection)
+            if job is not None:
+                job.meta["resources"] = usage
+                job.save()
+
+            # Handed back to the run task, which stores the totals on the run
+            if run_id is not None:
+                pipe = redis_connection.pipeline()
+                pipe.rpush(RESOURCES_KEY % run_id, json.dumps(usage))
+                pipe.expire(RESOURCES_KEY % run_id, 86400)
+                if profiler is not None:
+                    pipe.rpush(PROFILE_KEY % run_id, profiler.dumps())
+                    pipe.expire(PROFILE_KEY % run_id, 86400)
+                pipe.execute()
+
+
+def enqueue_particle(func, args, run_id=None, profile=False, router=None, jobs=None):
+    # Wrap paegan's particle_runner so the particle worker sets up shared resources first
+    job = (router or particle_queue).enqueue_call(func=particle, args=args, kwargs={ 'run_id' : run_id, 'profile' : profile })
+    if jobs is not None:
+        jobs.append(job)
+    return job
 
 
 def run(run_id):
@@ -42,6 +127,12 @@ def run(run_id):
 
         job = get_current_job(connection=redis_connection)
 
+        # Make room before writing anything
+        try:
+            enforce_retention(current_app.config, db, redis_connection)
+        except Exception:
+            app.logger.exception("Could not enforce retention")
+
         output_path = os.path.join(current_app.config['OUTPUT_PATH'], run_id)
         shutil.rmtree(output_path, ignore_errors=True)
         os.makedirs(output_path)
@@ -58,10 +149,36 @@ def run(run_id):
         if run is None:
             return "Failed to locate run %s. May have been deleted while task was in the queue?" % run_id
 
+        timer = PhaseTimer()
+        timer.add("queue_wait", queue_wait(job, fallback=run.created))
+
         # Wait for PubSub listening to begin
         time.sleep(2)
 
+        log_channel = "{}:log".format(run_id)
+        results_channel = "{}:results".format(run_id)
+        results_redis_url = current_app.config.get("RESULTS_REDIS_URI")
+
         model = None
+        # Particle tasks enqueued, each reports its usage (and profile) once done
+        jobs = []
+
+        def abort_particles():
+            # The ceiling's signal can't interrupt the wait on paegan's result
+            # listener, so fail every particle to end it and drop the tasks not started
+            for j in list(jobs):
+                try:
+                    j.cancel()
+                except Exception:
+                    pass
+            if model is not None:
+                rc = redis.from_url(results_redis_url)
+                for p in model.particles:
+                    rc.publish(results_channel, json.dumps({ "status" : "FAILED", "uid" : p.uid }))
+                flush_all()
+
+        monitor = ResourceMonitor(ceiling_mb=current_app.config.get('MEMORY_CEILING_MB'), on_exceeded=abort_particles)
+        monitor.start()
         try:
 
             hydropath      = run['hydro_path']
@@ -82,14 +199,6 @@ def run(run_id):
                 models.append(l)
             models.append(Transport(horizDisp=run['horiz_dispersion'], vertDisp=run['vert_dispersion']))
 
-            output_formats = [
-                ex.H5Trackline,
-                ex.H5TracklineWithPoints,
-                ex.H5ParticleTracklines,
-                ex.H5ParticleMultiPoint,
-                ex.H5GDALShapefile
-            ]
-
             def listen_for_logs(redis_url, log_channel, stop):
 
                 res = urlparse(redis_url)
@@ -99,7 +208,7 @@ def run(run_id):
                 # Set up Logger
                 logger = logging.getLogger(run_id)
                 logger.setLevel(logging.PROGRESS)
-                handler = FileHandler(log_file)
+                handler = RunLogHandler(log_file + ".gz", redis_connection, TAIL_KEY % run_id, tail=app.config['LOG_TAIL_LINES'])
                 handler.setLevel(logging.PROGRESS)
                 formatter = logging.Formatter('[%(asctime)s] - %(levelname)s - %(name)s - %(processName)s - %(message)s')
                 handler.setFormatter(formatter)
@@ -114,9 +223,7 @@ def run(run_id):
                 pubsub.subscribe(log_channel)
 
                 while True:
-                    if stop():
-                        break
-                    msg = pubsub.get_message()
+                    msg = pubsub.get_message(timeout=0.5)
                     if msg:
                         if msg['type'] != "message":
                             continue
@@ -134,9 +241,9 @@ def run(run_id):
                                     getattr(logger, prog["level"].lower())(prog.get("message"))
                         except Exception:
                             logger.info("Got strange result: %s" % msg["data"])
-
-                    # Relax
-                    time.sleep(0.01)
+                    elif stop():
+                        # Only once the channel is drained
+                        break
 
                 pubsub.unsubscribe()
                 pubsub.close()
@@ -151,31 +258,72 @@ def run(run_id):
                 sys.exit()
 
             stop_log_listener = False
-            log_channel = "{}:log".format(run_id)
-            results_channel = "{}:results".format(run_id)
+            use_results_transport([log_channel, results_channel])
             pl = threading.Thread(name="LogListener", target=listen_for_logs, args=(current_app.config.get("RESULTS_REDIS_URI"), log_channel, lambda: stop_log_listener, ))
             pl.daemon = True
             pl.start()
 
-            model = DistributedModelController(
-                geometry=geometry,
-                depth=start_depth,
-                start=start_time,
-                step=time_step,
-                nstep=num_steps,
-                npart=num_particles,
-                models=models,
-                use_bathymetry=True,
-                bathy_path=current_app.config['BATHY_PATH'],
-                use_shoreline=True,
-                time_method=run['time_method'],
-                shoreline_path=shoreline_path,
-                shoreline_feature=shoreline_feat,
-                shoreline_index_buffer=0.05)
-            model.setup_run(hydropath, redis_url=current_app.config.get("RESULTS_REDIS_URI"), redis_results_channel=results_channel, redis_log_channel=log_channel)
+            # Build the shared grid once, before the particle tasks need it
+            use_shared_bathymetry()
+            use_shoreline_index(shoreline_path, shoreline_feat)
+
+            with timer.phase("setup_run"):
+                # Sized from how long particles have been taking and how many workers can take them
+                size = batch_size(num_particles,
+                                  num_steps,
+                                  particle_workers(particle_queue),
+                                  step_seconds=step_seconds(redis_connection),
+                                  target_seconds=current_app.config['PARTICLE_BATCH_SECONDS'],
+                                  fixed=current_app.config['PARTICLE_BATCH_SIZE'])
+                job.meta["particle_batch_size"] = size
+                model = BatchingModelController(
+                    batch_size=size,
+                    geometry=geometry,
+                    depth=start_depth,
+                    start=start_time,
+                    step=time_step,
+                    nstep=num_steps,
+                    npart=num_particles,
+                    models=models,
+                    use_bathymetry=True,
+                    bathy_path=current_app.config['BATHY_PATH'],
+                    use_shoreline=True,
+                    time_method=run['time_method'],
+                    shoreline_path=shoreline_path,
+                    shoreline_feature=shoreline_feat,
+                    shoreline_index_buffer=0.05)
+                model.setup_run(hydropath, redis_url=current_app.config.get("RESULTS_REDIS_URI"), redis_results_channel=results_channel, redis_log_channel=log_channel)
+            # Opened by setup_run and building the shared grid, so warm on this host
+            advertise(redis_connection, [hydropath, shoreline_path, current_app.config['BATHY_PATH']])
 
             run.started = datetime.utcnow()
-            model.run(output_formats=output_formats, output_path=output_path, task_queue_call=particle_queue.enqueue_call)
+            # Exports are run below, concurrently, instead of serially by paegan
+            with timer.phase("model_run"), profiled(os.path.join(output_path, 'profile'), enabled=run['profile']):
+                # Particle tasks go to workers on hosts that have the files warm first
+                router = Router(particle_queue, [hydropath, shoreline_path, current_app.config['BATHY_PATH']], fallback=current_app.config['LOCALITY_FALLBACK_SECONDS'])
+                model.run(output_formats=[], output_path=output_path, task_queue_call=partial(enqueue_particle, run_id=run_id, profile=run['profile_particles'], router=router, jobs=jobs))
+            # Progress published while collecting results may still be buffered
+            flush_all()
+
+            if run['profile_particles']:
+                try:
+                    save(collect(run_id, redis_connection, expected=len(jobs), timeout=current_app.config['PARTICLE_REPORT_TIMEOUT']), os.path.join(output_path, 'particle_profile'))
+                except Exception:
+                    app.logger.exception("Could not save the particle profiles")
+
+            job.meta["message"] = "Exporting results"
+            job.save()
+            with timer.phase("export"):
+                run.exports = export_results(run['output_formats'], output_path, os.path.join(output_path, 'results.h5'))
+            with timer.phase("compress"):
+                precompress(output_path)
+
+            try:
+                with timer.phase("particle_store"):
+                    store_file = os.path.join(current_app.config['PARTICLE_STORE_PATH'], run_id + ".h5")
+                    run.particle_store = unicode(build_store(os.path.join(output_path, 'results.h5'), store_file))
+            except Exception:
+                app.logger.exception("Could not build the particle store")
 
         except Exception as e:
             # Send message to the log listener to finish
@@ -198,37 +346,60 @@ def run(run_id):
             job.meta["progress"] = 100
 
         finally:
+            usage = monitor.stop()
+            job.meta["resources"] = usage
+
+            if current_app.config['RESULTS_TRANSPORT'] == "streams":
+                delete_streams([log_channel, results_channel], redis.from_url(current_app.config.get("RESULTS_REDIS_URI")))
 
             # Move logfile to output directory
             time.sleep(1)
-            shutil.move(log_file, os.path.join(output_path, 'model.log'))
+            with timer.phase("log_move"):
+                shutil.move(log_file + ".gz", os.path.join(output_path, 'model.log.gz'))
+                os.remove(log_file)
+
+            # Read what the run record needs from the local output, before it is uploaded
+            summary, trackline = None, None
+            try:
+                with timer.phase("metadata"):
+                    summary, trackline = summarize_output(output_path, run.particle_store)
+            except Exception:
+                app.logger.exception("Could not summarize the run output")
 
             output_files = []
             for filename in os.listdir(output_path):
                 outfile = os.path.join(output_path, filename)
-                output_files.append(outfile)
+                # Served in place of the file they compress
+                if not is_sidecar(outfile):
+                    output_files.append(outfile)
 
             result_files = []
             # Handle results and cleanup
             if current_app.config['USE_S3'] is True:
-                base_access_url = urljoin("http://%s.s3.amazonaws.com/output/" % current_app.config['S3_BUCKET'], run_id)
-                # Upload results to S3 and remove the local copies
-                conn = S3Connection()
-                bucket = conn.get_bucket(current_app.config['S3_BUCKET'])
-
-                for outfile in output_files:
-                    # Upload the outfile with the same as the run name
-                    _, ext = os.path.splitext(outfile)
-                    new_filename = slugify(unicode(run['name'])) + ext
-
-                    k = Key(bucket)
-                    k.key = "output/%s/%s" % (run_id, new_filename)
-                    k.set_contents_from_filename(outfile)
-                    k.set_acl('public-read')
-                    result_files.append(base_access_url + "/" + new_filename)
-                    os.remove(outfile)
-
-                shutil.rmtree(output_path, ignore_errors=True)
+                with timer.phase("upload"):
+                    base_access_url = urljoin("http://%s.s3.amazonaws.com/output/" % current_app.config['S3_BUCKET'], run_id)
+                    # Upload results to S3 and remove the local copies
+                    conn = S3Connection()
+                    bucket = conn.get_bucket(current_app.config['S3_BUCKET'])
+
+                    for outfile in output_files:
+                        # Upload the outfile with the same as the run name
+                        _, ext = os.path.splitext(outfile)
+                        new_filename = s3_filename(run['name'], outfile)
+
+                        k = Key(bucket)
+                        k.key = "output/%s/%s" % (run_id, new_filename)
+                        compressed = sidecar(outfile)
+                        if compressed is not None:
+                            # S3 can't negotiate, every client gets the gzipped copy and decompresses it
+                            k.set_contents_from_filename(compressed, headers={ 'Content-Encoding' : 'gzip', 'Content-Type' : PRECOMPRESSED[ext] })
+                        else:
+                            k.set_contents_from_filename(outfile)
+                        k.set_acl('public-read')
+                        result_files.append(base_access_url + "/" + new_filename)
+                        os.remove(outfile)
+
+                    shutil.rmtree(output_path, ignore_errors=True)
 
             else:
                 result_files = output_files
@@ -239,5 +410,17 @@ def run(run_id):
             # Set output fields
             run.output = result_files
             run.ended = datetime.utcnow()
-            run.compute()
-            run.save()
+            run.compute(summary, trackline)
+
+            run.timings = dict(timer.timings)
+            # Cancelled tasks never report
+            expected = 0 if monitor.exceeded else len(jobs)
+            particle_usage = collect_usage(run_id, redis_connection, expected=expected, timeout=current_app.config['PARTICLE_REPORT_TIMEOUT'])
+            run.resources = { 'run' : usage, 'particles' : summarize_tasks(particle_usage) }
+            run.disk = { 'output_bytes' : du(output_path) + du(os.path.join(current_app.config['PARTICLE_STORE_PATH'], run_id + ".h5")), 'cache_bytes' : du(cache_path) }
+            run.save_results()
+
+            try:
+                record_timings(timer.timings)
+            except Exception:
+                app.logger.exception("Could not record run timings")
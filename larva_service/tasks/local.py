@@ -1,4 +1,4 @@
-from larva_service import app, db, slugify, redis_connection
+from larva_service import app, db, redis_connection
 from flask import current_app
 from shapely.wkt import loads
 import tempfile
@@ -27,7 +27,19 @@ from rq import get_current_job
 
 import time
 
-import paegan.transport.export as ex
+from larva_service.bathymetry import use_shared_bathymetry
+from larva_service.exports import export_results
+from larva_service.models.run import s3_filename
+from larva_service.particles import build_store
+from larva_service.metadata import summarize as summarize_output
+from larva_service.compression import PRECOMPRESSED, precompress, sidecar, is_sidecar
+from larva_service.shoreline_index import use_shoreline_index
+from larva_service.metrics import PhaseTimer, record_timings, queue_wait
+from larva_service.profiling import profiled
+from larva_service.resources import ResourceMonitor
+from larva_service.runlog import TAIL_KEY, RunLogHandler, follow, rate_limit
+from larva_service.retention import du, enforce as enforce_retention
+from larva_service.hydro_cache import keep as keep_hydro_cache
 
 
 def run(run_id):
@@ -36,6 +48,12 @@ def run(run_id):
 
         job = get_current_job(connection=redis_connection)
 
+        # Make room before writing anything
+        try:
+            enforce_retention(current_app.config, db, redis_connection)
+        except Exception:
+            app.logger.exception("Could not enforce retention")
+
         output_path = os.path.join(current_app.config['OUTPUT_PATH'], run_id)
         shutil.rmtree(output_path, ignore_errors=True)
         os.makedirs(output_path)
@@ -52,9 +70,24 @@ def run(run_id):
         if run is None:
             return "Failed to locate run %s. May have been deleted while task was in the queue?" % run_id
 
+        timer = PhaseTimer()
+        timer.add("queue_wait", queue_wait(job, fallback=run.created))
+
         # Wait for PubSub listening to begin
         time.sleep(2)
 
+        monitor = ResourceMonitor(ceiling_mb=current_app.config.get('MEMORY_CEILING_MB'))
+        monitor.start()
+
+        # paegan writes the plain log file, a compressed copy with its tail in Redis is kept from it
+        run_log = RunLogHandler(log_file + ".gz", redis_connection, TAIL_KEY % run_id, tail=current_app.config['LOG_TAIL_LINES'])
+        stop_follower = False
+        fl = threading.Thread(name="LogFollower", target=follow, args=(log_file, run_log, lambda: stop_follower,))
+        fl.daemon = True
+        fl.start()
+
+        cache_file = os.path.join(cache_path, run_id + ".nc.cache")
+
         model = None
         try:
 
@@ -76,14 +109,6 @@ def run(run_id):
                 models.append(l)
             models.append(Transport(horizDisp=run['horiz_dispersion'], vertDisp=run['vert_dispersion']))
 
-            output_formats = [
-                ex.H5Trackline,
-                ex.H5TracklineWithPoints,
-                ex.H5ParticleTracklines,
-                ex.H5ParticleMultiPoint,
-                ex.H5GDALShapefile
-            ]
-
             def save_progress(stop, progress_deque, logger):
                 while True:
 
@@ -132,32 +157,55 @@ def run(run_id):
             progress_handler.setLevel(logging.PROGRESS)
             logger.addHandler(progress_handler)
 
+            # Drop repetitive messages before they cross the queue, forked workers inherit the filter
+            rate_limit(logger, burst=current_app.config['LOG_RATE_BURST'], interval=current_app.config['LOG_RATE_INTERVAL'])
+
             stop_log_listener = False
             pl = threading.Thread(name="ProgressUpdater", target=save_progress, args=(lambda: stop_log_listener, progress_deque, logger,))
             pl.start()
 
-            model = CachingModelController(
-                geometry=geometry,
-                depth=start_depth,
-                start=start_time,
-                step=time_step,
-                nstep=num_steps,
-                npart=num_particles,
-                models=models,
-                use_bathymetry=True,
-                bathy_path=current_app.config['BATHY_PATH'],
-                use_shoreline=True,
-                time_method=run['time_method'],
-                time_chunk=run['time_chunk'],
-                horiz_chunk=run['horiz_chunk'],
-                shoreline_path=shoreline_path,
-                shoreline_feature=shoreline_feat,
-                shoreline_index_buffer=0.05)
-            cache_file = os.path.join(cache_path, run_id + ".nc.cache")
-            model.setup_run(hydropath, cache_path=cache_file, remove_cache=False)
+            # Forcers are forked from this process and inherit the shared grid and shoreline index
+            use_shared_bathymetry()
+            use_shoreline_index(shoreline_path, shoreline_feat)
+
+            with timer.phase("setup_run"):
+                model = CachingModelController(
+                    geometry=geometry,
+                    depth=start_depth,
+                    start=start_time,
+                    step=time_step,
+                    nstep=num_steps,
+                    npart=num_particles,
+                    models=models,
+                    use_bathymetry=True,
+                    bathy_path=current_app.config['BATHY_PATH'],
+                    use_shoreline=True,
+                    time_method=run['time_method'],
+                    time_chunk=run['time_chunk'],
+                    horiz_chunk=run['horiz_chunk'],
+                    shoreline_path=shoreline_path,
+                    shoreline_feature=shoreline_feat,
+                    shoreline_index_buffer=0.05)
+                model.setup_run(hydropath, cache_path=cache_file, remove_cache=False)
 
             run.started = datetime.utcnow()
-            model.run(output_formats=output_formats, output_path=output_path)
+            # Exports are run below, concurrently, instead of serially by paegan
+            with timer.phase("model_run"), profiled(os.path.join(output_path, 'profile'), enabled=run['profile']):
+                model.run(output_formats=[], output_path=output_path)
+
+            job.meta["message"] = "Exporting results"
+            job.save()
+            with timer.phase("export"):
+                run.exports = export_results(run['output_formats'], output_path, os.path.join(output_path, 'results.h5'))
+            with timer.phase("compress"):
+                precompress(output_path)
+
+            try:
+                with timer.phase("particle_store"):
+                    store_file = os.path.join(current_app.config['PARTICLE_STORE_PATH'], run_id + ".h5")
+                    run.particle_store = unicode(build_store(os.path.join(output_path, 'results.h5'), store_file))
+            except Exception:
+                app.logger.exception("Could not build the particle store")
 
         except Exception as e:
             # Stop progress log handler
@@ -180,6 +228,8 @@ def run(run_id):
             job.meta["progress"] = 100
 
         finally:
+            usage = monitor.stop()
+            job.meta["resources"] = usage
 
             # Close and remove the handlers so we can use the log file without a file lock
             for hand in list(logger.handlers):
@@ -191,47 +241,90 @@ def run(run_id):
 
             time.sleep(1)
 
-            # Move logfile to output directory
-            shutil.move(log_file, os.path.join(output_path, 'model.log'))
+            stop_follower = True
+            fl.join()
+            run_log.close()
 
-            # Move cachefile to output directory if we made one
-            shutil.move(cache_file, os.path.join(output_path, 'hydro_cache.nc'))
+            with timer.phase("log_move"):
+                # Move the compressed logfile to output directory
+                shutil.move(run_log.path, os.path.join(output_path, 'model.log.gz'))
+                os.remove(log_file)
+
+            # Keep the forcing data only when asked to, compressed and stored once for every run with the same data
+            hydro_cache_link = None
+            if os.path.exists(cache_file):
+                if run['keep_hydro_cache']:
+                    try:
+                        with timer.phase("hydro_cache"):
+                            digest, hydro_cache_link = keep_hydro_cache(cache_file, current_app.config)
+                            run.hydro_cache = unicode(digest)
+                    except Exception:
+                        app.logger.exception("Could not keep the forcing data")
+                os.remove(cache_file)
+
+            # Read what the run record needs from the local output, before it is uploaded
+            summary, trackline = None, None
+            try:
+                with timer.phase("metadata"):
+                    summary, trackline = summarize_output(output_path, run.particle_store)
+            except Exception:
+                app.logger.exception("Could not summarize the run output")
 
             output_files = []
             for filename in os.listdir(output_path):
                 outfile = os.path.join(output_path, filename)
-                output_files.append(outfile)
+                # Served in place of the file they compress
+                if not is_sidecar(outfile):
+                    output_files.append(outfile)
 
             result_files = []
             # Handle results and cleanup
             if current_app.config['USE_S3'] is True:
-                base_access_url = urljoin("http://%s.s3.amazonaws.com/output/" % current_app.config['S3_BUCKET'], run_id)
-                # Upload results to S3 and remove the local copies
-                conn = S3Connection()
-                bucket = conn.get_bucket(current_app.config['S3_BUCKET'])
-
-                for outfile in output_files:
-                    # Upload the outfile with the same as the run name
-                    _, ext = os.path.splitext(outfile)
-                    new_filename = slugify(unicode(run['name'])) + ext
-
-                    k = Key(bucket)
-                    k.key = "output/%s/%s" % (run_id, new_filename)
-                    k.set_contents_from_filename(outfile)
-                    k.set_acl('public-read')
-                    result_files.append(base_access_url + "/" + new_filename)
-                    os.remove(outfile)
-
-                shutil.rmtree(output_path, ignore_errors=True)
+                with timer.phase("upload"):
+                    base_access_url = urljoin("http://%s.s3.amazonaws.com/output/" % current_app.config['S3_BUCKET'], run_id)
+                    # Upload results to S3 and remove the local copies
+                    conn = S3Connection()
+                    bucket = conn.get_bucket(current_app.config['S3_BUCKET'])
+
+                    for outfile in output_files:
+                        # Upload the outfile with the same as the run name
+                        _, ext = os.path.splitext(outfile)
+                        new_filename = s3_filename(run['name'], outfile)
+
+                        k = Key(bucket)
+                        k.key = "output/%s/%s" % (run_id, new_filename)
+                        compressed = sidecar(outfile)
+                        if compressed is not None:
+                            # S3 can't negotiate, every client gets the gzipped copy and decompresses it
+                            k.set_contents_from_filename(compressed, headers={ 'Content-Encoding' : 'gzip', 'Content-Type' : PRECOMPRESSED[ext] })
+                        else:
+                            k.set_contents_from_filename(outfile)
+                        k.set_acl('public-read')
+                        result_files.append(base_access_url + "/" + new_filename)
+                        os.remove(outfile)
+
+                    shutil.rmtree(output_path, ignore_errors=True)
 
             else:
                 result_files = output_files
 
+            if hydro_cache_link is not None:
+                result_files.append(hydro_cache_link)
+
             job.meta["updated"]  = datetime.utcnow().replace(tzinfo=pytz.utc).astimezone(pytz.utc)
             job.save()
 
             # Set output fields
             run.output = result_files
             run.ended = datetime.utcnow()
-            run.compute()
-            run.save()
+            run.compute(summary, trackline)
+
+            run.timings = dict(timer.timings)
+            run.resources = { 'run' : usage }
+            run.disk = { 'output_bytes' : du(output_path) + du(os.path.join(current_app.config['PARTICLE_STORE_PATH'], run_id + ".h5")), 'cache_bytes' : du(cache_path) }
+            run.save_results()
+
+            try:
+                record_timings(timer.timings)
+            except Exception:
+                app.logger.exception("Could not record run timings")
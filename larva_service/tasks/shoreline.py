@@ -14,6 +14,12 @@ def get_info(shoreline_id):
             return "No Shoreline exists to update, aborting update process for ID %s" % shoreline_id
 
         shoreline.get_info()
+
+        try:
+            shoreline.build_index()
+        except Exception:
+            app.logger.exception("Could not build a spatial index for shoreline %s" % shoreline_id)
+
         shoreline.updated = datetime.utcnow()
 
         shoreline.save()
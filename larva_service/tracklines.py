@@ -0,0 +1,184 @@
+"""
+Compact binary encoding of GeoJSON objects for storing tracklines outside of
+the run documents.  Coordinates are quantized (to about 10cm horizontally and
+1mm vertically), delta encoded from one position to the next and written as
+zigzag varints, so a trackline moving a little every step takes a few bytes a
+position.  Everything that isn't a coordinate, like the feature's id and
+properties, is kept as compressed JSON in the header.
+"""
+import json
+import zlib
+import struct
+
+MAGIC = "TLB"
+VERSION = 1
+# Quantization of x/y and of z
+SCALES = (1e6, 1e3)
+
+
+def _is_position(c):
+    return len(c) > 0 and not isinstance(c[0], (list, tuple))
+
+
+def _shape(coordinates):
+    """
+    None for a single position, the number of positions for a list of
+    them and a list of shapes for deeper nesting
+    """
+    if _is_position(coordinates):
+        return None
+    if len(coordinates) == 0 or _is_position(coordinates[0]):
+        return len(coordinates)
+    return [_shape(c) for c in coordinates]
+
+
+def _positions(coordinates):
+    if _is_position(coordinates):
+        yield coordinates
+    else:
+        for c in coordinates:
+            for p in _positions(c):
+                yield p
+
+
+def _rebuild(shape, positions):
+    if shape is None:
+        return next(positions)
+    if isinstance(shape, int):
+        return [next(positions) for i in range(shape)]
+    return [_rebuild(s, positions) for s in shape]
+
+
+def _count(shape):
+    if shape is None:
+        return 1
+    if isinstance(shape, int):
+        return shape
+    return sum(_count(s) for s in shape)
+
+
+def _write_varint(out, value):
+    # zigzag, so small negative deltas stay small
+    value = (value << 1) ^ (value >> 63)
+    while True:
+        byte = value & 0x7f
+        value >>= 7
+        if value:
+            out.append(byte | 0x80)
+        else:
+            out.append(byte)
+            return
+
+
+def _read_varint(data, offset):
+    value = 0
+    shift = 0
+    while True:
+        byte = data[offset]
+        offset += 1
+        value |= (byte & 0x7f) << shift
+        shift += 7
+        if not byte & 0x80:
+            break
+    return (value >> 1) ^ -(value & 1), offset
+
+
+def _strip(obj, arrays):
+    """
+    Copy of 'obj' with every coordinates array replaced by a reference to
+    its place in 'arrays'
+    """
+    if isinstance(obj, dict):
+        copy = {}
+        for key, value in obj.items():
+            if key == 'coordinates':
+                dims = min(3, max([len(p) for p in _positions(value)] or [2]))
+                copy[key] = { '$ref' : len(arrays), 'shape' : _shape(value), 'dims' : dims }
+                arrays.append((value, dims))
+            else:
+                copy[key] = _strip(value, arrays)
+        return copy
+    if isinstance(obj, list):
+        return [_strip(o, arrays) for o in obj]
+    return obj
+
+
+def _restore(obj, arrays):
+    if isinstance(obj, dict):
+        if '$ref' in obj:
+            return arrays[obj['$ref']]
+        return dict((k, _restore(v, arrays)) for k, v in obj.items())
+    if isinstance(obj, list):
+        return [_restore(o, arrays) for o in obj]
+    return obj
+
+
+def count(geo):
+    """
+    Number of positions in a GeoJSON object
+    """
+    if isinstance(geo, dict):
+        return sum(_count(_shape(v)) if k == 'coordinates' else count(v) for k, v in geo.items())
+    if isinstance(geo, list):
+        return sum(count(g) for g in geo)
+    return 0
+
+
+def encode(geo):
+    """
+    Encode a GeoJSON object (as parsed JSON) to a byte string
+    """
+    arrays = []
+    header = zlib.compress(json.dumps(_strip(geo, arrays), separators=(',', ':')))
+
+    body = bytearray()
+    previous = [0, 0, 0]
+    for coordinates, dims in arrays:
+        for p in _positions(coordinates):
+            for i in range(dims):
+                value = int(round(float(p[i] if i < len(p) else 0) * SCALES[i // 2]))
+                _write_varint(body, value - previous[i])
+                previous[i] = value
+    return struct.pack(">3sBI", MAGIC, VERSION, len(header)) + header + str(body)
+
+
+def decode(data):
+    """
+    Decode a byte string written by encode() back to a GeoJSON object
+    """
+    data = bytearray(data)
+    magic, version, length = struct.unpack(">3sBI", str(data[:8]))
+    if magic != MAGIC or version != VERSION:
+        raise ValueError("Not an encoded trackline")
+    structure = json.loads(zlib.decompress(str(data[8:8 + length])))
+
+    refs = []
+
+    def collect(obj):
+        if isinstance(obj, dict):
+            if '$ref' in obj:
+                refs.append(obj)
+            else:
+                for v in obj.values():
+                    collect(v)
+        elif isinstance(obj, list):
+            for o in obj:
+                collect(o)
+    collect(structure)
+    refs.sort(key=lambda r: r['$ref'])
+
+    offset = 8 + length
+    previous = [0, 0, 0]
+    arrays = []
+    for ref in refs:
+        dims = ref['dims']
+        positions = []
+        for i in range(_count(ref['shape'])):
+            position = []
+            for d in range(dims):
+                delta, offset = _read_varint(data, offset)
+                previous[d] += delta
+                position.append(round(previous[d] / SCALES[d // 2], 7))
+            positions.append(position)
+        arrays.append(_rebuild(ref['shape'], iter(positions)))
+    return _restore(structure, arrays)
@@ -1 +1,5 @@
-from larva_service.views import index, run, dataset, shoreline
+from larva_service import app
+from larva_service.compression import compress_response
+from larva_service.views import index, run, dataset, shoreline, analysis
+
+app.after_request(compress_response)
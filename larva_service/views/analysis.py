@@ -0,0 +1,82 @@
+import json
+
+from bson.objectid import ObjectId
+from bson.errors import InvalidId
+from flask import redirect, url_for, request, flash, jsonify
+from pymongo import DESCENDING
+from rq import cancel_job
+
+from larva_service import app, db, analysis_queue, redis_connection
+from larva_service.models.analysis import Analysis
+from larva_service.serialize import api_document, response, stream
+from larva_service.views.helpers import requires_auth
+
+
+def analysis_json(analysis):
+    js = api_document(analysis, Analysis.api_fields)
+    js['status'] = unicode(analysis.status())
+    return js
+
+
+@app.route('/analysis', methods=['POST'])
+@app.route('/analysis.<string:format>', methods=['POST'])
+def add_analysis(format=None):
+    try:
+        config_dict = json.loads(request.form.get("config", "").strip())
+        run_ids = [unicode(ObjectId(r)) for r in config_dict['runs']]
+        if not run_ids:
+            raise ValueError("An analysis needs at least one run")
+    except (ValueError, KeyError, TypeError, InvalidId):
+        return jsonify( { 'results' : "Could not decode parameters" } ), 400
+
+    analysis = db.Analysis()
+    analysis.name = unicode(config_dict.get('name', ''))
+    analysis.run_ids = run_ids
+    if config_dict.get('shoreline_buffer') is not None:
+        analysis.shoreline_buffer = float(config_dict['shoreline_buffer'])
+    analysis.save()
+
+    job = analysis_queue.enqueue_call(func='larva_service.tasks.analysis.run', args=(unicode(analysis['_id']),))
+    analysis.task_id = unicode(job.id)
+    analysis.save()
+
+    return jsonify( { 'results' : unicode(analysis['_id']) } )
+
+
+@app.route('/analyses', methods=['GET'])
+@app.route('/analyses.<string:format>', methods=['GET'])
+def analyses(format=None):
+    if format is None:
+        format = 'json'
+
+    if format == 'json':
+        return stream('results', (analysis_json(a) for a in db.Analysis.find().sort('created', DESCENDING)))
+    else:
+        flash("Response format '%s' not supported" % format, 'warning')
+        return redirect(url_for('runs'))
+
+
+@app.route('/analyses/<ObjectId:analysis_id>', methods=['GET'])
+@app.route('/analyses/<ObjectId:analysis_id>.<string:format>', methods=['GET'])
+def show_analysis(analysis_id, format=None):
+    if format is None:
+        format = 'json'
+
+    analysis = db.Analysis.find_one( { '_id' : analysis_id } )
+
+    if format == 'json':
+        return response( analysis_json(analysis) )
+    else:
+        flash("Response format '%s' not supported" % format, 'warning')
+        return redirect(url_for('runs'))
+
+
+@app.route('/analyses/<ObjectId:analysis_id>/delete', methods=['GET', 'DELETE'])
+@app.route('/analyses/<ObjectId:analysis_id>/delete.<string:format>', methods=['GET', 'DELETE'])
+@requires_auth
+def delete_analysis(analysis_id, format=None):
+    analysis = db.Analysis.find_one( { '_id' : analysis_id } )
+    cancel_job(analysis.task_id, connection=redis_connection)
+    analysis.delete()
+
+    return jsonify( { 'status' : "success" })
@@ -1,10 +1,12 @@
-from flask import render_template, redirect, url_for, request, flash, jsonify
-from larva_service import app, db, dataset_queue, redis_connection
-import json
-from larva_service.models import remove_mongo_keys
+from flask import render_template, redirect, url_for, request, flash, jsonify, abort
+from larva_service import app, db, dataset_queue, redis_connection, invalidate_choices
+from larva_service.models.dataset import Dataset, match_variables, dataset_query, covering
+from larva_service.serialize import projection, api_document, response, stream
+from larva_service.responses import Cached, cached, invalidate
 from larva_service.views.helpers import requires_auth
 from larva_service.tasks.dataset import calc
 from rq import cancel_job
+from shapely.wkt import loads
 
 @app.route('/dataset', methods=['POST'])
 @requires_auth
@@ -21,24 +23,85 @@ def add_dataset():
     flash("Dataset created", 'success')
     return redirect(url_for('datasets'))
 
+VARIABLES_PER_PAGE = 50
+MAX_VARIABLES_PER_PAGE = 500
+
+
+def dataset_fields():
+    # Variables can be MBs for large model grids, only sent when asked for
+    if request.args.get('variables', '').lower() in ['true', '1', 'yes']:
+        return Dataset.api_fields + ['variables']
+    return Dataset.api_fields
+
+
+def dataset_filter():
+    """
+    The geometry (from ?contains=<WKT>) and time span (?start=, ?end=) the
+    datasets listed must cover.  Raises ValueError when they can't be read.
+    """
+    from paegan.utils.datetime import datetime_parser
+
+    geometry = starting = ending = None
+    if request.args.get('contains'):
+        try:
+            geometry = loads(request.args.get('contains'))
+        except Exception:
+            raise ValueError("contains must be WKT")
+    try:
+        if request.args.get('start'):
+            starting = datetime_parser(request.args.get('start'))
+        if request.args.get('end'):
+            ending = datetime_parser(request.args.get('end'))
+    except Exception:
+        raise ValueError("start and end must be dates")
+    return geometry, starting, ending
+
+
+def find_datasets(fields=None):
+    """
+    The datasets covering this request's dataset_filter(), best first when
+    filtered by geometry
+    """
+    geometry, starting, ending = dataset_filter()
+    if fields is None:
+        fields = { 'variables' : False }
+    elif geometry is not None:
+        fields = dict(fields, footprint=True)
+
+    if geometry is None and starting is None and ending is None:
+        return db.datasets.find({}, fields)
+    return covering(db.datasets.find(dataset_query(geometry, starting, ending), fields), geometry)
+
+
 @app.route('/datasets', methods=['GET'])
 @app.route('/datasets.<string:format>', methods=['GET'])
 def datasets(format=None):
+    """
+    The datasets, or with ?contains=<WKT>&start=&end= only those covering
+    that geometry and time span, best first
+    """
     if format is None:
         format = 'html'
 
-    datasets = db.Dataset.find()
-
     if format == 'html':
+        try:
+            datasets = [db.Dataset(doc) for doc in find_datasets()]
+        except ValueError as e:
+            flash(unicode(e), 'warning')
+            return redirect(url_for('datasets'))
         return render_template('datasets.html', datasets=datasets)
     elif format == 'json':
-        jsond = []
-        for ds in datasets:
-            js = json.loads(ds.to_json())
-            remove_mongo_keys(js)
-            js['_id'] = unicode(ds._id)
-            jsond.append(js)
-        return jsonify( { 'results' : jsond } )
+        fields = dataset_fields()
+
+        def build():
+            docs = find_datasets(projection(fields))
+            return Cached(stream('results', (api_document(doc, fields) for doc in docs)))
+
+        try:
+            dataset_filter()
+        except ValueError as e:
+            return jsonify( { 'results' : unicode(e) } ), 400
+        return cached(["datasets"], build)
     else:
         flash("Response format '%s' not supported" % format, 'warning')
         return redirect(url_for('datasets'))
@@ -49,21 +112,56 @@ def show_dataset(dataset_id, format=None):
     if format is None:
         format = 'html'
 
-    dataset = db.Dataset.find_one( { '_id' : dataset_id } )
-
     if format == 'html':
-        variables = json.dumps(dataset.variables, sort_keys=True, indent=4)
+        dataset = db.Dataset.find_one( { '_id' : dataset_id }, { 'variables' : False } )
         markers = dataset.google_maps_coordinates()
-        return render_template('show_dataset.html', dataset=dataset, markers=markers, variables=variables)
+        return render_template('show_dataset.html', dataset=dataset, markers=markers, per_page=VARIABLES_PER_PAGE)
     elif format == 'json':
-        jsond = json.loads(dataset.to_json())
-        remove_mongo_keys(jsond) #destructive method
-        jsond['_id'] = unicode(dataset._id)
-        return jsonify( jsond )
+        fields = dataset_fields()
+
+        def build():
+            dataset = db.Dataset.find_one( { '_id' : dataset_id }, projection(fields) )
+            if dataset is None:
+                abort(404)
+            updated = dataset.updated or dataset.created
+            return Cached(response( api_document(dataset, fields) ), last_modified=updated, validator=updated)
+        return cached(["datasets:all", "datasets:%s" % dataset_id], build)
     else:
         flash("Reponse format '%s' not supported" % format, 'warning')
         return redirect(url_for('datasets'))
 
+@app.route('/datasets/<ObjectId:dataset_id>/variables', methods=['GET'])
+@app.route('/datasets/<ObjectId:dataset_id>/variables.<string:format>', methods=['GET'])
+def dataset_variables(dataset_id, format=None):
+    """
+    A page of a dataset's variables and their attributes, sorted by name.
+
+    * q: only variables whose name, standard_name or long_name contain it
+    * standard_name: only variables with this standard_name
+    * page, per_page: 1 based page number and page size
+    """
+    if format is None:
+        format = 'json'
+    if format != 'json':
+        return jsonify( { 'results' : "Response format '%s' not supported" % format } ), 400
+
+    try:
+        page = max(1, int(request.args.get('page', 1)))
+        per_page = min(MAX_VARIABLES_PER_PAGE, max(1, int(request.args.get('per_page', VARIABLES_PER_PAGE))))
+    except ValueError:
+        return jsonify( { 'results' : "page and per_page must be integers" } ), 400
+
+    def build():
+        doc = db.datasets.find_one( { '_id' : dataset_id }, { 'variables' : True, 'updated' : True } )
+        if doc is None:
+            abort(404)
+        matched = match_variables(doc.get('variables'), q=request.args.get('q'), standard_name=request.args.get('standard_name'))
+        start = (page - 1) * per_page
+        results = [{ 'name' : name, 'attributes' : attributes } for name, attributes in matched[start:start + per_page]]
+        return Cached(response( { 'total' : len(matched), 'page' : page, 'per_page' : per_page, 'results' : results } ),
+                      last_modified=doc.get('updated'), validator=doc.get('updated'))
+    return cached(["datasets:all", "datasets:%s" % dataset_id], build)
+
 @app.route('/datasets/<ObjectId:dataset_id>/delete', methods=['GET'])
 @app.route('/datasets/<ObjectId:dataset_id>/delete.<string:format>', methods=['GET'])
 @requires_auth
@@ -122,4 +220,6 @@ def schedule_dataset(dataset_id, format=None):
 @requires_auth
 def clear_datasets():
     db.drop_collection("datasets")
+    invalidate("datasets", "datasets:all")
+    invalidate_choices()
     return redirect(url_for('datasets'))
@@ -1,5 +1,7 @@
 from flask import render_template, make_response, redirect
-from larva_service import app
+from larva_service import app, db, cache, redis_connection, run_queue, particle_queue, dataset_queue, shoreline_queue, analysis_queue
+from larva_service.metrics import render
+from larva_service.retention import from_config
 from larva_service.views.helpers import requires_auth
 
 
@@ -15,7 +17,13 @@ def admin():
     show_keys = ['OUTPUT_PATH', 'SHORE_PATH', 'BATHY_PATH', 'CACHE_PATH', 'DEBUG', 'TESTING', 'NON_S3_OUTPUT_URL']
     environ = { g: v for g, v in app.config.items() if g in show_keys }
 
-    return render_template('admin.html', environment=environ)
+    # Walking the run directories takes a while with many runs
+    disk = cache.get('disk_usage')
+    if disk is None:
+        disk = from_config(app.config, db, redis_connection).summary()
+        cache.set('disk_usage', disk, timeout=300)
+
+    return render_template('admin.html', environment=environ, disk=disk)
 
 
 @requires_auth
@@ -24,6 +32,13 @@ def jobs():
     return redirect('/rq')
 
 
+@app.route('/metrics', methods=['GET'])
+def metrics():
+    response = make_response(render([run_queue, particle_queue, dataset_queue, shoreline_queue, analysis_queue]))
+    response.headers["Content-type"] = "text/plain; version=0.0.4"
+    return response
+
+
 @app.route('/crossdomain.xml', methods=['GET'])
 def crossdomain():
     domain = """
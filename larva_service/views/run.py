@@ -1,43 +1,90 @@
 import os
 import json
 from urlparse import urlparse
+from StringIO import StringIO
+
+import numpy as np
 
 import requests
 
 from rq import cancel_job
 from pymongo import DESCENDING
-from flask import render_template, redirect, url_for, request, flash, jsonify, send_file, abort
-
-
-from larva_service import app, db, run_queue, redis_connection, cache
-from larva_service.models import remove_mongo_keys
-from larva_service.models.run import Run
+from flask import render_template, redirect, url_for, request, flash, jsonify, send_file, abort, make_response
+
+
+from larva_service import app, db, run_queue, redis_connection, cache, choices_version
+from larva_service.models.run import Run, run_status, file_key_and_link
+from larva_service.models.trackline import delete_trackline
+from larva_service.exports import EXPORTERS
+from larva_service.particles import ParticleStore
+from larva_service.density import cached_density, to_png
+from larva_service.locality import enqueue
+from larva_service.retention import touch
+from larva_service.hydro_cache import release
+from larva_service.runlog import tail
+from larva_service.compression import PRECOMPRESSED, sidecar, accepts
+from larva_service.serialize import projection, api_document, response, stream
+from larva_service.responses import Cached, cached, invalidate
 
 from larva_service.views.helpers import requires_auth
-from larva_service.tasks.local import run as local_run
-from larva_service.tasks.distributed import run as distributed_run
 
 from flask_wtf import Form
-from wtforms.fields import StringField, RadioField, TextAreaField, SelectField
+from wtforms.fields import StringField, RadioField, TextAreaField, SelectField, SelectMultipleField
 from wtforms.fields.html5 import URLField, DateField, IntegerField, DecimalField, EmailField
 from wtforms.validators import DataRequired, url, Email, NumberRange, Optional, InputRequired
 
 
+# Enqueued by name so the web tier never imports paegan
+LOCAL_RUN = 'larva_service.tasks.local.run'
+DISTRIBUTED_RUN = 'larva_service.tasks.distributed.run'
+
+
+def enqueue_run(run):
+    if urlparse(run.hydro_path).scheme != '':
+        # DAP, use the CachingModelController
+        return run_queue.enqueue_call(func=LOCAL_RUN, args=(unicode(run['_id']),))
+    # Local file path, use the DistributedModelController, preferably on a host with the files warm
+    resources = [run.hydro_path, run.shoreline_path or app.config.get("SHORE_PATH"), app.config.get("BATHY_PATH")]
+    return enqueue(run_queue, resources, fallback=app.config['LOCALITY_FALLBACK_SECONDS'], func=DISTRIBUTED_RUN, args=(unicode(run['_id']),))
+
+
+def finished_run(run, response):
+    """
+    Cached responses of finished runs are final, those of the others change
+    with the run's status
+    """
+    if run.task_result:
+        return Cached(response, last_modified=run.ended, final=True, validator=run.ended)
+    return Cached(response, live=True)
+
+
+def cached_choices(name, compute):
+    key = '{}:{}'.format(name, choices_version())
+    choices = cache.get(key)
+    if choices is None:
+        choices = compute()
+        cache.set(key, choices)
+    return choices
+
+
 def dataset_choices():
-    with app.app_context():
-        return [(s.location, '{}: {:%b %d %Y} to {:%b %d %Y}'.format(s.name, s.starting, s.ending) ) for s in db.Dataset.find().sort('name')]
+    def compute():
+        docs = db.datasets.find({}, projection(['name', 'location', 'starting', 'ending'])).sort('name')
+        return [(s['location'], '{}: {:%b %d %Y} to {:%b %d %Y}'.format(s['name'], s['starting'], s['ending']) ) for s in docs]
+    return cached_choices('dataset_choices', compute)
 
 
 def shoreline_choices():
-    with app.app_context():
-        return [(s.path, s.name) for s in db.Shoreline.find().sort('name')]
+    def compute():
+        return [(s['path'], s['name']) for s in db.shorelines.find({}, projection(['name', 'path'])).sort('name')]
+    return cached_choices('shoreline_choices', compute)
 
 
 class RunForm(Form):
     name             = StringField('Name', validators=[ DataRequired() ], description='A unique and human readable name for this run, ie. "Montague Island 2006 - PWS Hindcast"')
     behavior         = SelectField('Behavior', validators=[ Optional() ])
     particles        = IntegerField('Particles', validators=[ NumberRange(min=1, max=200, message="Must be between 1 and 200.") ], description="The number of particles to force")
-    dataset          = RadioField('Hydro model', validators=[ DataRequired() ], choices=dataset_choices())
+    dataset          = RadioField('Hydro model', validators=[ DataRequired() ], choices=[])
     geometry         = TextAreaField('Starting position', validators=[ DataRequired() ], description="Point or Polygon geometry as a WKT string. Create using http://arthur-e.github.io/Wicket/sandbox-gmaps3.html.")
     release_depth    = DecimalField("Release depth", validators=[ InputRequired() ], description="Starting depth, in meters")
     start            = DateField('Start', validators=[ DataRequired() ])
@@ -49,7 +96,8 @@ class RunForm(Form):
     horiz_chunk      = IntegerField('Grid cache', default=Run.default_values['horiz_chunk'], description="Tune the local Grid cache when using DAP models")
     time_method      = RadioField('Time method', choices=[('nearest', 'Nearest'), ('interp', 'Interpolate')], default=Run.default_values['time_method'])
     email            = EmailField('Email', validators=[ Email() ])
-    shoreline        = RadioField('Shoreline', validators=[ DataRequired() ], choices=shoreline_choices())
+    shoreline        = RadioField('Shoreline', validators=[ DataRequired() ], choices=[])
+    output_formats   = SelectMultipleField('Output formats', choices=[ (f, f.replace('_', ' ').capitalize()) for f in EXPORTERS.keys() ], default=Run.default_values['output_formats'], description="Exports to produce when the run finishes")
 
 
 @app.route('/run', methods=['GET', 'POST'])
@@ -78,16 +126,18 @@ def run_larva_model(format=None):
 
     run = db.Run()
     run.load_run_config(config_dict)
+    if not run.select_hydro_path():
+        message = "No dataset covers the run's geometry and time span"
+        if format == 'html':
+            flash(message, 'danger')
+            return redirect(url_for('runs'))
+        elif format == 'json':
+            return jsonify( { 'results' : message } ), 400
     run.save()
 
     # Enqueue
 
-    if urlparse(run.hydro_path).scheme != '':
-        # DAP, use the CachingModelController
-        job = run_queue.enqueue_call(func=local_run, args=(unicode(run['_id']),))
-    else:
-        # Local file path, use the DistributedModelController
-        job = run_queue.enqueue_call(func=distributed_run, args=(unicode(run['_id']),))
+    job = enqueue_run(run)
 
     run.task_id = unicode(job.id)
     run.save()
@@ -116,6 +166,8 @@ def submit():
 
     form = RunForm()
     form.behavior.choices = behavior_choices()
+    form.dataset.choices = dataset_choices()
+    form.shoreline.choices = shoreline_choices()
 
     if not form.validate_on_submit():
         return render_template('submit.html', form=form)
@@ -151,6 +203,7 @@ def submit():
         config_dict['horiz_chunk'] = form.horiz_chunk.data
         config_dict['time_method'] = form.time_method.data
         config_dict['email'] = form.email.data
+        config_dict['output_formats'] = form.output_formats.data
 
         app.logger.info(config_dict)
 
@@ -163,12 +216,7 @@ def submit():
         run.load_run_config(config_dict)
         run.save()
         # Enqueue
-        if urlparse(run.hydro_path).scheme != '':
-            # DAP, use the CachingModelController
-            job = run_queue.enqueue_call(func=local_run, args=(unicode(run['_id']),))
-        else:
-            # Local file path, use the DistributedModelController
-            job = run_queue.enqueue_call(func=distributed_run, args=(unicode(run['_id']),))
+        job = enqueue_run(run)
         run.task_id = unicode(job.id)
         run.save()
         flash('Run created', 'success')
@@ -185,6 +233,11 @@ def delete_run(run_id, format=None):
     run = db.Run.find_one( { '_id' : run_id } )
     cancel_job(run.task_id, connection=redis_connection)
     run.delete()
+    delete_trackline(run_id)
+    try:
+        release(run.hydro_cache, app.config, db)
+    except Exception:
+        app.logger.exception("Could not release the forcing data of run %s" % run_id)
 
     if format == 'json':
         return jsonify( { 'status' : "success" })
@@ -197,6 +250,9 @@ def delete_run(run_id, format=None):
 @requires_auth
 def clear_runs():
     db.drop_collection("runs")
+    db.drop_collection("tracklines")
+    # Responses of single runs are also keyed on "runs:all"
+    invalidate("runs", "runs:all")
     return redirect(url_for('runs'))
 
 
@@ -206,20 +262,23 @@ def runs(format=None):
     if format is None:
         format = 'html'
 
-    runs = db.Run.find().sort('created', DESCENDING)
-
     if format == 'html':
+        runs = db.Run.find().sort('created', DESCENDING)
         return render_template('runs.html', runs=runs)
     elif format == 'json':
-        jsond = []
-        for run in runs:
-            js = json.loads(run.to_json())
-            remove_mongo_keys(js, extra=['output', 'cached_behavior', 'task_result', 'task_id'])
-            js['_id'] = unicode(run._id)
-            js['status'] = unicode(run.status())
-            js['output'] = list(run.output_files())
-            jsond.append(js)
-        return jsonify( { 'results' : jsond } )
+        def build():
+            docs = db.runs.find({}, projection(Run.api_fields + ['output', 'task_result', 'task_id'])).sort('created', DESCENDING)
+            # The statuses of unfinished runs change without the runs being saved
+            live = db.runs.find({ 'task_result' : { '$in' : [None, u''] } }).limit(1).count(True) > 0
+
+            def results():
+                for doc in docs:
+                    js = api_document(doc, Run.api_fields)
+                    js['status'] = unicode(run_status(doc.get('task_result'), doc.get('task_id')))
+                    js['output'] = [file_key_and_link(doc['_id'], f) for f in doc.get('output') or []]
+                    yield js
+            return Cached(stream('results', results()), live=live)
+        return cached(["runs"], build)
     else:
         flash("Reponse format '%s' not supported" % format, 'warning')
         return redirect(url_for('runs'))
@@ -231,26 +290,55 @@ def show_run(run_id, format=None):
     if format is None:
         format = 'html'
 
-    run = db.Run.find_one( { '_id' : run_id } )
-
     if format == 'html':
+        run = db.Run.find_one( { '_id' : run_id } )
+        # Viewing a run keeps its output from being evicted first
+        touch(redis_connection, run_id)
         markers = run.google_maps_coordinates()
-        linestring = run.google_maps_trackline()
+        trackline = run.get_trackline()
+        linestring = run.google_maps_trackline(trackline)
         run_config = json.dumps(run.run_config(), sort_keys=True, indent=4)
         cached_behavior = json.dumps(run.cached_behavior, sort_keys=True, indent=4)
-        return render_template('show_run.html', run=run, run_config=run_config, cached_behavior=cached_behavior, line=linestring, markers=markers)
+        log_tail = tail(str(run._id), redis_connection)
+        return render_template('show_run.html', run=run, run_config=run_config, cached_behavior=cached_behavior, line=linestring, markers=markers, log_tail=log_tail,
+                               trackline=json.dumps(trackline, sort_keys=True) if trackline else None)
     elif format == 'json':
-        jsond = json.loads(run.to_json())
-        remove_mongo_keys(jsond, extra=['output', 'task_result', 'task_id'])
-        jsond['_id'] = unicode(run._id)
-        jsond['status'] = unicode(run.status())
-        jsond['output'] = list(run.output_files())
-        return jsonify( jsond )
+        def build():
+            run = db.Run.find_one( { '_id' : run_id } )
+            if run is None:
+                abort(404)
+            jsond = api_document(run, Run.api_fields + ['cached_behavior'])
+            jsond['status'] = unicode(run.status())
+            jsond['output'] = list(run.output_files())
+            trackline = run.get_trackline()
+            jsond['trackline'] = unicode(json.dumps(trackline, sort_keys=True)) if trackline else None
+            return finished_run(run, response( jsond ))
+        return cached(["runs:all", "runs:%s" % run_id], build)
     else:
         flash("Reponse format '%s' not supported" % format, 'warning')
         return redirect(url_for('runs'))
 
 
+@app.route('/runs/<ObjectId:run_id>/trackline', methods=['GET'])
+@app.route('/runs/<ObjectId:run_id>/trackline.<string:format>', methods=['GET'])
+def run_trackline(run_id, format=None):
+    if format is None:
+        format = 'geojson'
+
+    if format not in ['geojson', 'json']:
+        return jsonify( { 'results' : "Response format '%s' not supported" % format } ), 400
+
+    def build():
+        run = db.Run.find_one( { '_id' : run_id } )
+        if run is None:
+            abort(404)
+        trackline = run.get_trackline()
+        if trackline is None:
+            abort(404)
+        return finished_run(run, response( trackline ))
+    return cached(["runs:all", "runs:%s" % run_id], build)
+
+
 @app.route('/runs/<ObjectId:run_id>/status', methods=['GET'])
 @app.route('/runs/<ObjectId:run_id>/status.<string:format>', methods=['GET'])
 def status_run(run_id, format=None):
@@ -267,12 +355,87 @@ def status_run(run_id, format=None):
         return redirect(url_for('runs'))
 
 
+@app.route('/runs/<ObjectId:run_id>/log', methods=['GET'])
+def run_log(run_id):
+    # The last lines of the run's log, kept for a week after the run
+    return jsonify( { 'lines' : tail(str(run_id), redis_connection) } )
+
+
 @app.route('/runs/<ObjectId:run_id>/run_config', methods=['GET'])
 def run_config(run_id):
     run = db.Run.find_one( { '_id' : run_id } )
     return jsonify( run.run_config() )
 
 
+@app.route('/runs/<ObjectId:run_id>/particles', methods=['GET'])
+@app.route('/runs/<ObjectId:run_id>/particles.<string:format>', methods=['GET'])
+def run_particles(run_id, format=None):
+    run = db.Run.find_one( { '_id' : run_id } )
+    if run is None or not run.particle_store or not os.path.exists(run.particle_store):
+        abort(404)
+
+    try:
+        bbox = None
+        if request.args.get('bbox'):
+            bbox = [float(v) for v in request.args.get('bbox').split(',')]
+            if len(bbox) != 4:
+                raise ValueError("bbox must be minx,miny,maxx,maxy")
+
+        fields = None
+        if request.args.get('fields'):
+            fields = [f.strip() for f in request.args.get('fields').split(',')]
+
+        result = ParticleStore(run.particle_store).query_json(time=request.args.get('time'), bbox=bbox, fields=fields)
+    except ValueError as e:
+        return jsonify( { 'results' : e.message } ), 400
+
+    return jsonify(result)
+
+
+@app.route('/runs/<ObjectId:run_id>/density', methods=['GET'])
+@app.route('/runs/<ObjectId:run_id>/density.<string:format>', methods=['GET'])
+def run_density(run_id, format=None):
+    if format is None:
+        format = 'json'
+
+    run = db.Run.find_one( { '_id' : run_id } )
+    if run is None or not run.particle_store or not os.path.exists(run.particle_store):
+        abort(404)
+
+    try:
+        cell_size = float(request.args.get('cell', 0.01))
+        if cell_size <= 0:
+            raise ValueError("cell must be positive")
+
+        bbox = None
+        if request.args.get('bbox'):
+            bbox = [float(v) for v in request.args.get('bbox').split(',')]
+            if len(bbox) != 4:
+                raise ValueError("bbox must be minx,miny,maxx,maxy")
+
+        bounds, values = cached_density(run.particle_store, cell_size, time=request.args.get('time'), bbox=bbox, kind=request.args.get('kind', 'density'),
+                                        max_entries=app.config.get('DENSITY_CACHE_ENTRIES'))
+    except ValueError as e:
+        return jsonify( { 'results' : e.message } ), 400
+
+    if format == 'json':
+        return jsonify( { 'bounds' : list(bounds), 'cell' : cell_size, 'shape' : list(values.shape), 'values' : np.round(values, 6).tolist() } )
+    elif format == 'png':
+        response = make_response(to_png(values))
+        response.headers['Content-Type'] = 'image/png'
+        response.headers['X-Bounds'] = ','.join(str(b) for b in bounds)
+        return response
+    elif format == 'npy':
+        buf = StringIO()
+        np.save(buf, values.astype(np.float32))
+        response = make_response(buf.getvalue())
+        response.headers['Content-Type'] = 'application/octet-stream'
+        response.headers['X-Bounds'] = ','.join(str(b) for b in bounds)
+        return response
+    else:
+        return jsonify( { 'results' : "Response format '%s' not supported" % format } ), 400
+
+
 @app.route("/runs/<ObjectId:run_id>/output/<string:filename>", methods=['GET'])
 def run_output_download(run_id, filename):
     # Avoid being able to download ".." and "/"
@@ -280,6 +443,13 @@ def run_output_download(run_id, filename):
         abort(404)
 
     run = db.Run.find_one( { '_id' : run_id } )
+    touch(redis_connection, run_id)
     for f in run.output:
         if os.path.basename(f) == filename:
+            compressed = sidecar(f)
+            if compressed is not None and accepts('gzip'):
+                rv = send_file(compressed, mimetype=PRECOMPRESSED[os.path.splitext(f)[1]])
+                rv.headers['Content-Encoding'] = 'gzip'
+                rv.vary.add('Accept-Encoding')
+                return rv
             return send_file(f)
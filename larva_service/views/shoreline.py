@@ -1,11 +1,12 @@
-from flask import render_template, redirect, url_for, request, flash, jsonify
-from larva_service import app, db, shoreline_queue, redis_connection
+from flask import render_template, redirect, url_for, request, flash, jsonify, abort
+from larva_service import app, db, shoreline_queue, redis_connection, invalidate_choices
 from larva_service.models.shoreline import Shoreline
 from larva_service.tasks.shoreline import get_info
 from larva_service.views.helpers import requires_auth
 import json
 import pytz
-from larva_service.models import remove_mongo_keys
+from larva_service.serialize import projection, api_document, response, stream
+from larva_service.responses import Cached, cached, invalidate
 from pymongo import DESCENDING
 from rq import cancel_job
 from shapely.geometry import box
@@ -16,18 +17,14 @@ def shorelines(format=None):
     if format is None:
         format = 'html'
 
-    shorelines = db.Shoreline.find().sort('created', DESCENDING)
-
     if format == 'html':
+        shorelines = db.Shoreline.find().sort('created', DESCENDING)
         return render_template('shorelines.html', shorelines=shorelines)
     elif format == 'json':
-        jsonsl = []
-        for sl in shorelines:
-            js = json.loads(sl.to_json())
-            remove_mongo_keys(js)
-            js['_id'] = unicode(sl._id)
-            jsonsl.append(js)
-        return jsonify( { 'results' : jsonsl } )
+        def build():
+            docs = db.shorelines.find({}, projection(Shoreline.api_fields)).sort('created', DESCENDING)
+            return Cached(stream('results', (api_document(doc, Shoreline.api_fields) for doc in docs)))
+        return cached(["shorelines"], build)
     else:
         flash("Response format '%s' not supported" % format, 'danger')
         return redirect(url_for('shorelines'))
@@ -63,16 +60,18 @@ def show_shoreline(shoreline_id, format=None):
     if format is None:
         format = 'html'
 
-    shoreline = db.Shoreline.find_one( { '_id' : shoreline_id } )
-
     if format == 'html':
+        shoreline = db.Shoreline.find_one( { '_id' : shoreline_id } )
         markers = shoreline.google_maps_coordinates()
         return render_template('show_shoreline.html', shoreline=shoreline, markers=markers)
     elif format == 'json':
-        jsond = json.loads(shoreline.to_json())
-        remove_mongo_keys(jsond) #destructive method
-        jsond['_id'] = unicode(shoreline._id)
-        return jsonify( jsond )
+        def build():
+            shoreline = db.Shoreline.find_one( { '_id' : shoreline_id } )
+            if shoreline is None:
+                abort(404)
+            updated = shoreline.updated or shoreline.created
+            return Cached(response( api_document(shoreline, Shoreline.api_fields) ), last_modified=updated, validator=updated)
+        return cached(["shorelines:all", "shorelines:%s" % shoreline_id], build)
     else:
         flash("Reponse format '%s' not supported" % format, 'danger')
         return redirect(url_for('shorelines'))
@@ -98,4 +97,6 @@ def delete_shoreline(shoreline_id, format=None):
 @requires_auth
 def clear_shorelines():
     db.drop_collection("shorelines")
+    invalidate("shorelines", "shorelines:all")
+    invalidate_choices()
     return redirect(url_for('shorelines'))
@@ -0,0 +1,47 @@
+from tests.flask_mongo import FlaskMongoTestCase
+import os
+import shutil
+import tempfile
+
+from shapely.geometry import box
+
+from larva_service import app, db
+from larva_service.shoreline_index import build_index
+from larva_service.tasks.analysis import land_for_run
+
+SHORE_PATH = u"/data/shore.shp"
+
+
+class FakeRun(object):
+
+    def __init__(self, shoreline_feature=u''):
+        self.shoreline_path = SHORE_PATH
+        self.shoreline_feature = shoreline_feature
+        self.summary = { 'bounds' : [0., 0., 3., 3.] }
+        self.particle_store = u''
+
+
+class AnalysisTestCase(FlaskMongoTestCase):
+
+    def setUp(self):
+        super(AnalysisTestCase, self).setUp()
+        self.folder = tempfile.mkdtemp()
+        # Two layers of the same shapefile
+        for feature, geom in [(u"coast", box(0, 0, 1, 1)), (u"islands", box(2, 2, 3, 3))]:
+            shoreline = db.Shoreline()
+            shoreline.name = feature
+            shoreline.path = SHORE_PATH
+            shoreline.feature_name = feature
+            shoreline.index_path = unicode(os.path.join(self.folder, feature))
+            build_index([geom], shoreline.index_path)
+            shoreline.save()
+
+    def tearDown(self):
+        self.db.drop_collection("shorelines")
+        shutil.rmtree(self.folder, ignore_errors=True)
+        super(AnalysisTestCase, self).tearDown()
+
+    def test_land_for_run_uses_the_run_feature(self):
+        with app.app_context():
+            assert land_for_run(FakeRun(u"islands"), 0).bounds == (2., 2., 3., 3.)
+            assert land_for_run(FakeRun(u"coast"), 0).bounds == (0., 0., 1., 1.)
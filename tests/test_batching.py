@@ -0,0 +1,84 @@
+import json
+import time
+import unittest
+
+import redis
+
+from larva_service import app
+from larva_service.batching import batch_size, batches, run_batch
+from larva_service.resources import MemoryCeilingExceeded
+
+
+class FakeParticle(object):
+
+    def __init__(self, uid):
+        self.uid = uid
+
+
+class FakeModel(object):
+
+    redis_results_channel = "larva_service_test:results"
+
+    def __init__(self):
+        self.redis_url = app.config['REDIS_URI']
+
+
+class FakeMonitor(object):
+
+    exceeded = None
+
+
+class BatchingTestCase(unittest.TestCase):
+
+    def test_batch_size_spreads_over_workers(self):
+        # Unknown particle times, two tasks per worker
+        assert batch_size(200, 24, 4) == 25
+        assert batch_size(3, 24, 4) == 1
+        assert batch_size(10, 24, 0) == 5
+
+    def test_batch_size_from_particle_times(self):
+        # 0.01s a step, 24 steps: 250 particles fill a minute
+        assert batch_size(200, 24, 4, step_seconds=0.01) == 25
+        # 1s a step, 24 steps: each particle alone takes longer than the target
+        assert batch_size(200, 24, 4, step_seconds=1.) == 3
+        assert batch_size(200, 240, 4, step_seconds=1.) == 1
+
+    def test_fixed_batch_size(self):
+        assert batch_size(200, 24, 4, step_seconds=1., fixed=10) == 10
+
+    def test_batches(self):
+        assert batches(range(5), 2) == [[0, 1], [2, 3], [4]]
+        assert batches(range(5), 10) == [range(5)]
+
+    def test_batch_over_the_ceiling(self):
+        model = FakeModel()
+        monitor = FakeMonitor()
+        parts = [FakeParticle(i) for i in range(4)]
+        ran = []
+
+        def runner(part, model):
+            ran.append(part.uid)
+            if part.uid == 1:
+                # Caught by paegan's particle_runner, which fails only this particle
+                monitor.exceeded = "Memory ceiling of 1 MB exceeded"
+
+        pubsub = redis.from_url(model.redis_url).pubsub()
+        pubsub.subscribe(model.redis_results_channel)
+        assert pubsub.get_message(timeout=1)['type'] == 'subscribe'
+        with self.assertRaises(MemoryCeilingExceeded):
+            run_batch(parts, model, monitor, runner=runner)
+        assert ran == [0, 1]
+
+        failed = []
+        deadline = time.time() + 2
+        while len(failed) < 2 and time.time() < deadline:
+            message = pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+            if message is not None:
+                failed.append(json.loads(message['data']))
+        pubsub.close()
+        assert failed == [{ 'status' : 'FAILED', 'uid' : 2 }, { 'status' : 'FAILED', 'uid' : 3 }]
+
+    def test_batch_under_the_ceiling(self):
+        ran = []
+        run_batch([FakeParticle(i) for i in range(3)], FakeModel(), FakeMonitor(), runner=lambda part, model: ran.append(part.uid))
+        assert ran == [0, 1, 2]
@@ -0,0 +1,78 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from larva_service.bathymetry import BathyGrid, grid_path, remove_old_grids
+
+
+class BathyGridTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "bathy")
+
+        # 3x4 grid, depth increases by 1m per cell eastward and 10m per cell northward
+        values = -(np.arange(4)[np.newaxis, :] + 10 * np.arange(3)[:, np.newaxis]).astype(np.float32)
+        np.save(self.path + ".npy", values)
+        with open(self.path + ".json", "w") as f:
+            json.dump({ 'x0' : -150., 'y0' : 60., 'dx' : 0.5, 'dy' : 0.5, 'shape' : [3, 4] }, f)
+
+        self.grid = BathyGrid(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_grid_nodes(self):
+        depths = self.grid.depth([-150., -149., -148.5], [60., 60.5, 61.])
+        assert np.allclose(depths, [0., -12., -23.])
+
+    def test_interpolated_batch(self):
+        depths = self.grid.depth([-149.75, -149.25], [60.25, 60.75])
+        assert np.allclose(depths, [-5.5, -16.5])
+
+    def test_outside_grid_is_clamped(self):
+        depths = self.grid.depth([-160., -140.], [50., 70.])
+        assert np.allclose(depths, [0., -23.])
+
+
+class GridPathTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.sources = []
+        for name in ["a", "b"]:
+            os.makedirs(os.path.join(self.folder, name))
+            source = os.path.join(self.folder, name, "bathy.nc")
+            with open(source, "w") as f:
+                f.write("x" * 10)
+            self.sources.append(source)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_same_file_names_get_their_own_grid(self):
+        a, b = [grid_path(s) for s in self.sources]
+        assert a != b
+        assert os.path.basename(a).startswith("bathy-")
+        assert grid_path(os.path.join(self.folder, "a", "..", "a", "bathy.nc")) == a
+
+    def test_changed_source_gets_a_new_grid(self):
+        before = grid_path(self.sources[0])
+        with open(self.sources[0], "w") as f:
+            f.write("x" * 20)
+        assert grid_path(self.sources[0]) != before
+
+    def test_remove_old_grids(self):
+        grids = os.path.join(self.folder, "grids")
+        os.makedirs(grids)
+        for name, source in [("old", self.sources[0]), ("new", self.sources[0]), ("other", self.sources[1])]:
+            np.save(os.path.join(grids, name + ".npy"), np.zeros(1))
+            with open(os.path.join(grids, name + ".json"), "w") as f:
+                json.dump({ 'source' : source }, f)
+
+        remove_old_grids(self.sources[0], os.path.join(grids, "new"))
+        assert sorted(os.listdir(grids)) == ["new.json", "new.npy", "other.json", "other.npy"]
@@ -0,0 +1,47 @@
+import os
+import gzip
+import json
+import shutil
+import tempfile
+import unittest
+
+from larva_service.compression import precompress, sidecar, is_sidecar, gzip_bytes
+
+
+class CompressionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.trackline = os.path.join(self.folder, "particle_multipoint.geojson")
+        with open(self.trackline, "w") as f:
+            json.dump({ 'type' : 'MultiPoint', 'coordinates' : [[-147 + k * 0.001, 60.75] for k in range(2000)] }, f)
+        with open(os.path.join(self.folder, "small.json"), "w") as f:
+            f.write("{}")
+        with open(os.path.join(self.folder, "model.log.gz"), "w") as f:
+            f.write(gzip_bytes("log line\n" * 1000))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_precompress(self):
+        written = precompress(self.folder)
+        assert written == [self.trackline + ".gz"]
+        assert sidecar(self.trackline) == self.trackline + ".gz"
+        assert sidecar(os.path.join(self.folder, "small.json")) is None
+
+        f = gzip.open(self.trackline + ".gz")
+        try:
+            assert f.read() == open(self.trackline).read()
+        finally:
+            f.close()
+        assert os.path.getsize(self.trackline + ".gz") * 5 < os.path.getsize(self.trackline)
+
+    def test_is_sidecar(self):
+        precompress(self.folder)
+        assert is_sidecar(self.trackline + ".gz")
+        assert not is_sidecar(self.trackline)
+        # Compressed output, not a copy of anything
+        assert not is_sidecar(os.path.join(self.folder, "model.log.gz"))
+
+    def test_gzip_bytes_is_stable(self):
+        assert gzip_bytes("x" * 5000) == gzip_bytes("x" * 5000)
@@ -0,0 +1,100 @@
+from tests.flask_mongo import FlaskMongoTestCase
+import json
+from datetime import datetime
+
+from larva_service import app, db
+from larva_service.models.dataset import footprint, index_datasets
+
+
+class DatasetSelectionTestCase(FlaskMongoTestCase):
+
+    def setUp(self):
+        super(DatasetSelectionTestCase, self).setUp()
+        self.datasets = []
+        for name, bbox in [(u"Gulf of Alaska", u"POLYGON ((-160 50, -130 50, -130 62, -160 62, -160 50))"),
+                           (u"PWS", u"POLYGON ((-148.5 59.5, -145.5 59.5, -145.5 61.5, -148.5 61.5, -148.5 59.5))")]:
+            dataset = db.Dataset()
+            dataset.name = name
+            dataset.location = u"http://example.com/thredds/dodsC/%s.nc" % name
+            dataset.bbox = bbox
+            dataset.starting = datetime(2012, 1, 1)
+            dataset.ending = datetime(2013, 1, 1)
+            dataset.save()
+            self.datasets.append(dataset)
+
+        with app.app_context():
+            index_datasets()
+
+    def tearDown(self):
+        self.db.drop_collection("datasets")
+        super(DatasetSelectionTestCase, self).tearDown()
+
+    def names(self, query):
+        return [d['name'] for d in json.loads(self.app.get('/datasets.json?' + query).data)['results']]
+
+    def test_footprint(self):
+        assert footprint(u"POINT (-147 60.75)") == { 'type' : 'Point', 'coordinates' : [-147, 60.75] }
+        assert footprint(u"POLYGON ((200 50, 210 50, 210 60, 200 60, 200 50))")['coordinates'][0][0] == [-160, 50]
+        assert footprint(u"POLYGON ((170 50, 190 50, 190 60, 170 60, 170 50))") is None
+        assert footprint(None) is None
+
+        # Wider than a hemisphere or reaching a pole
+        assert footprint(u"POLYGON ((-180 -90, 180 -90, 180 90, -180 90, -180 -90))") is None
+        assert footprint(u"POLYGON ((-100 0, 90 0, 90 10, -100 10, -100 0))") is None
+        assert footprint(u"POLYGON ((-10 80, 10 80, 10 90, -10 90, -10 80))") is None
+
+        # Falls back to the box when the polygon can't be indexed
+        islands = u"MULTIPOLYGON (((0 0, 1 0, 1 1, 0 1, 0 0)), ((2 0, 3 0, 3 1, 2 1, 2 0)))"
+        assert footprint(islands, u"POLYGON ((0 0, 3 0, 3 1, 0 1, 0 0))")['type'] == 'Polygon'
+
+    def test_unindexable_datasets_save(self):
+        dataset = db.Dataset()
+        dataset.name = u"Global"
+        dataset.location = u"http://example.com/thredds/dodsC/global.nc"
+        dataset.bbox = u"POLYGON ((-180 -90, 180 -90, 180 90, -180 90, -180 -90))"
+        dataset.save()
+        assert self.db['datasets'].find_one({ '_id' : dataset._id })['footprint'] is None
+
+    def test_contains(self):
+        assert self.names('contains=POINT (-147 60.75)') == [u"PWS", u"Gulf of Alaska"]
+        assert self.names('contains=POINT (-150 55)') == [u"Gulf of Alaska"]
+        assert self.names('contains=POINT (-120 55)') == []
+
+    def test_time_span(self):
+        assert self.names('contains=POINT (-147 60.75)&start=2012-06-01&end=2012-06-03') == [u"PWS", u"Gulf of Alaska"]
+        assert self.names('contains=POINT (-147 60.75)&start=2012-12-30&end=2013-01-03') == []
+
+        rv = self.app.get('/datasets.json?contains=nonsense')
+        assert rv.status_code == 400
+
+    def test_auto_hydro_path(self):
+        config = {
+            'particles'  : 10,
+            'duration'   : 2,
+            'start'      : "2012-06-01T00:00:00Z",
+            'timestep'   : 3600,
+            'geometry'   : "POINT (-147 60.75)",
+            'hydro_path' : "auto",
+        }
+        rv = self.app.post('/run.json', data=dict(config=json.dumps(config)))
+        run = self.db['runs'].find_one()
+        assert run['hydro_path'] == self.datasets[1].location
+
+        config['start'] = "2014-06-01T00:00:00Z"
+        rv = self.app.post('/run.json', data=dict(config=json.dumps(config)))
+        assert rv.status_code == 400
+        assert self.db['runs'].count() == 1
+
+    def test_conditional_listing(self):
+        rv = self.app.get('/datasets.json')
+        etag = rv.headers['ETag']
+        assert rv.headers['Cache-Control'] == "no-cache"
+
+        rv = self.app.get('/datasets.json', headers={ 'If-None-Match' : etag })
+        assert rv.status_code == 304
+
+        self.datasets[0].name = u"Renamed"
+        self.datasets[0].save()
+        rv = self.app.get('/datasets.json', headers={ 'If-None-Match' : etag })
+        assert rv.status_code == 200
+        assert u"Renamed" in [d['name'] for d in json.loads(rv.data)['results']]
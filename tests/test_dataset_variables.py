@@ -0,0 +1,46 @@
+from tests.flask_mongo import FlaskMongoTestCase
+import json
+
+from larva_service import db
+
+
+class DatasetVariablesTestCase(FlaskMongoTestCase):
+
+    def setUp(self):
+        super(DatasetVariablesTestCase, self).setUp()
+        self.dataset = db.Dataset()
+        self.dataset.name = u"ROMS"
+        self.dataset.location = u"http://example.com/thredds/dodsC/roms.nc"
+        self.dataset.variables = {
+            'u'    : { 'standard_name' : 'eastward_sea_water_velocity', 'units' : 'm/s' },
+            'v'    : { 'standard_name' : 'northward_sea_water_velocity', 'units' : 'm/s' },
+            'temp' : { 'standard_name' : 'sea_water_temperature', 'long_name' : 'Potential Temperature' },
+        }
+        self.dataset.save()
+
+    def tearDown(self):
+        self.dataset.delete()
+        super(DatasetVariablesTestCase, self).tearDown()
+
+    def test_excluded_from_listing(self):
+        results = json.loads(self.app.get('/datasets.json').data)['results']
+        assert 'variables' not in results[0]
+
+        results = json.loads(self.app.get('/datasets.json?variables=true').data)['results']
+        assert sorted(results[0]['variables'].keys()) == ['temp', 'u', 'v']
+
+    def test_pages(self):
+        rv = json.loads(self.app.get('/datasets/%s/variables.json?per_page=2' % self.dataset._id).data)
+        assert rv['total'] == 3
+        assert [v['name'] for v in rv['results']] == ['temp', 'u']
+
+        rv = json.loads(self.app.get('/datasets/%s/variables.json?per_page=2&page=2' % self.dataset._id).data)
+        assert [v['name'] for v in rv['results']] == ['v']
+
+    def test_filters(self):
+        rv = json.loads(self.app.get('/datasets/%s/variables.json?q=temperature' % self.dataset._id).data)
+        assert [v['name'] for v in rv['results']] == ['temp']
+
+        rv = json.loads(self.app.get('/datasets/%s/variables.json?standard_name=northward_sea_water_velocity' % self.dataset._id).data)
+        assert [v['name'] for v in rv['results']] == ['v']
+        assert rv['results'][0]['attributes']['units'] == 'm/s'
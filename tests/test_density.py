@@ -0,0 +1,55 @@
+import os
+import time
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+
+from larva_service.density import grid_bounds, histogram, to_png, prune
+
+
+class DensityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Particle 0 sits in one cell for 3 steps, particle 1 moves through 3 cells
+        self.lons = np.array([0.05, 0.05, 0.05, 0.05, 0.15, 0.25])
+        self.lats = np.array([0.05, 0.05, 0.05, 0.05, 0.05, 0.05])
+        self.pids = np.array([0, 0, 0, 1, 1, 1])
+        self.bounds = grid_bounds(self.lons, self.lats, 0.1)
+
+    def test_bounds_snap_to_cells(self):
+        assert np.allclose(self.bounds, (0., 0., 0.3, 0.1))
+
+    def test_density(self):
+        values = histogram(self.lons, self.lats, self.pids, self.bounds, 0.1, kind='density')
+        assert values.shape == (1, 3)
+        assert np.allclose(values, [[4 / 6., 1 / 6., 1 / 6.]])
+
+    def test_presence(self):
+        values = histogram(self.lons, self.lats, self.pids, self.bounds, 0.1, kind='presence')
+        assert np.allclose(values, [[1., 0.5, 0.5]])
+
+    def test_points_outside_bounds_are_dropped(self):
+        values = histogram(self.lons, self.lats, self.pids, (0., 0., 0.1, 0.1), 0.1)
+        assert np.allclose(values, [[4 / 6.]])
+
+    def test_png(self):
+        png = to_png(np.array([[0., 0.5], [1., 0.25]]))
+        assert png.startswith(b"\x89PNG\r\n\x1a\n")
+
+    def test_prune(self):
+        folder = tempfile.mkdtemp()
+        try:
+            for i in range(4):
+                path = os.path.join(folder, "%d.npz" % i)
+                open(path, "wb").close()
+                os.utime(path, (time.time() - 100 + i, time.time() - 100 + i))
+            # Used since
+            os.utime(os.path.join(folder, "0.npz"), None)
+            open(os.path.join(folder, "4.npz.1.tmp"), "wb").close()
+
+            prune(folder, 2)
+            assert sorted(os.listdir(folder)) == ["0.npz", "3.npz", "4.npz.1.tmp"]
+        finally:
+            shutil.rmtree(folder)
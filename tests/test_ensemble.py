@@ -0,0 +1,45 @@
+import unittest
+
+import numpy as np
+
+from larva_service.ensemble import Land, haversine, describe, summarize
+
+
+class EnsembleTestCase(unittest.TestCase):
+
+    def test_haversine(self):
+        # One degree of latitude is ~111.2km
+        d = haversine(np.array([0., -147.]), np.array([0., 60.]), np.array([0., -147.]), np.array([1., 61.]))
+        assert np.allclose(d, [111.195, 111.195], atol=0.01)
+
+    def test_land_contains(self):
+        from shapely.geometry import box
+
+        land = Land([box(0, 0, 1, 1), box(2, 0, 3, 1)])
+        lons = np.array([[0.5, 1.5, 2.5], [5., 0.5, -1.]])
+        lats = np.array([[0.5, 0.5, 0.5], [0.5, 2., 0.5]])
+        assert land.contains(lons, lats).tolist() == [[True, False, True], [False, False, False]]
+        assert Land([box(0, 0, 1, 1)], buffer=0.1).contains(np.array([1.05]), np.array([0.5])).tolist() == [True]
+
+    def test_describe_ignores_nan(self):
+        stats = describe(np.array([1., np.nan, 3.]))
+        assert stats['mean'] == 2.
+        assert stats['p50'] == 2.
+        assert describe(np.array([np.nan])) is None
+
+    def test_summarize(self):
+        summary = summarize({ 'distance'      : np.array([10., 20., 30., 40.]),
+                              'beached_hours' : np.array([np.nan, 5., np.nan, 7.]),
+                              'settled'       : np.array([True, False, False, False]) })
+        assert summary['particles'] == 4
+        assert summary['arrival_probability'] == 0.5
+        assert summary['settled_probability'] == 0.25
+        assert summary['hours_to_beaching']['mean'] == 6.
+        assert summary['distance_km']['max'] == 40.
+
+    def test_summarize_without_shoreline(self):
+        summary = summarize({ 'distance'      : np.array([10.]),
+                              'beached_hours' : np.array([np.nan]),
+                              'settled'       : np.array([False]) }, beaching=False)
+        assert summary['arrival_probability'] is None
+        assert summary['hours_to_beaching'] is None
@@ -0,0 +1,51 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import netCDF4
+
+from larva_service.hydro_cache import content_hash, compress
+
+
+class HydroCacheTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.source = os.path.join(self.folder, "source.nc")
+        self.write(self.source, np.arange(240, dtype=np.float32).reshape(10, 4, 6))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, path, values, fmt="NETCDF3_CLASSIC"):
+        nc = netCDF4.Dataset(path, "w", format=fmt)
+        nc.title = "cache"
+        nc.createDimension("time", None)
+        nc.createDimension("y", values.shape[1])
+        nc.createDimension("x", values.shape[2])
+        u = nc.createVariable("u", "f4", ("time", "y", "x"), fill_value=-999.)
+        u.units = "m/s"
+        u[:] = values
+        nc.close()
+
+    def test_compressed_copy_has_the_same_content(self):
+        path = compress(self.source, os.path.join(self.folder, "out", "compressed.nc"))
+        assert content_hash(path) == content_hash(self.source)
+
+        nc = netCDF4.Dataset(path)
+        try:
+            filters = nc.variables["u"].filters()
+            assert filters['zlib'] is True
+            assert filters['shuffle'] is True
+            assert nc.variables["u"].units == "m/s"
+            assert nc.dimensions["time"].isunlimited()
+        finally:
+            nc.close()
+        assert os.listdir(os.path.join(self.folder, "out")) == ["compressed.nc"]
+
+    def test_different_values_hash_differently(self):
+        other = os.path.join(self.folder, "other.nc")
+        self.write(other, np.zeros((10, 4, 6), dtype=np.float32))
+        assert content_hash(other) != content_hash(self.source)
@@ -0,0 +1,36 @@
+import os
+import sys
+import json
+import unittest
+import subprocess
+
+# Seconds a gunicorn worker may spend importing the web application
+IMPORT_TIME_BUDGET = 2.0
+
+# Scientific packages only the rq workers should ever load
+WORKER_ONLY_MODULES = ['paegan', 'netCDF4', 'fiona', 'tables']
+
+IMPORT_SCRIPT = """
+import sys
+import json
+import time
+started = time.time()
+import larva_service
+elapsed = time.time() - started
+loaded = [m for m in sys.modules if m.split('.')[0] in %r and sys.modules[m] is not None]
+print(json.dumps({ 'elapsed' : elapsed, 'loaded' : sorted(loaded) }))
+""" % WORKER_ONLY_MODULES
+
+
+class ImportTimeTestCase(unittest.TestCase):
+
+    def setUp(self):
+        # Import in a fresh interpreter, the test runner already has everything loaded
+        output = subprocess.check_output([sys.executable, '-c', IMPORT_SCRIPT], env=dict(os.environ))
+        self.result = json.loads(output.strip().splitlines()[-1])
+
+    def test_no_worker_modules_in_web_tier(self):
+        assert self.result['loaded'] == [], self.result['loaded']
+
+    def test_import_time_budget(self):
+        assert self.result['elapsed'] < IMPORT_TIME_BUDGET, "Importing larva_service took %.2fs" % self.result['elapsed']
@@ -3,6 +3,8 @@ import json
 import pytz
 from datetime import datetime
 
+from larva_service.models.run import s3_filename, file_key_and_link
+
 
 class LarvaRunTestCase(FlaskMongoTestCase):
 
@@ -69,3 +71,41 @@ class LarvaRunTestCase(FlaskMongoTestCase):
         # Defaults
         assert result_json['time_chunk'] == 10
         assert result_json['horiz_chunk'] == 5
+
+    def test_conditional_run_description(self):
+        rv = self.app.get('/runs/%s.json' % self.run['_id'])
+        assert rv.headers['Cache-Control'] == "no-cache"
+        etag = rv.headers['ETag']
+
+        rv = self.app.get('/runs/%s.json' % self.run['_id'], headers={ 'If-None-Match' : etag })
+        assert rv.status_code == 304
+
+    def test_live_listing_is_not_cached(self):
+        rv = self.app.get('/runs.json')
+        assert 'ETag' not in rv.headers
+        assert rv.headers['Cache-Control'] == "no-cache"
+        assert [r['_id'] for r in json.loads(rv.data)['results']] == [str(self.run['_id'])]
+
+    def test_saving_invalidates_cached_run(self):
+        from larva_service import db
+
+        url = '/runs/%s.json' % self.run['_id']
+        assert json.loads(self.app.get(url).data)['name'] != u"Renamed"
+
+        run = db.Run.find_one({ '_id' : self.run['_id'] })
+        run.name = u"Renamed"
+        run.save()
+        assert json.loads(self.app.get(url).data)['name'] == u"Renamed"
+
+    def test_s3_file_types(self):
+        base = "http://bucket.s3.amazonaws.com/output/abc/"
+        files = ["profile.pstats", "particle_profile.pstats", "profile.collapsed", "particle_profile.collapsed",
+                 "model.log.gz", "output.h5", "particle_tracklines.geojson"]
+        names = [s3_filename(u"Particle spill", f) for f in files]
+        assert names[0] == u"Particle-spill-profile.pstats"
+        assert len(set(names)) == len(files)
+
+        types = [file_key_and_link("abc", base + n).keys()[0] for n in names]
+        assert types == ["Profile (pstats)", "Particle Profile (pstats)",
+                         "Profile (collapsed stacks)", "Particle Profile (collapsed stacks)",
+                         "Logfile (gzip)", "HDF5 Data File", "Particle Tracklines (GeoJSON)"]
@@ -0,0 +1,140 @@
+import time
+import socket
+import unittest
+
+from rq import Queue, Worker
+
+from larva_service import redis_connection
+from larva_service.locality import (WARM_KEY, ROUTED_KEY, Router, LocalityWorker, advertise, warm_hosts,
+                                    release_overdue, host_queue_name)
+
+QUEUE = "larva_service_test"
+RESOURCES = ["http://example.com/thredds/dodsC/hydro.nc", "/data/shore.shp"]
+
+
+def noop():
+    pass
+
+
+class LocalityTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.queue = Queue(QUEUE, connection=redis_connection)
+        self.hosts = ["host-a", "host-b", socket.gethostname()]
+        self.workers = []
+        self.clean()
+
+    def tearDown(self):
+        for w in self.workers:
+            w.register_death()
+        self.clean()
+
+    def clean(self):
+        for q in [self.queue] + [self.host_queue(h) for h in self.hosts]:
+            q.empty()
+        redis_connection.delete(ROUTED_KEY % QUEUE, *[WARM_KEY % h for h in self.hosts])
+
+    def host_queue(self, host):
+        return Queue(host_queue_name(QUEUE, host), connection=redis_connection)
+
+    def worker(self, host, n):
+        w = Worker([self.host_queue(host), self.queue], name="%s-%d" % (host, n), connection=redis_connection)
+        w.register_birth()
+        self.workers.append(w)
+        return w
+
+    def test_warm_hosts(self):
+        self.worker("host-a", 1)
+        self.worker("host-b", 1)
+        self.worker("host-b", 2)
+        advertise(redis_connection, RESOURCES, host="host-a")
+        advertise(redis_connection, RESOURCES[:1], host="host-b")
+
+        assert warm_hosts(self.queue, RESOURCES) == { "host-a" : [1, 2], "host-b" : [2, 1] }
+        assert warm_hosts(self.queue, RESOURCES[1:]) == { "host-a" : [1, 1] }
+        assert warm_hosts(self.queue, [None]) == {}
+
+    def test_cold_resources_are_not_warm(self):
+        self.worker("host-a", 1)
+        redis_connection.execute_command('ZADD', WARM_KEY % "host-a", time.time() - 7200, RESOURCES[0])
+        assert warm_hosts(self.queue, RESOURCES) == {}
+
+    def test_router_slots(self):
+        self.worker("host-a", 1)
+        self.worker("host-b", 1)
+        self.worker("host-b", 2)
+        advertise(redis_connection, RESOURCES, host="host-a")
+        advertise(redis_connection, RESOURCES[:1], host="host-b")
+
+        router = Router(self.queue, RESOURCES)
+        # Warmest first, two jobs per worker, then the shared queue
+        assert router._slots == ["host-a"] * 2 + ["host-b"] * 4
+        jobs = [router.enqueue_call(func=noop) for i in range(7)]
+
+        assert self.host_queue("host-a").job_ids == [j.id for j in jobs[:2]]
+        assert self.host_queue("host-b").job_ids == [j.id for j in jobs[2:6]]
+        assert self.queue.job_ids == [jobs[6].id]
+        assert redis_connection.zcard(ROUTED_KEY % QUEUE) == 6
+
+    def test_router_without_warm_hosts(self):
+        self.worker("host-a", 1)
+        job = Router(self.queue, RESOURCES).enqueue_call(func=noop)
+        assert self.queue.job_ids == [job.id]
+        assert not redis_connection.exists(ROUTED_KEY % QUEUE)
+
+    def test_release_overdue(self):
+        self.worker("host-a", 1)
+        advertise(redis_connection, RESOURCES, host="host-a")
+
+        waiting = Router(self.queue, RESOURCES, fallback=0).enqueue_call(func=noop)
+        assert release_overdue(self.queue) == 1
+        assert self.host_queue("host-a").job_ids == []
+        assert self.queue.job_ids == [waiting.id]
+        # Released once
+        assert release_overdue(self.queue) == 0
+        assert self.queue.job_ids == [waiting.id]
+
+    def test_started_jobs_are_not_released(self):
+        self.worker("host-a", 1)
+        advertise(redis_connection, RESOURCES, host="host-a")
+
+        started = Router(self.queue, RESOURCES, fallback=0).enqueue_call(func=noop)
+        # Taken by a worker on its host before it fell back
+        assert self.host_queue("host-a").pop_job_id() == started.id
+        assert release_overdue(self.queue) == 0
+        assert self.queue.job_ids == []
+        assert not redis_connection.exists(ROUTED_KEY % QUEUE)
+
+    def test_jobs_not_due_stay_routed(self):
+        self.worker("host-a", 1)
+        advertise(redis_connection, RESOURCES, host="host-a")
+
+        job = Router(self.queue, RESOURCES, fallback=60).enqueue_call(func=noop)
+        assert release_overdue(self.queue) == 0
+        assert self.host_queue("host-a").job_ids == [job.id]
+
+    def test_worker_listens_on_its_host_first(self):
+        worker = LocalityWorker([self.queue], connection=redis_connection)
+        assert worker.queue_names() == [host_queue_name(QUEUE, socket.gethostname()), QUEUE]
+        assert [q.name for q in worker.shared_queues] == [QUEUE]
+
+        shared = self.queue.enqueue_call(func=noop)
+        own = self.host_queue(socket.gethostname()).enqueue_call(func=noop)
+        job, queue = worker.dequeue_job_and_maintain_ttl(1)
+        assert job.id == own.id
+        job, queue = worker.dequeue_job_and_maintain_ttl(1)
+        assert job.id == shared.id
+
+    def test_worker_releases_overdue_jobs(self):
+        self.worker("host-a", 1)
+        advertise(redis_connection, RESOURCES, host="host-a")
+        routed = Router(self.queue, RESOURCES, fallback=1).enqueue_call(func=noop)
+
+        worker = LocalityWorker([self.queue], connection=redis_connection)
+        worker.release_interval = 1
+        started = time.time()
+        # Wakes up while waiting to move the job host-a did not start
+        job, queue = worker.dequeue_job_and_maintain_ttl(10)
+        assert job.id == routed.id
+        assert queue.name == QUEUE
+        assert time.time() - started < 5
@@ -0,0 +1,82 @@
+import os
+import json
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables
+
+from larva_service.particles import build_store
+from larva_service.metadata import particle_summary, summarize
+
+
+class ResultsTable(tables.IsDescription):
+    particle  = tables.UInt8Col()
+    time      = tables.Time32Col()
+    latitude  = tables.Float32Col()
+    longitude = tables.Float32Col()
+    depth     = tables.Float32Col()
+    settled   = tables.BoolCol()
+    dead      = tables.BoolCol()
+
+
+class MetadataTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        results = os.path.join(self.folder, "results.h5")
+
+        # 3 particles drifting north 0.1 degrees per hour for 5 hours, particle 1
+        # settles at the end and particle 2 dies and drops out after 3
+        with tables.open_file(results, mode="w") as h5:
+            group = h5.create_group("/", "trajectories")
+            table = h5.create_table(group, "model_results", ResultsTable)
+            row = table.row
+            for t in range(5):
+                for p in range(3):
+                    if p == 2 and t > 2:
+                        continue
+                    row['particle'] = p
+                    row['time'] = 1388538000 + t * 3600
+                    row['latitude'] = 60. + t * 0.1
+                    row['longitude'] = -147. + p
+                    row['depth'] = -2. - t
+                    row['settled'] = p == 1 and t == 4
+                    row['dead'] = p == 2 and t == 2
+                    row.append()
+            table.flush()
+
+        self.store = build_store(results, os.path.join(self.folder, "store.h5"))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_particle_summary(self):
+        # Chunks of 2 timesteps, so distances cross chunk boundaries
+        summary = particle_summary(self.store, chunk_size=2)
+        assert summary['particles'] == 3
+        assert summary['timesteps'] == 5
+        assert np.allclose(summary['bounds'], [-147., 60., -145., 60.4])
+        assert summary['depth'] == { 'min' : -6., 'max' : -2. }
+        # 0.4 degrees of latitude is ~44.5km
+        assert np.allclose(summary['distance_km']['max'], 44.478, atol=0.01)
+        assert np.allclose(summary['distance_km']['min'], 22.239, atol=0.01)
+        assert summary['settled'] == 1
+        assert summary['dead'] == 1
+        assert summary['halted'] == 0
+
+    def test_summarize(self):
+        output = os.path.join(self.folder, "output")
+        os.makedirs(output)
+        trackline = { 'type' : 'LineString', 'coordinates' : [[-147., 60.], [-147., 60.4]] }
+        with open(os.path.join(output, "simple_trackline.geojson"), "w") as f:
+            json.dump(trackline, f)
+
+        summary, geo = summarize(output, self.store)
+        assert geo == trackline
+        assert summary['particles'] == 3
+
+        summary, geo = summarize(output, None)
+        assert summary == {}
+        assert summarize(self.folder)[1] is None
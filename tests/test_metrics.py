@@ -0,0 +1,31 @@
+import unittest
+from datetime import datetime, timedelta
+
+from larva_service.metrics import PhaseTimer, queue_wait
+
+
+class FakeJob(object):
+
+    def __init__(self, enqueued_at):
+        self.enqueued_at = enqueued_at
+
+
+class MetricsTestCase(unittest.TestCase):
+
+    def test_queue_wait_from_last_enqueue(self):
+        # A rerun of a run created a day ago
+        created = datetime.utcnow() - timedelta(days=1)
+        wait = queue_wait(FakeJob(datetime.utcnow() - timedelta(seconds=30)), fallback=created)
+        assert 30 <= wait < 40
+
+    def test_queue_wait_fallback(self):
+        assert 60 <= queue_wait(FakeJob(None), fallback=datetime.utcnow() - timedelta(seconds=60)) < 70
+        assert queue_wait(None) == 0.
+
+    def test_phase_timer(self):
+        timer = PhaseTimer()
+        timer.add("queue_wait", 1.23456)
+        with timer.phase("export"):
+            pass
+        assert timer.timings.keys() == ["queue_wait", "export"]
+        assert timer.timings["queue_wait"] == 1.235
@@ -0,0 +1,71 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+import numpy as np
+import tables
+
+from larva_service.particles import build_store, ParticleStore
+
+
+class ResultsTable(tables.IsDescription):
+    particle  = tables.UInt8Col()
+    time      = tables.Time32Col()
+    latitude  = tables.Float32Col()
+    longitude = tables.Float32Col()
+    depth     = tables.Float32Col()
+
+
+class ParticleStoreTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        results = os.path.join(self.folder, "results.h5")
+
+        # 3 particles drifting east 0.1 degrees per hour for 5 hours, particle 2 drops out after 3
+        with tables.open_file(results, mode="w") as h5:
+            group = h5.create_group("/", "trajectories")
+            table = h5.create_table(group, "model_results", ResultsTable)
+            row = table.row
+            for t in range(5):
+                for p in range(3):
+                    if p == 2 and t > 2:
+                        continue
+                    row['particle'] = p
+                    row['time'] = 1388538000 + t * 3600
+                    row['latitude'] = 60. + p
+                    row['longitude'] = -147. + t * 0.1
+                    row['depth'] = -2.
+                    row.append()
+            table.flush()
+
+        self.store = ParticleStore(build_store(results, os.path.join(self.folder, "store.h5"), chunk_times=2))
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_full_store(self):
+        times, particles, data = self.store.query()
+        assert len(times) == 5
+        assert particles.tolist() == [0, 1, 2]
+        assert data['latitude'].shape == (5, 3)
+        assert np.isnan(data['latitude'][4, 2])
+        assert np.isnan(data['temperature']).all()
+
+    def test_time_range(self):
+        times, particles, data = self.store.query(time="2014-01-01T02:00:00/2014-01-01T03:00:00", fields=['longitude'])
+        assert times.tolist() == [1388538000 + 3600, 1388538000 + 7200]
+        assert data.keys() == ['longitude']
+        assert np.allclose(data['longitude'][:, 0], [-146.9, -146.8])
+
+    def test_nearest_time(self):
+        times, particles, data = self.store.query(time="2014-01-01T03:10:00")
+        assert times.tolist() == [1388538000 + 7200]
+
+    def test_bbox(self):
+        result = self.store.query_json(bbox=(-148, 60.5, -146, 61.5), fields=['latitude'])
+        assert result['fields']['latitude'][0] == [None, 61., None]
+
+    def test_unknown_field(self):
+        self.assertRaises(ValueError, self.store.query, fields=['bogus'])
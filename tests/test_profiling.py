@@ -0,0 +1,83 @@
+import os
+import shutil
+import pstats
+import time
+import tempfile
+import unittest
+import threading
+
+from larva_service.profiling import PROFILE_KEY, Profiler, profiled, save, collect
+
+
+def busy(n):
+    total = 0
+    for i in xrange(n):
+        total += sum(range(100))
+    return total
+
+
+class ProfilingTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.prefix = os.path.join(self.folder, "profile")
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def test_profiled_writes_both_files(self):
+        with profiled(self.prefix):
+            busy(20000)
+
+        stats = pstats.Stats(self.prefix + ".pstats")
+        assert any(func[2] == 'busy' for func in stats.stats)
+
+        with open(self.prefix + ".collapsed") as f:
+            lines = f.read().splitlines()
+        for line in lines:
+            stack, count = line.rsplit(" ", 1)
+            assert int(count) > 0
+        assert any("busy (test_profiling.py" in line for line in lines)
+
+    def test_disabled_writes_nothing(self):
+        with profiled(self.prefix, enabled=False):
+            busy(10)
+        assert os.listdir(self.folder) == []
+
+    def test_save_merges_profiles(self):
+        dumps = []
+        for i in range(2):
+            profiler = Profiler()
+            profiler.start()
+            busy(100)
+            profiler.stop()
+            dumps.append(profiler.dumps())
+
+        paths = save(dumps, self.prefix)
+        assert paths == [self.prefix + ".pstats", self.prefix + ".collapsed"]
+        stats = pstats.Stats(self.prefix + ".pstats")
+        calls = [v[1] for k, v in stats.stats.items() if k[2] == 'busy']
+        assert calls == [2]
+
+    def test_save_without_profiles(self):
+        assert save([], self.prefix) == []
+
+    def test_collect_waits_for_late_profiles(self):
+        from larva_service import redis_connection
+
+        key = PROFILE_KEY % "test"
+        redis_connection.delete(key)
+        profiler = Profiler()
+        profiler.start()
+        busy(10)
+        profiler.stop()
+
+        def report():
+            # Particle tasks push their profile after their results are published
+            time.sleep(0.3)
+            redis_connection.rpush(key, profiler.dumps())
+        threading.Thread(target=report).start()
+
+        profiles = collect("test", redis_connection, expected=1, timeout=5)
+        assert len(profiles) == 1
+        assert save(profiles, self.prefix) == [self.prefix + ".pstats", self.prefix + ".collapsed"]
@@ -0,0 +1,97 @@
+import os
+import json
+import time
+import unittest
+import threading
+import subprocess
+
+from larva_service.resources import RESOURCES_KEY, ResourceMonitor, MemoryCeilingExceeded, process_tree, sample, summarize_tasks, collect_usage
+
+
+class ResourcesTestCase(unittest.TestCase):
+
+    def test_sample(self):
+        usage = sample(os.getpid())
+        assert usage['rss_bytes'] > 0
+        assert usage['cpu_seconds'] > 0
+
+    def test_process_tree_includes_children(self):
+        child = subprocess.Popen(["sleep", "5"])
+        try:
+            assert child.pid in process_tree(os.getpid())
+        finally:
+            child.kill()
+            child.wait()
+
+    def test_monitor_usage(self):
+        monitor = ResourceMonitor(interval=0.05)
+        monitor.start()
+        block = bytearray(50 * 1024 * 1024)
+        sum(xrange(1000000))
+        time.sleep(0.2)
+        usage = monitor.stop()
+        del block
+
+        assert usage['peak_rss_mb'] >= 50
+        assert usage['cpu_seconds'] >= 0
+        assert usage['exceeded'] is False
+
+    def test_ceiling_fails_cleanly(self):
+        monitor = ResourceMonitor(ceiling_mb=1, interval=0.05)
+        monitor.start()
+        try:
+            with self.assertRaises(MemoryCeilingExceeded):
+                for i in range(100):
+                    time.sleep(0.05)
+        finally:
+            usage = monitor.stop()
+        assert usage['exceeded'] is True
+
+    def test_ceiling_wakes_blocked_main_thread(self):
+        # Like a distributed run joining paegan's result listener, which signals can't interrupt
+        finished = threading.Event()
+        listener = threading.Thread(target=finished.wait)
+        listener.start()
+        monitor = ResourceMonitor(ceiling_mb=1, interval=0.05, on_exceeded=finished.set)
+        monitor.start()
+        try:
+            with self.assertRaises(MemoryCeilingExceeded):
+                listener.join()
+                time.sleep(5)
+        finally:
+            usage = monitor.stop()
+        assert usage['exceeded'] is True
+
+    def test_collect_usage_waits_for_tasks(self):
+        from larva_service import redis_connection
+
+        key = RESOURCES_KEY % "test"
+        redis_connection.delete(key)
+        usage = { 'peak_rss_mb' : 100., 'cpu_seconds' : 1.5, 'read_bytes' : 10, 'write_bytes' : 1, 'exceeded' : False }
+
+        def report():
+            # Pushed after the task's results were published
+            time.sleep(0.3)
+            redis_connection.rpush(key, json.dumps(usage))
+        threading.Thread(target=report).start()
+        redis_connection.rpush(key, json.dumps(usage))
+
+        assert len(collect_usage("test", redis_connection, expected=2, timeout=5)) == 2
+        assert not redis_connection.exists(key)
+
+        started = time.time()
+        assert collect_usage("test", redis_connection, expected=1, timeout=1) == []
+        assert time.time() - started >= 1
+
+    def test_summarize_tasks(self):
+        usages = [
+            { 'peak_rss_mb' : 100., 'cpu_seconds' : 1.5, 'read_bytes' : 10, 'write_bytes' : 1, 'exceeded' : False },
+            { 'peak_rss_mb' : 250., 'cpu_seconds' : 2.5, 'read_bytes' : 20, 'write_bytes' : 2, 'exceeded' : True },
+        ]
+        summary = summarize_tasks(usages)
+        assert summary['tasks'] == 2
+        assert summary['peak_rss_mb'] == 250.
+        assert summary['cpu_seconds'] == 4.
+        assert summary['read_bytes'] == 30
+        assert summary['exceeded'] == 1
+        assert summarize_tasks([]) is None
@@ -0,0 +1,82 @@
+import os
+import shutil
+import tempfile
+import unittest
+from datetime import datetime
+
+from larva_service.retention import Retention, du, run_ids, last_used
+
+RUN_A = "5423f0d1e3f7b2a1c9d4e5f6"
+RUN_B = "5423f0d1e3f7b2a1c9d4e5f7"
+
+
+class FakeRun(object):
+
+    def __init__(self, created, ended=None):
+        self.created = created
+        self.ended = ended
+
+
+class RetentionTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.output = os.path.join(self.folder, "output")
+        self.cache = os.path.join(self.folder, "cache")
+        self.store = os.path.join(self.output, "particles")
+        for path in [os.path.join(self.output, RUN_A), os.path.join(self.cache, RUN_A), os.path.join(self.cache, "bathy"), self.store]:
+            os.makedirs(path)
+        self.write(os.path.join(self.output, RUN_A, "results.h5"), 1000)
+        self.write(os.path.join(self.cache, RUN_A, "hydro.nc.cache"), 500)
+        self.write(os.path.join(self.store, RUN_A + ".h5"), 200)
+        self.write(os.path.join(self.store, RUN_B + ".h5"), 300)
+        os.makedirs(os.path.join(self.store, RUN_A + ".h5.density"))
+        self.write(os.path.join(self.store, RUN_A + ".h5.density", "grid.npz"), 50)
+        self.write(os.path.join(self.cache, "bathy", "grid.npy"), 5000)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder)
+
+    def write(self, path, size):
+        with open(path, "wb") as f:
+            f.write("x" * size)
+
+    def test_du(self):
+        assert du(os.path.join(self.output, RUN_A)) == 1000
+        assert du(os.path.join(self.store, RUN_A + ".h5")) == 200
+        assert du(os.path.join(self.folder, "missing")) == 0
+
+    def test_shared_directories_are_not_runs(self):
+        assert run_ids(self.cache) == [RUN_A]
+        assert run_ids(self.output) == [RUN_A]
+
+    def test_usage(self):
+        r = Retention(None, None, self.output, self.cache, particle_store_path=self.store)
+        sizes = r.usage()
+        assert sizes[RUN_A] == { 'output_bytes' : 1250, 'cache_bytes' : 500 }
+        assert sizes[RUN_B] == { 'output_bytes' : 300, 'cache_bytes' : 0 }
+
+        summary = r.summary(sizes)
+        assert summary['output']['used_bytes'] == 1550
+        assert summary['output']['runs'] == 2
+        assert summary['cache']['used_bytes'] == 500
+
+    def test_evict_output_removes_density_cache(self):
+        r = Retention(None, None, self.output, self.cache, particle_store_path=self.store)
+        r.evict_output(RUN_A)
+        assert not os.path.exists(os.path.join(self.store, RUN_A + ".h5"))
+        assert not os.path.exists(os.path.join(self.store, RUN_A + ".h5.density"))
+        assert r.usage()[RUN_A] == { 'output_bytes' : 0, 'cache_bytes' : 500 }
+
+        # Left behind without its store
+        os.makedirs(os.path.join(self.store, RUN_B + ".h5.density"))
+        self.write(os.path.join(self.store, RUN_B + ".h5.density", "grid.npz"), 50)
+        os.remove(os.path.join(self.store, RUN_B + ".h5"))
+        assert r.usage()[RUN_B] == { 'output_bytes' : 50, 'cache_bytes' : 0 }
+
+    def test_last_used(self):
+        run = FakeRun(datetime(2014, 1, 1), ended=datetime(2014, 1, 2))
+        assert last_used(run, None, "lru") == last_used(run, None, "age") == 1388620800
+        # Viewing a run later only counts for lru
+        assert last_used(run, 1400000000, "lru") == 1400000000
+        assert last_used(run, 1400000000, "age") == 1388620800
@@ -0,0 +1,77 @@
+import os
+import gzip
+import shutil
+import logging
+import tempfile
+import unittest
+
+from larva_service.runlog import RateLimitFilter, RunLogHandler, follow
+
+
+class RunLogTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.logger = logging.getLogger("test_runlog")
+        self.logger.setLevel(logging.DEBUG)
+        self.logger.propagate = False
+
+    def tearDown(self):
+        for h in list(self.logger.handlers):
+            self.logger.removeHandler(h)
+        for f in list(self.logger.filters):
+            self.logger.removeFilter(f)
+        shutil.rmtree(self.folder)
+
+    def read(self, path):
+        with gzip.open(path) as f:
+            return f.read().splitlines()
+
+    def test_rate_limit_counts_similar_messages_together(self):
+        f = RateLimitFilter(burst=3, interval=3600)
+        records = [logging.LogRecord("x", logging.INFO, __file__, 1, "Particle %d moved to %f", (i, i / 3.), None) for i in range(10)]
+        passed = [r for r in records if f.filter(r)]
+        assert len(passed) == 3
+
+        other = logging.LogRecord("x", logging.INFO, __file__, 1, "Something else", (), None)
+        assert f.filter(other)
+
+        warning = logging.LogRecord("x", logging.WARNING, __file__, 1, "Particle %d is lost", (1,), None)
+        assert all(f.filter(warning) for i in range(10))
+
+    def test_rate_limit_reports_dropped_messages(self):
+        f = RateLimitFilter(burst=1, interval=3600)
+        first = logging.LogRecord("x", logging.INFO, __file__, 1, "Step %d", (1,), None)
+        assert f.filter(first)
+        for i in range(5):
+            assert not f.filter(logging.LogRecord("x", logging.INFO, __file__, 1, "Step %d", (i,), None))
+
+        # A new window lets the next one through with the count of what was dropped
+        f.interval = 0
+        record = logging.LogRecord("x", logging.INFO, __file__, 1, "Step %d", (9,), None)
+        assert f.filter(record)
+        assert record.getMessage() == "Step 9 (5 similar messages dropped)"
+
+    def test_handler_writes_gzip_and_keeps_tail(self):
+        path = os.path.join(self.folder, "model.log.gz")
+        handler = RunLogHandler(path, tail=5, batch=1000, interval=3600)
+        self.logger.addHandler(handler)
+        for i in range(20):
+            self.logger.info("line %d", i)
+
+        assert list(handler.tail) == ["line %d" % i for i in range(15, 20)]
+        handler.close()
+        assert self.read(path) == ["line %d" % i for i in range(20)]
+
+    def test_follow(self):
+        source = os.path.join(self.folder, "plain.log")
+        with open(source, "w") as f:
+            f.write("one\ntwo\nthr")
+        with open(source, "a") as f:
+            f.write("ee")
+
+        path = os.path.join(self.folder, "model.log.gz")
+        handler = RunLogHandler(path)
+        follow(source, handler, lambda: True)
+        handler.close()
+        assert self.read(path) == ["one", "two", "three"]
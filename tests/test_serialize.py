@@ -0,0 +1,38 @@
+import json
+import unittest
+from datetime import datetime
+
+from bson.objectid import ObjectId
+from flask import Flask
+
+from larva_service import serialize
+
+
+class SerializeTestCase(unittest.TestCase):
+
+    def test_dumps(self):
+        js = json.loads(serialize.dumps({ 'created' : datetime(2014, 1, 1, 0, 0, 1, 500000), 'run' : ObjectId("0" * 24) }))
+        assert js['created'] == 1388534401500
+        assert js['run'] == "0" * 24
+
+    def test_api_document(self):
+        doc = { '_id' : ObjectId("1" * 24), 'name' : u"run", 'output' : [u"/tmp/a.h5"] }
+        js = serialize.api_document(doc, ['name', 'email'])
+        assert js == { '_id' : u"1" * 24, 'name' : u"run", 'email' : None }
+
+    def test_stream(self):
+        serialize.STREAM_BYTES, default = 64, serialize.STREAM_BYTES
+        try:
+            app = Flask(__name__)
+            with app.test_request_context():
+                rv = serialize.stream('results', ({ 'i' : i, 'padding' : 'x' * 20 } for i in range(10)))
+                chunks = list(rv.response)
+        finally:
+            serialize.STREAM_BYTES = default
+
+        assert len(chunks) > 1
+        js = json.loads(''.join(chunks))
+        assert [r['i'] for r in js['results']] == range(10)
+
+        with app.test_request_context():
+            assert json.loads(''.join(serialize.stream('results', iter([])).response)) == { 'results' : [] }
@@ -0,0 +1,41 @@
+import os
+import shutil
+import tempfile
+import unittest
+
+from shapely.geometry import box, MultiPolygon
+
+from larva_service.shoreline_index import build_index, load_index
+
+
+class ShorelineIndexTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.folder = tempfile.mkdtemp()
+        self.path = os.path.join(self.folder, "shoreline")
+
+        # A 30x30 grid of small islands, with the last row as MultiPolygons
+        self.geoms = [box(x, y, x + 0.5, y + 0.5) for x in range(30) for y in range(29)]
+        self.geoms += [MultiPolygon([box(x, 29, x + 0.25, 29.5), box(x + 0.25, 29.5, x + 0.5, 29.75)]) for x in range(30)]
+        self.stats = build_index(self.geoms, self.path, node_size=16)
+        self.index = load_index(self.path)
+
+    def tearDown(self):
+        shutil.rmtree(self.folder, ignore_errors=True)
+
+    def test_stats(self):
+        assert self.stats['features'] == 30 * 29 + 60
+        assert self.stats['bounds'] == [0., 0., 29.5, 29.75]
+        assert self.stats['bytes'] > 0
+        assert len(self.index) == self.stats['features']
+
+    def test_query_bounds(self):
+        geoms = self.index.query((10.25, 10.25, 11.25, 11.25))
+        assert sorted(g.bounds for g in geoms) == [(10., 10., 10.5, 10.5), (10., 11., 10.5, 11.5), (11., 10., 11.5, 10.5), (11., 11., 11.5, 11.5)]
+
+    def test_query_wkt(self):
+        geoms = self.index.query(box(-5, 29.6, 1.3, 40).wkt)
+        assert len(geoms) == 2
+
+    def test_query_outside(self):
+        assert self.index.query((100, 100, 101, 101)) == []
@@ -0,0 +1,148 @@
+import json
+import time
+import unittest
+import threading
+
+from larva_service import app
+from larva_service import streams
+from larva_service.streams import StreamingRedis, flush_all, delete_streams
+
+CHANNEL = "larva_service_test:results"
+LOG_CHANNEL = "larva_service_test:log"
+
+
+class StreamsTestCase(unittest.TestCase):
+
+    def setUp(self):
+        self.settings = dict(streams.settings)
+        # Nothing is written until flushed
+        streams.settings.update(batch=1000, interval=3600)
+        streams._streams.update([CHANNEL, LOG_CHANNEL])
+        self.connection = StreamingRedis.from_url(app.config['REDIS_URI'])
+        self.connection.delete(CHANNEL, LOG_CHANNEL)
+
+    def tearDown(self):
+        flush_all()
+        delete_streams([CHANNEL, LOG_CHANNEL], self.connection)
+        streams.settings.clear()
+        streams.settings.update(self.settings)
+
+    def subscribe(self):
+        pubsub = self.connection.pubsub()
+        pubsub.subscribe(CHANNEL)
+        return pubsub
+
+    def read(self, pubsub):
+        messages = []
+        while True:
+            message = pubsub.get_message(ignore_subscribe_messages=True)
+            if message is None:
+                return messages
+            messages.append(message['data'])
+
+    def test_buffered_until_flushed(self):
+        pubsub = self.subscribe()
+        self.connection.publish(CHANNEL, "a")
+        assert self.read(pubsub) == []
+        flush_all()
+        assert self.read(pubsub) == ["a"]
+
+    def test_order_across_clients(self):
+        # Results go out through the forcer's client, COMPLETED through another
+        forcer = StreamingRedis.from_url(app.config['REDIS_URI'])
+        runner = StreamingRedis.from_url(app.config['REDIS_URI'])
+        pubsub = self.subscribe()
+
+        for i in range(10):
+            forcer.publish(CHANNEL, json.dumps({ 'time' : i }))
+        forcer.publish(LOG_CHANNEL, "log")
+        runner.publish(CHANNEL, json.dumps({ 'status' : 'COMPLETED' }))
+        # Writing through either client writes out both
+        runner.flush()
+
+        messages = [json.loads(m) for m in self.read(pubsub)]
+        assert [m.get('time') for m in messages[:-1]] == range(10)
+        assert messages[-1] == { 'status' : 'COMPLETED' }
+
+    def test_acknowledged_and_deleted(self):
+        pubsub = self.subscribe()
+        for i in range(3):
+            self.connection.publish(CHANNEL, str(i))
+        flush_all()
+
+        assert pubsub.get_message(ignore_subscribe_messages=True)['data'] == "0"
+        assert self.connection.execute_command('XLEN', CHANNEL) == 3
+        # Asking for the next one acknowledges the last
+        assert pubsub.get_message(ignore_subscribe_messages=True)['data'] == "1"
+        assert self.connection.execute_command('XLEN', CHANNEL) == 2
+        pubsub.close()
+        assert self.connection.execute_command('XLEN', CHANNEL) == 1
+        assert self.connection.execute_command('XPENDING', CHANNEL, streams.GROUP)[0] == 0
+
+    def test_listen(self):
+        pubsub = self.subscribe()
+        for i in range(3):
+            self.connection.publish(CHANNEL, str(i))
+        flush_all()
+
+        received = []
+        for message in pubsub.listen():
+            if message['type'] == 'message':
+                received.append(message['data'])
+            if len(received) == 3:
+                pubsub.unsubscribe()
+        assert received == ["0", "1", "2"]
+
+    def test_pubsub_channels(self):
+        pubsub = self.connection.pubsub()
+        pubsub.subscribe("larva_service_test:other")
+        time.sleep(0.1)
+        assert pubsub.get_message(timeout=1)['type'] == 'subscribe'
+        self.connection.publish("larva_service_test:other", "x")
+        assert pubsub.get_message(timeout=1)['data'] == "x"
+        assert not self.connection.exists("larva_service_test:other")
+        pubsub.close()
+
+    def test_backpressure_gives_up(self):
+        streams.settings.update(max_backlog=4, timeout=0.2)
+        self.subscribe()
+
+        started = time.time()
+        for i in range(10):
+            self.connection.publish(CHANNEL, str(i))
+        flush_all()
+        assert time.time() - started >= 0.2
+        assert CHANNEL in streams._gave_up
+
+        # Not waited for again
+        started = time.time()
+        self.connection.publish(CHANNEL, "more")
+        flush_all()
+        assert time.time() - started < 0.2
+        assert self.connection.execute_command('XLEN', CHANNEL) == 11
+
+    def test_backpressure_waits_for_consumer(self):
+        streams.settings.update(max_backlog=4, timeout=10)
+        pubsub = self.subscribe()
+        received = []
+
+        def consume():
+            time.sleep(0.3)
+            deadline = time.time() + 5
+            while len(received) < 10 and time.time() < deadline:
+                message = pubsub.get_message(ignore_subscribe_messages=True, timeout=0.1)
+                if message is not None:
+                    received.append(message['data'])
+            pubsub.acknowledge()
+
+        consumer = threading.Thread(target=consume)
+        consumer.start()
+        started = time.time()
+        for i in range(10):
+            self.connection.publish(CHANNEL, str(i))
+        flush_all()
+        consumer.join()
+
+        assert 0.3 <= time.time() - started < 10
+        assert CHANNEL not in streams._gave_up
+        assert received == [str(i) for i in range(10)]
@@ -0,0 +1,38 @@
+import json
+import unittest
+
+from larva_service import tracklines
+
+
+class TracklinesTestCase(unittest.TestCase):
+
+    def trackline(self, n=500):
+        return { 'type' : 'LineString', 'coordinates' : [[-147.123456 + k * 0.0013, 60.75 - k * 0.0007, -k * 0.25] for k in range(n)] }
+
+    def test_round_trip(self):
+        geo = self.trackline()
+        decoded = tracklines.decode(tracklines.encode(geo))
+        assert decoded['type'] == 'LineString'
+        assert len(decoded['coordinates']) == 500
+        for a, b in zip(geo['coordinates'], decoded['coordinates']):
+            assert abs(a[0] - b[0]) < 1e-6
+            assert abs(a[1] - b[1]) < 1e-6
+            assert abs(a[2] - b[2]) < 1e-3
+
+    def test_nested(self):
+        geo = { 'type'     : 'Feature',
+                'id'       : 'center',
+                'properties' : { 'particles' : 10 },
+                'geometry' : { 'type' : 'GeometryCollection',
+                               'geometries' : [{ 'type' : 'Point', 'coordinates' : [-147., 60.75] },
+                                               { 'type' : 'MultiLineString', 'coordinates' : [[[-147., 60.75], [-147.5, 61.]], [[-146., 60.]]] }] } }
+        decoded = tracklines.decode(tracklines.encode(geo))
+        assert decoded == geo
+        assert tracklines.count(geo) == 4
+
+    def test_smaller(self):
+        geo = self.trackline()
+        assert len(tracklines.encode(geo)) * 4 < len(json.dumps(geo))
+
+    def test_not_encoded(self):
+        self.assertRaises(ValueError, tracklines.decode, "not a trackline")